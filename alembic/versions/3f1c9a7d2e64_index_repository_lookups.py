@@ -0,0 +1,59 @@
+"""index repository lookups
+
+Revision ID: 3f1c9a7d2e64
+Revises: 8769e8050b81
+Create Date: 2026-10-18 18:40:52.113094
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1c9a7d2e64"
+down_revision: Union[str, None] = "8769e8050b81"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (name, table, columns, unique)
+INDEXES = [
+    ("ix_order_lines_orderid", "order_lines", ["orderid"], False),
+    ("ix_batches_reference", "batches", ["reference"], True),
+    ("ix_batches_sku", "batches", ["sku"], False),
+    ("ix_allocations_batch_id", "allocations", ["batch_id"], False),
+    ("ix_allocations_orderline_id", "allocations", ["orderline_id"], False),
+]
+
+
+def check_references_are_unique() -> None:
+    duplicates = op.get_bind().execute(
+        sa.text(
+            "SELECT reference FROM batches GROUP BY reference HAVING COUNT(*) > 1"
+        )
+    )
+    references = [reference for (reference,) in duplicates]
+    if references:
+        raise RuntimeError(
+            f"Batch references must be unique before migrating; duplicated: {references}"
+        )
+
+
+def upgrade() -> None:
+    if not context.is_offline_mode():
+        check_references_are_unique()
+    # on Postgres, build without locking the tables against writes; CONCURRENTLY
+    # can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            op.create_index(
+                name, table, columns, unique=unique, postgresql_concurrently=True
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
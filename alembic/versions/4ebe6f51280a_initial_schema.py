@@ -0,0 +1,68 @@
+"""initial schema
+
+The tables as ``orm.metadata.create_all`` built them before migrations were
+introduced; databases created that way can be stamped at this revision.
+
+Revision ID: 4ebe6f51280a
+Revises:
+Create Date: 2026-10-18 18:10:18.373114
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "4ebe6f51280a"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "order_lines",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("sku", sa.String(length=255), nullable=True),
+        sa.Column("qty", sa.Integer(), nullable=False),
+        sa.Column("orderid", sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "products",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("sku", sa.String(length=255), nullable=True),
+        sa.Column("version", sa.Integer(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_products_sku"), "products", ["sku"], unique=True)
+    op.create_table(
+        "batches",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("reference", sa.String(length=255), nullable=True),
+        sa.Column("sku", sa.String(length=255), nullable=True),
+        sa.Column("_purchased_quantity", sa.Integer(), nullable=False),
+        sa.Column("eta", sa.Date(), nullable=True),
+        sa.ForeignKeyConstraint(["sku"], ["products.sku"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "allocations",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("orderline_id", sa.Integer(), nullable=True),
+        sa.Column("batch_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["batch_id"], ["batches.id"]),
+        sa.ForeignKeyConstraint(["orderline_id"], ["order_lines.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("allocations")
+    op.drop_table("batches")
+    op.drop_index(op.f("ix_products_sku"), table_name="products")
+    op.drop_table("products")
+    op.drop_table("order_lines")
@@ -0,0 +1,46 @@
+"""add allocations view
+
+Revision ID: 8769e8050b81
+Revises: 9c2d51e7a3b8
+Create Date: 2026-10-18 18:15:16.867701
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8769e8050b81"
+down_revision: Union[str, None] = "9c2d51e7a3b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "allocations_view",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("orderid", sa.String(length=255), nullable=False),
+        sa.Column("sku", sa.String(length=255), nullable=False),
+        sa.Column("qty", sa.Integer(), nullable=False),
+        sa.Column("batchref", sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_allocations_view_orderid", "allocations_view", ["orderid"], unique=False
+    )
+    # the handlers only see allocations made from now on; copy the existing ones
+    op.execute(
+        "INSERT INTO allocations_view (orderid, sku, qty, batchref)"
+        " SELECT ol.orderid, ol.sku, ol.qty, b.reference FROM allocations AS a"
+        " JOIN order_lines AS ol ON ol.id = a.orderline_id"
+        " JOIN batches AS b ON b.id = a.batch_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_allocations_view_orderid", table_name="allocations_view")
+    op.drop_table("allocations_view")
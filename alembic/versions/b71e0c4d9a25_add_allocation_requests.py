@@ -0,0 +1,41 @@
+"""add allocation requests
+
+Revision ID: b71e0c4d9a25
+Revises: 3f1c9a7d2e64
+Create Date: 2026-10-18 21:02:37.418806
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b71e0c4d9a25"
+down_revision: Union[str, None] = "3f1c9a7d2e64"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "allocation_requests",
+        sa.Column("idempotency_key", sa.String(length=255), nullable=False),
+        sa.Column("orderid", sa.String(length=255), nullable=False),
+        sa.Column("sku", sa.String(length=255), nullable=False),
+        sa.Column("qty", sa.Integer(), nullable=False),
+        sa.Column("batchref", sa.String(length=255), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.func.now(),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("idempotency_key"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("allocation_requests")
@@ -0,0 +1,58 @@
+"""
+Allocation latency as the number of lines already allocated to each batch grows.
+
+Run with ``python -m benchmarks.bench_allocation``. The "re-summed" column forces
+every batch to recompute its allocated quantity from ``_allocations`` before each
+allocation, which is what ``Batch.available_quantity`` used to do.
+"""
+
+import argparse
+import time
+
+from cosmicpython.domain.models import Batch, OrderLine, Product
+
+SKU = "HOT-SKU"
+
+
+def make_product(batches: int, lines_per_batch: int) -> Product:
+    product = Product(SKU, batches=[])
+    for b in range(batches):
+        batch = Batch(f"batch-{b}", SKU, qty=lines_per_batch * 2 + 100_000, eta=None)
+        for n in range(lines_per_batch):
+            batch.allocate(OrderLine(f"order-{b}-{n}", SKU, 1))
+        product.batches.append(batch)
+    return product
+
+
+def time_allocations(product: Product, allocations: int, resum: bool) -> float:
+    started = time.perf_counter()
+    for n in range(allocations):
+        if resum:
+            for batch in product.batches:
+                batch._allocated_quantity = None
+        product.allocate(OrderLine(f"new-order-{n}", SKU, 1))
+    return (time.perf_counter() - started) / allocations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--allocations", type=int, default=200)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1_000, 10_000, 50_000]
+    )
+    args = parser.parse_args()
+
+    print(f"{'lines/batch':>12} {'running total':>16} {'re-summed':>16}")
+    for size in args.sizes:
+        running = time_allocations(
+            make_product(args.batches, size), args.allocations, resum=False
+        )
+        resummed = time_allocations(
+            make_product(args.batches, size), args.allocations, resum=True
+        )
+        print(f"{size:>12} {running * 1e6:>13.1f} us {resummed * 1e6:>13.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Throughput of the broker consumer: ``--messages`` AllocationRequired commands
+(spread over ``--skus`` products) put on the in-process FakeBroker, then
+consumed into the message bus with reads of each ``--batch-sizes``.
+
+Bigger reads mean fewer acknowledgements, and runs of allocations handled as
+one AllocationsRequired, in one unit of work. By default the units of work are
+the in-memory fakes, so this times the broker, consumer and bus; with ``--sql``
+they go to the shared engine from ``config`` (the docker-compose Postgres, or
+whatever DB_URI points at). Run with ``python -m benchmarks.bench_broker``.
+"""
+
+import argparse
+import time
+import uuid
+
+from cosmicpython import config
+from cosmicpython.adapters import broker as brokers
+from cosmicpython.adapters import orm
+from cosmicpython.adapters.broker import FakeBroker
+from cosmicpython.domain import events
+from cosmicpython.service_layer.broker_consumer import BrokerConsumer
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import (
+    FakeUnitOfWork,
+    SqlAlchemyUnitOfWork,
+)
+
+
+def run(messages: int, skus: int, batch_size: int, sql: bool) -> float:
+    prefix = f"broker-{uuid.uuid4().hex[:6]}"
+    if sql:
+        uow_factory = SqlAlchemyUnitOfWork
+    else:
+        uow = FakeUnitOfWork()
+        uow_factory = lambda: uow  # noqa: E731
+    bus = MessageBus()
+    for n in range(skus):
+        sku = f"{prefix}-{n}"
+        bus.handle(
+            events.BatchCreated(f"{sku}-batch", sku, messages, None), uow_factory()
+        )
+
+    broker = FakeBroker()
+    consumer = BrokerConsumer(
+        broker, bus, uow_factory, batch_size=batch_size, block_ms=0
+    )
+    broker.publish(
+        brokers.INBOUND,
+        [
+            brokers.encode(
+                events.AllocationRequired(f"o{n}", f"{prefix}-{n % skus}", 1)
+            )
+            for n in range(messages)
+        ],
+    )
+    started = time.perf_counter()
+    while consumer.consume_batch():
+        pass
+    seconds = time.perf_counter() - started
+    assert consumer.metrics["handled"] == messages, consumer.metrics
+    return messages / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--skus", type=int, default=10)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000]
+    )
+    parser.add_argument("--sql", action="store_true")
+    args = parser.parse_args()
+
+    if args.sql:
+        orm.metadata.create_all(config.get_engine())
+        orm.start_mappers()
+
+    print(f"{'batch size':>10} {'messages/s':>12}")
+    for batch_size in args.batch_sizes:
+        rate = run(args.messages, args.skus, batch_size, args.sql)
+        print(f"{batch_size:>10} {rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Allocating a cart of order lines one request at a time versus in one unit of work.
+
+Needs the Postgres from docker-compose (configured through the DB_* variables in
+``.envrc``). Run with ``python -m benchmarks.bench_bulk_allocation``.
+"""
+
+import argparse
+import time
+import uuid
+
+from sqlalchemy import create_engine
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def make_cart(skus: list[str], size: int) -> list[events.AllocationRequired]:
+    return [
+        events.AllocationRequired(uuid.uuid4().hex, skus[n % len(skus)], 1)
+        for n in range(size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--skus", type=int, default=10)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 500])
+    args = parser.parse_args()
+
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = orm.sessionmaker(bind=engine)
+    bus = MessageBus()
+
+    run = uuid.uuid4().hex[:6]
+    skus = [f"bench-{run}-{n}" for n in range(args.skus)]
+    for sku in skus:
+        bus.handle(
+            events.BatchCreated(f"{sku}-batch", sku, 1_000_000, None),
+            SqlAlchemyUnitOfWork(session_factory),
+        )
+
+    print(f"{'lines':>6} {'single calls':>14} {'allocate_many':>14} {'speedup':>8}")
+    for size in args.sizes:
+        started = time.perf_counter()
+        for line in make_cart(skus, size):
+            bus.handle(line, SqlAlchemyUnitOfWork(session_factory))
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        bus.handle(
+            events.AllocationsRequired(make_cart(skus, size)),
+            SqlAlchemyUnitOfWork(session_factory),
+        )
+        bulk = time.perf_counter() - started
+
+        print(f"{size:>6} {single:>12.3f} s {bulk:>12.3f} s {single / bulk:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
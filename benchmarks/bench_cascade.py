@@ -0,0 +1,60 @@
+"""
+Time to handle a BatchQuantityChanged that empties a batch holding N lines, so
+the message bus works through N AllocationRequired events moving every line to
+a second batch. Runs against the in-memory FakeUnitOfWork, so it times the bus
+and the domain model only.
+
+With an O(1) event queue the time per reallocated line should stay flat as N
+grows. Run with ``python -m benchmarks.bench_cascade``.
+"""
+
+import argparse
+import time
+
+from cosmicpython.domain import events
+from cosmicpython.domain.models import Batch, OrderLine, Product
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+SKU = "SHRINKING-SOFA"
+
+
+def make_uow(lines: int) -> FakeUnitOfWork:
+    shrinking = Batch("shrinking", SKU, qty=lines, eta=None)
+    spare = Batch("spare", SKU, qty=lines, eta=None)
+    product = Product(SKU, batches=[])
+    product.add_batch(shrinking)
+    product.add_batch(spare)
+    for n in range(lines):
+        product.allocate(OrderLine(f"order-{n}", SKU, 1))
+    uow = FakeUnitOfWork()
+    uow.products.add(product)
+    return uow
+
+
+def time_cascade(lines: int) -> float:
+    uow = make_uow(lines)
+    started = time.perf_counter()
+    MessageBus().handle(events.BatchQuantityChanged("shrinking", 0), uow)
+    elapsed = time.perf_counter() - started
+    [product] = uow.products.seen
+    spare = next(b for b in product.batches if b.reference == "spare")
+    assert spare.allocated_quantity == lines
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--lines", type=int, nargs="+", default=[1_000, 2_000, 4_000, 8_000, 16_000]
+    )
+    args = parser.parse_args()
+
+    print(f"{'lines':>8} {'total ms':>10} {'us/line':>9}")
+    for lines in args.lines:
+        elapsed = time_cascade(lines)
+        print(f"{lines:>8} {elapsed * 1e3:>10.1f} {elapsed / lines * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Cost of collecting new events once a unit of work has seen many products: the
+bus collects after every handler, so a bulk job that has loaded ``--seen``
+products and then handles messages one at a time used to walk all of them each
+time. Now only the products that recorded events are visited.
+
+Handles ``--messages`` AllocationRequired on a FakeUnitOfWork that has seen
+each of ``--seen`` products, collecting either from the dirty products only
+("dirty") or by walking every product seen, as before ("walk"). Times the bus
+and domain model only, and separately the collecting; the rest still grows with
+``--seen`` as FakeProductRepository looks products up by scanning. Run with
+``python -m benchmarks.bench_collect_events``.
+"""
+
+import argparse
+import time
+
+from cosmicpython.domain import events
+from cosmicpython.domain.models import Batch, Product
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+
+class TimedUnitOfWork(FakeUnitOfWork):
+    collect_seconds = 0.0
+
+    def collect_new_events(self):
+        started = time.perf_counter()
+        collected = list(self.collect())
+        self.collect_seconds += time.perf_counter() - started
+        return iter(collected)
+
+    def collect(self):
+        return FakeUnitOfWork.collect_new_events(self)
+
+
+class WalkingUnitOfWork(TimedUnitOfWork):
+    def collect(self):
+        self.products.tracked.dirty.clear()
+        for product in self.products.seen:
+            events, product.events = product.events, []
+            yield from events
+
+
+def make_uow(kind: str, seen: int, messages: int) -> TimedUnitOfWork:
+    uow = (WalkingUnitOfWork if kind == "walk" else TimedUnitOfWork)()
+    for n in range(seen):
+        sku = f"sku-{n}"
+        uow.products.add(Product(sku, [Batch(f"batch-{n}", sku, messages, None)]))
+    return uow
+
+
+def time_messages(kind: str, seen: int, messages: int) -> tuple[float, float]:
+    """Seconds for all the messages, and of those, collecting their events."""
+    uow = make_uow(kind, seen, messages)
+    bus = MessageBus()
+    lines = [
+        events.AllocationRequired(f"order-{n}", f"sku-{n % seen}", 1)
+        for n in range(messages)
+    ]
+    started = time.perf_counter()
+    for line in lines:
+        bus.handle(line, uow)
+    return time.perf_counter() - started, uow.collect_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seen", type=int, nargs="+", default=[100, 1_000, 10_000])
+    parser.add_argument("--messages", type=int, default=2_000)
+    args = parser.parse_args()
+
+    print(f"{'seen':>8} {'kind':>6} {'us/message':>11} {'collecting':>11}")
+    for seen in args.seen:
+        for kind in ("walk", "dirty"):
+            total, collecting = time_messages(kind, seen, args.messages)
+            print(
+                f"{seen:>8} {kind:>6} {total / args.messages * 1e6:>11.1f}"
+                f" {collecting / args.messages * 1e6:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Many threads allocating the same SKU at once, under each concurrency strategy:
+the optimistic version check with retries, or a row lock taken when the product
+is loaded (FOR UPDATE, NOWAIT or SKIP LOCKED, retried when the row is held).
+
+Demand exceeds the batch on purpose; every run checks the batch was never
+over-allocated. Uses the shared engine from ``config`` (the docker-compose
+Postgres, or whatever DB_URI points at; size DB_POOL_SIZE for the threads).
+Run with ``python -m benchmarks.bench_contention``.
+"""
+
+import argparse
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.adapters.repository import ProductLocked
+from cosmicpython.domain import events
+from cosmicpython.service_layer import handlers
+from cosmicpython.service_layer.message_bus import MessageBus, RetryPolicy
+from cosmicpython.service_layer.unit_of_work import (
+    ConcurrencyConflict,
+    SqlAlchemyUnitOfWork,
+)
+
+STRATEGIES = {
+    "optimistic": {},
+    "for-update": {handlers.allocate: {"lock": "update"}},
+    "nowait": {handlers.allocate: {"lock": "nowait"}},
+    "skip-locked": {handlers.allocate: {"lock": "skip_locked"}},
+}
+
+
+def allocated_quantity(session_factory, sku) -> tuple[int, int]:
+    session = session_factory()
+    try:
+        [[purchased, allocated]] = session.execute(
+            text(
+                "SELECT b._purchased_quantity, COALESCE(SUM(ol.qty), 0)"
+                " FROM batches AS b"
+                " LEFT JOIN allocations AS a ON a.batch_id = b.id"
+                " LEFT JOIN order_lines AS ol ON ol.id = a.orderline_id"
+                " WHERE b.sku = :sku GROUP BY b._purchased_quantity"
+            ),
+            dict(sku=sku),
+        )
+        return purchased, allocated
+    finally:
+        session.close()
+
+
+def run(strategy: str, threads: int, per_thread: int, capacity: int, session_factory):
+    sku = f"contended-{uuid.uuid4().hex[:8]}"
+    MessageBus().handle(
+        events.BatchCreated(f"{sku}-batch", sku, capacity, None),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+    bus = MessageBus(
+        RetryPolicy(attempts=200, backoff=0.001, max_backoff=0.05),
+        handler_options=STRATEGIES[strategy],
+    )
+    outcomes = Counter()
+
+    def worker(n):
+        for i in range(per_thread):
+            line = events.AllocationRequired(f"{sku}-{n}-{i}", sku, 1)
+            try:
+                [batchref, *_] = bus.handle(
+                    line, SqlAlchemyUnitOfWork(session_factory)
+                )
+                outcomes["allocated" if batchref else "out_of_stock"] += 1
+            except (ConcurrencyConflict, ProductLocked):
+                outcomes["gave_up"] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started
+
+    purchased, allocated = allocated_quantity(session_factory, sku)
+    assert allocated <= purchased, f"{strategy}: {allocated} allocated of {purchased}"
+    assert allocated == outcomes["allocated"], f"{strategy}: lost allocations"
+    return elapsed, outcomes, bus.metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--per-thread", type=int, default=50)
+    parser.add_argument("--capacity", type=int, default=300)
+    parser.add_argument(
+        "--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES)
+    )
+    args = parser.parse_args()
+
+    session_factory = config.init_db()
+    orm.metadata.create_all(config.get_engine())
+
+    print(
+        f"{'strategy':>12} {'req/s':>8} {'allocated':>10} {'out of stock':>13}"
+        f" {'gave up':>8} {'conflicts':>10} {'retries':>8}"
+    )
+    for strategy in args.strategies:
+        elapsed, outcomes, metrics = run(
+            strategy, args.threads, args.per_thread, args.capacity, session_factory
+        )
+        requests = args.threads * args.per_thread
+        print(
+            f"{strategy:>12} {requests / elapsed:>8.0f} {outcomes['allocated']:>10}"
+            f" {outcomes['out_of_stock']:>13} {outcomes['gave_up']:>8}"
+            f" {metrics['conflicts']:>10} {metrics['retries']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Latency against throughput for group commit: ``--threads`` threads, each
+allocating ``--lines`` one-unit lines of its own SKU, either each in a unit of
+work and commit of its own ("direct") or through a GroupCommitter gathering
+messages for each of ``--windows`` milliseconds.
+
+A longer window puts more allocations in each commit, so fewer commits (and
+fsyncs) per second are needed, but every caller waits for its group. Uses the
+shared engine from ``config`` (the docker-compose Postgres, or whatever DB_URI
+points at; size DB_POOL_SIZE for the threads). Run with
+``python -m benchmarks.bench_group_commit``.
+"""
+
+import argparse
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer.group_commit import GroupCommitter
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+from .bench_shards import delete_seeded
+
+
+def run(window, threads: int, lines: int) -> dict:
+    prefix = f"group-{uuid.uuid4().hex[:6]}"
+    bus = MessageBus()
+    for n in range(threads):
+        sku = f"{prefix}-{n}"
+        bus.handle(
+            events.BatchCreated(f"{sku}-batch", sku, lines, None),
+            SqlAlchemyUnitOfWork(),
+        )
+    group = None
+    if window is not None:
+        group = GroupCommitter(bus, window=window / 1000, max_group=threads)
+
+    def allocate(n):
+        latencies = []
+        for i in range(lines):
+            line = events.AllocationRequired(f"{prefix}-{n}-{i}", f"{prefix}-{n}", 1)
+            started = time.perf_counter()
+            if group is None:
+                [batchref, *_] = bus.handle(line, SqlAlchemyUnitOfWork())
+            else:
+                [batchref, *_] = group.handle(line)
+            latencies.append(time.perf_counter() - started)
+            assert batchref, line
+        return latencies
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        latencies = sorted(l for ls in pool.map(allocate, range(threads)) for l in ls)
+    seconds = time.perf_counter() - started
+    if group is not None:
+        group.close()
+    delete_seeded(prefix)
+    return {
+        "rate": len(latencies) / seconds,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1000,
+        "per_commit": (
+            group.metrics["messages"] / group.metrics["groups"] if group else 1
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--lines", type=int, default=100)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5])
+    args = parser.parse_args()
+
+    orm.metadata.create_all(config.get_engine())
+    orm.start_mappers()
+
+    print(
+        f"{'mode':>10} {'lines/s':>10} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'per commit':>10}"
+    )
+    for window in [None, *args.windows]:
+        result = run(window, args.threads, args.lines)
+        mode = "direct" if window is None else f"{window:g} ms"
+        print(
+            f"{mode:>10} {result['rate']:>10,.0f} {result['p50']:>8.2f}"
+            f" {result['p99']:>8.2f} {result['per_commit']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+How long importing the API module takes, from ``python -X importtime``.
+
+Run with ``python -m benchmarks.bench_import_time``. Pass ``--compare REV`` to
+measure a git revision (e.g. the commit before engine creation became lazy)
+side by side with the working tree.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+from pathlib import Path
+
+MODULE = "cosmicpython.endpoints.api"
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_time_us(source: Path) -> int:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        cwd=source,
+        env={**os.environ, "PYTHONPATH": str(source)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # "import time: self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        if line.rstrip().endswith(f"| {MODULE}"):
+            return int(line.split("|")[1])
+    raise RuntimeError(f"{MODULE} missing from importtime output:\n{result.stderr}")
+
+
+def measure(source: Path, runs: int) -> float:
+    return statistics.median(import_time_us(source) for _ in range(runs)) / 1000
+
+
+def export_revision(rev: str, into: Path) -> Path:
+    archive = into / "rev.tar"
+    subprocess.run(
+        ["git", "archive", "--output", str(archive), rev], cwd=ROOT, check=True
+    )
+    with tarfile.open(archive) as tar:
+        tar.extractall(into / "src", filter="data")
+    return into / "src"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--compare", metavar="REV")
+    args = parser.parse_args()
+
+    print(f"{'tree':>20} {'median import':>16}")
+    if args.compare:
+        with tempfile.TemporaryDirectory() as tmp:
+            source = export_revision(args.compare, Path(tmp))
+            print(f"{args.compare:>20} {measure(source, args.runs):>13.1f} ms")
+    print(f"{'working tree':>20} {measure(ROOT, args.runs):>13.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
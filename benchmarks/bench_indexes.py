@@ -0,0 +1,234 @@
+"""
+The repository's queries against a large database, checked with EXPLAIN.
+
+Seeds ``--lines`` allocated order lines (1M by default) spread over ``--skus``
+products of one batch each, then runs the statements the repositories actually
+issue: loading a product by SKU and by batch reference, finding the batch
+holding an order line, and removing an allocation. Each statement's plan must
+not scan any of the repository tables in full; the run fails if one does.
+With ``--compare`` the indexes are dropped and the timings taken again.
+
+Uses the shared engine from ``config`` (the docker-compose Postgres, or whatever
+DB_URI points at). The seeded rows are deleted afterwards unless ``--keep``.
+Run with ``python -m benchmarks.bench_indexes``.
+"""
+
+import argparse
+import re
+import time
+import uuid
+
+from sqlalchemy import event, text
+
+from cosmicpython import config
+from cosmicpython.adapters import orm, repository
+from cosmicpython.domain.models import OrderLine
+
+TABLES = ("products", "batches", "order_lines", "allocations")
+# a plan line reading a whole table, or an alias of one such as batches_1:
+# Postgres' Seq Scan, SQLite's SCAN (it says SEARCH when it uses an index)
+TABLE = rf"({'|'.join(TABLES)})(_\d+)?\b"
+FULL_SCAN = {
+    "postgresql": re.compile(rf"Seq Scan on {TABLE}"),
+    "sqlite": re.compile(rf"^SCAN {TABLE}"),
+}
+EXPLAIN = {"postgresql": "EXPLAIN", "sqlite": "EXPLAIN QUERY PLAN"}
+NUMBERS = {
+    "postgresql": "WITH numbers(n) AS (SELECT generate_series(1, :count))",
+    "sqlite": (
+        "WITH RECURSIVE numbers(n) AS"
+        " (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < :count)"
+    ),
+}
+
+
+def seed(connection, prefix: str, skus: int, lines: int) -> None:
+    numbers = NUMBERS[connection.dialect.name]
+    connection.execute(
+        text(
+            f"INSERT INTO products (sku, version) {numbers}"
+            f" SELECT '{prefix}-sku-' || n, 1 FROM numbers"
+        ),
+        dict(count=skus),
+    )
+    connection.execute(
+        text(
+            "INSERT INTO batches (reference, sku, _purchased_quantity)"
+            f" {numbers} SELECT '{prefix}-batch-' || n, '{prefix}-sku-' || n,"
+            f" {lines} FROM numbers"
+        ),
+        dict(count=skus),
+    )
+    connection.execute(
+        text(
+            f"INSERT INTO order_lines (orderid, sku, qty) {numbers}"
+            f" SELECT '{prefix}-order-' || n, '{prefix}-sku-' || (n % :skus + 1), 1"
+            " FROM numbers"
+        ),
+        dict(count=lines, skus=skus),
+    )
+    # every line goes to its SKU's one batch
+    connection.execute(
+        text(
+            "INSERT INTO allocations (orderline_id, batch_id)"
+            " SELECT ol.id, b.id FROM order_lines AS ol"
+            " JOIN batches AS b ON b.sku = ol.sku"
+            " WHERE ol.orderid LIKE :orders"
+        ),
+        dict(orders=f"{prefix}-order-%"),
+    )
+
+
+def delete_seeded(connection, prefix: str) -> None:
+    connection.execute(
+        text(
+            "DELETE FROM allocations WHERE batch_id IN"
+            " (SELECT id FROM batches WHERE reference LIKE :batches)"
+        ),
+        dict(batches=f"{prefix}-batch-%"),
+    )
+    for table, column, kind in [
+        ("order_lines", "orderid", "order"),
+        ("batches", "reference", "batch"),
+        ("products", "sku", "sku"),
+    ]:
+        connection.execute(
+            text(f"DELETE FROM {table} WHERE {column} LIKE :pattern"),
+            dict(pattern=f"{prefix}-{kind}-%"),
+        )
+
+
+def repository_statements(engine, session_factory, prefix: str, skus: int) -> dict:
+    """The SQL each repository call sends, with its parameters, by call."""
+    sku, batchref = f"{prefix}-sku-{skus // 2}", f"{prefix}-batch-{skus // 2}"
+    orderid = f"{prefix}-order-{skus // 2 - 1}"
+    calls = {
+        "get by sku": lambda s: repository.SqlAlchemyProductRepository(s).get(sku),
+        "get by batchref": lambda s: repository.SqlAlchemyProductRepository(
+            s
+        ).get_by_batchref(batchref),
+        "find containing line": lambda s: repository.SQLAlchemyRepository(
+            s
+        ).find_containing_line(OrderLine(orderid, sku, 1)),
+        "deallocate": lambda s: deallocate(s, sku, orderid),
+    }
+    statements = {}
+    for name, call in calls.items():
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            captured.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", capture)
+        session = session_factory()
+        try:
+            call(session)
+        finally:
+            session.rollback()
+            session.close()
+            event.remove(engine, "before_cursor_execute", capture)
+        statements[name] = captured
+    return statements
+
+
+def deallocate(session, sku, orderid) -> None:
+    product = repository.SqlAlchemyProductRepository(session).get(sku)
+    line = next(
+        line
+        for batch in product.batches
+        for line in batch._allocations
+        if line.orderid == orderid
+    )
+    product.deallocate(line)
+    session.flush()
+
+
+def full_scans(connection, statement, parameters) -> list[str]:
+    dialect = connection.dialect.name
+    plan = connection.exec_driver_sql(f"{EXPLAIN[dialect]} {statement}", parameters)
+    # Postgres returns one line of text per row, SQLite the detail in the last column
+    lines = [row[-1] for row in plan]
+    return [line for line in lines if FULL_SCAN[dialect].search(line.strip())]
+
+
+def time_statement(connection, statement, parameters, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        connection.exec_driver_sql(statement, parameters).fetchall()
+    return (time.perf_counter() - started) / repeat
+
+
+def time_calls(engine, statements: dict, repeat: int) -> dict:
+    timings = {}
+    with engine.connect() as connection:
+        for name, captured in statements.items():
+            timings[name] = sum(
+                time_statement(connection, statement, parameters, repeat)
+                for statement, parameters in captured
+                if statement.lstrip().upper().startswith("SELECT")
+            )
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--skus", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--keep", action="store_true")
+    args = parser.parse_args()
+
+    engine = config.get_engine()
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = config.get_session_factory()
+    prefix = f"idx-{uuid.uuid4().hex[:6]}"
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        seed(connection, prefix, args.skus, args.lines)
+        if connection.dialect.name == "postgresql":
+            connection.execute(text(f"ANALYZE {', '.join(TABLES)}"))
+        else:
+            connection.execute(text("ANALYZE"))
+    print(f"seeded {args.lines} lines in {time.perf_counter() - started:.1f}s")
+
+    try:
+        statements = repository_statements(engine, session_factory, prefix, args.skus)
+        failures = []
+        with engine.connect() as connection:
+            for name, captured in statements.items():
+                for statement, parameters in captured:
+                    for line in full_scans(connection, statement, parameters):
+                        failures.append(f"{name}: {line.strip()}\n  {statement}")
+        timings = time_calls(engine, statements, args.repeat)
+
+        unindexed = {}
+        if args.compare:
+            indexes = [
+                index
+                for table in (orm.batches, orm.order_lines, orm.allocations)
+                for index in table.indexes
+            ]
+            for index in indexes:
+                index.drop(engine)
+            try:
+                unindexed = time_calls(engine, statements, max(args.repeat // 10, 1))
+            finally:
+                for index in indexes:
+                    index.create(engine)
+
+        print(f"{'call':>22} {'indexed':>12} {'unindexed':>12}")
+        for name, indexed in timings.items():
+            without = f"{unindexed[name] * 1e3:>9.2f} ms" if name in unindexed else ""
+            print(f"{name:>22} {indexed * 1e3:>9.2f} ms {without:>12}")
+        assert not failures, "full table scans:\n" + "\n".join(failures)
+    finally:
+        if not args.keep:
+            with engine.begin() as connection:
+                delete_seeded(connection, prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Bulk ingestion rate: writes a CSV of ``--rows`` batches (1M by default) and
+loads it the way ``python -m cosmicpython.endpoints.ingest`` does, reporting
+rows per second. ``--single`` rows are also loaded one BatchCreated at a time,
+the way /add_batch does, for comparison. ``--memory`` shows the load's memory
+stays flat however big the file.
+
+Uses the shared engine from ``config`` (the docker-compose Postgres, where the
+batches go in with COPY, or whatever DB_URI points at). The loaded rows are
+deleted afterwards unless ``--keep``. Run with ``python -m benchmarks.bench_ingest``.
+"""
+
+import argparse
+import csv
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from sqlalchemy import text
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer import ingest
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def write_shipment(file, prefix: str, rows: int, skus: int) -> None:
+    writer = csv.writer(file)
+    writer.writerow(["ref", "sku", "qty", "eta"])
+    for n in range(rows):
+        eta = f"2030-01-{n % 28 + 1:02d}" if n % 3 else ""
+        writer.writerow([f"{prefix}-batch-{n}", f"{prefix}-sku-{n % skus}", 100, eta])
+
+
+def delete_loaded(prefix: str) -> None:
+    with config.get_engine().begin() as connection:
+        connection.execute(
+            text("DELETE FROM batches WHERE reference LIKE :pattern"),
+            dict(pattern=f"{prefix}-%"),
+        )
+        connection.execute(
+            text("DELETE FROM products WHERE sku LIKE :pattern"),
+            dict(pattern=f"{prefix}-%"),
+        )
+
+
+def one_at_a_time(prefix: str, rows: int, skus: int) -> float:
+    bus = MessageBus()
+    started = time.perf_counter()
+    for n in range(rows):
+        bus.handle(
+            events.BatchCreated(
+                f"{prefix}-single-{n}", f"{prefix}-sku-{n % skus}", 100
+            ),
+            SqlAlchemyUnitOfWork(),
+        )
+    return rows / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--skus", type=int, default=10_000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--single", type=int, default=1000)
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="report peak memory too (tracemalloc slows the load down a lot)",
+    )
+    args = parser.parse_args()
+
+    orm.metadata.create_all(config.get_engine())
+    orm.start_mappers()
+    prefix = f"ingest-{uuid.uuid4().hex[:6]}"
+
+    with tempfile.NamedTemporaryFile("w+", suffix=".csv", newline="") as file:
+        write_shipment(file, prefix, args.rows, args.skus)
+        file.seek(0)
+        if args.memory:
+            tracemalloc.start()
+        try:
+            report = ingest.ingest(
+                file,
+                MessageBus(),
+                SqlAlchemyUnitOfWork,
+                chunk_size=args.chunk_size,
+            )
+            print(
+                f"bulk: {report.rows} rows in {report.seconds:.1f}s,"
+                f" {report.rows_per_second:,.0f} rows/s"
+            )
+            if args.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f"peak traced memory {peak / 2**20:.1f} MiB")
+            if args.single:
+                rate = one_at_a_time(prefix, args.single, args.skus)
+                print(f"one at a time: {rate:,.0f} rows/s")
+        finally:
+            if not args.keep:
+                delete_loaded(prefix)
+
+
+if __name__ == "__main__":
+    main()
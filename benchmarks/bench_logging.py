@@ -0,0 +1,98 @@
+"""
+What logging adds to a request: allocating one line through the message bus,
+on a product already holding ``--lines`` allocations, with the service layer's
+structured logging at different levels and sample rates.
+
+For comparison, "eager" adds what the handlers used to do on every request:
+``pprint.pformat`` of the aggregate plus an f-string, formatted whether or not
+the record was emitted. Emitted records are formatted into a handler that
+throws the text away, so only the logging itself is timed. Runs against the
+in-memory FakeUnitOfWork. Run with ``python -m benchmarks.bench_logging``.
+"""
+
+import argparse
+import logging
+import pprint
+import time
+
+from cosmicpython import logs
+from cosmicpython.domain import events
+from cosmicpython.domain.models import Batch, OrderLine, Product
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+SKU = "LOGGED-LAMP"
+
+
+class DiscardingHandler(logging.Handler):
+    def emit(self, record):
+        self.format(record)
+
+
+def make_uow(lines: int, requests: int) -> FakeUnitOfWork:
+    product = Product(SKU, batches=[])
+    product.add_batch(Batch("stock", SKU, qty=lines + requests, eta=None))
+    for n in range(lines):
+        product.allocate(OrderLine(f"existing-{n}", SKU, 1))
+    uow = FakeUnitOfWork()
+    uow.products.add(product)
+    return uow
+
+
+def eager_log(uow: FakeUnitOfWork, event: events.AllocationRequired) -> None:
+    # what add_batch and deallocate logged before
+    product = uow.products.get(SKU)
+    logging.info(
+        "Deallocate structure:\n%s",
+        pprint.pformat([b._allocations for b in product.batches]),
+    )
+    logging.info(f"Line provided: {event.orderid}")
+
+
+def run(lines: int, requests: int, eager: bool) -> float:
+    uow = make_uow(lines, requests)
+    bus = MessageBus()
+    started = time.perf_counter()
+    for n in range(requests):
+        event = events.AllocationRequired(f"order-{n}", SKU, 1)
+        if eager:
+            eager_log(uow, event)
+        bus.handle(event, uow)
+    return (time.perf_counter() - started) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    root.addHandler(DiscardingHandler())
+    # (label, level, sample rate, eager)
+    cases = [
+        ("eager, WARNING", logging.WARNING, 1.0, True),
+        ("eager, INFO", logging.INFO, 1.0, True),
+        ("structured, WARNING", logging.WARNING, 1.0, False),
+        ("structured, INFO", logging.INFO, 1.0, False),
+        ("structured, DEBUG 1%", logging.DEBUG, 0.01, False),
+        ("structured, DEBUG", logging.DEBUG, 1.0, False),
+    ]
+    baseline = None
+    print(f"{'case':>22} {'per request':>12} {'overhead':>10}")
+    for label, level, sample_rate, eager in cases:
+        root.setLevel(level)
+        logs.configure(logging.getLevelName(level), sample_rate)
+        per_request = run(args.lines, args.requests, eager)
+        if baseline is None:
+            # nothing emitted and nothing formatted lazily: the floor
+            root.setLevel(logging.CRITICAL)
+            baseline = run(args.lines, args.requests, eager=False)
+        print(
+            f"{label:>22} {per_request * 1e6:>9.1f} us"
+            f" {(per_request - baseline) * 1e6:>7.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Memory held by a Product with ``--lines`` allocated lines (1M by default),
+measured with tracemalloc.
+
+- events: a run of AllocationRequired as the bus holds it, slotted against the
+  same dataclass with a per-instance __dict__;
+- loaded: the aggregate as loaded through SqlAlchemyProductRepository, whose
+  SKUs are interned (one string object, however many lines);
+- snapshot: the same aggregate as the product cache keeps it (beyond the
+  strings it shares with the loaded lines).
+
+Mapped classes such as OrderLine can't be slotted (the ORM keeps their values
+in __dict__), so the loaded aggregate is dominated by per-instance ORM state;
+the snapshot is the compact form. Seeds one product through the shared engine
+from ``config`` (the docker-compose Postgres, or whatever DB_URI points at) and
+deletes it afterwards unless ``--keep``.
+Run with ``python -m benchmarks.bench_memory``.
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+import uuid
+from dataclasses import dataclass
+
+from benchmarks.bench_indexes import delete_seeded, seed
+from cosmicpython import config
+from cosmicpython.adapters import orm, repository
+from cosmicpython.adapters.cache import snapshot
+from cosmicpython.domain import events
+
+
+@dataclass
+class UnslottedAllocationRequired:
+    orderid: str
+    sku: str
+    qty: int
+
+
+def measure(build):
+    """What ``build()`` returns, and the bytes still allocated for it."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    seconds = time.perf_counter() - started
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, seconds
+
+
+def report(label: str, size: int, lines: int, seconds: float) -> None:
+    print(
+        f"{label:>26} {size / 2**20:>9.1f} MiB {size / lines:>8.0f} B/line"
+        f" {seconds:>7.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--keep", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'':>26} {'retained':>13} {'per line':>10} {'time':>8}")
+    for label, cls in [
+        ("events (slots)", events.AllocationRequired),
+        ("events (__dict__)", UnslottedAllocationRequired),
+    ]:
+        run, size, seconds = measure(
+            lambda: [cls(f"order-{n}", "MEMORY-SKU", 1) for n in range(args.lines)]
+        )
+        report(label, size, args.lines, seconds)
+        del run
+
+    engine = config.get_engine()
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = config.get_session_factory()
+    prefix = f"mem-{uuid.uuid4().hex[:6]}"
+    with engine.begin() as connection:
+        seed(connection, prefix, 1, args.lines)
+
+    try:
+        session = session_factory()
+        products = repository.SqlAlchemyProductRepository(session)
+        product, size, seconds = measure(lambda: products.get(f"{prefix}-sku-1"))
+        report("loaded", size, args.lines, seconds)
+        lines = [line for batch in product.batches for line in batch._allocations]
+        skus = len({id(line.sku) for line in lines})
+        print(f"{len(lines)} lines loaded, sharing {skus} sku string(s)")
+
+        cached, size, seconds = measure(lambda: snapshot(product))
+        report("snapshot", size, args.lines, seconds)
+        session.close()
+    finally:
+        if not args.keep:
+            with engine.begin() as connection:
+                delete_seeded(connection, prefix)
+
+
+if __name__ == "__main__":
+    main()
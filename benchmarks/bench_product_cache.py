@@ -0,0 +1,86 @@
+"""
+Reading a hot Product through the unit of work, with and without the product
+cache, as its number of allocated lines grows.
+
+Without the cache every ``get`` loads the batches and their allocations; with it
+a hit costs the ``products.version`` check and rebuilding the aggregate from the
+snapshot. The rebuild still creates every batch and line, so for big aggregates
+on a local database it costs about what the load does; the saving is the two
+round trips and the rows not sent. Uses the shared engine from ``config`` (the
+docker-compose Postgres, or whatever DB_URI points at).
+Run with ``python -m benchmarks.bench_product_cache``.
+"""
+
+import argparse
+import time
+import uuid
+
+from sqlalchemy import event
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.adapters.cache import ProductCache
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def make_product(lines: int, session_factory) -> str:
+    sku = f"cached-{uuid.uuid4().hex[:8]}"
+    uow = SqlAlchemyUnitOfWork(session_factory, ProductCache())
+    MessageBus().handle(events.BatchCreated(f"{sku}-batch", sku, lines, None), uow)
+    MessageBus().handle(
+        events.AllocationsRequired(
+            [events.AllocationRequired(f"o{n}", sku, 1) for n in range(lines)]
+        ),
+        uow,
+    )
+    return sku
+
+
+def time_reads(sku, reads: int, session_factory, cache) -> tuple[float, float]:
+    uow = SqlAlchemyUnitOfWork(session_factory, cache)
+    statements = []
+
+    def count(*_):
+        statements.append(None)
+
+    engine = config.get_engine()
+    event.listen(engine, "before_cursor_execute", count)
+    started = time.perf_counter()
+    for _ in range(reads):
+        with uow:
+            uow.products.get(sku)
+            uow.commit()
+    elapsed = time.perf_counter() - started
+    event.remove(engine, "before_cursor_execute", count)
+    return elapsed / reads, len(statements) / reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1_000])
+    args = parser.parse_args()
+
+    orm.metadata.create_all(config.get_engine())
+    orm.start_mappers()
+    session_factory = config.get_session_factory()
+
+    print(f"{'lines':>8} {'uncached':>22} {'cached':>22}")
+    for size in args.sizes:
+        sku = make_product(size, session_factory)
+        uncached, uncached_queries = time_reads(
+            sku, args.reads, session_factory, None
+        )
+        cache = ProductCache()
+        cached, cached_queries = time_reads(sku, args.reads, session_factory, cache)
+        print(
+            f"{size:>8} {uncached * 1e6:>10.1f} us {uncached_queries:>4.1f} q"
+            f" {cached * 1e6:>10.1f} us {cached_queries:>4.1f} q"
+        )
+        assert cache.metrics["hits"] >= args.reads - 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Emptying a batch that holds N lines, with the bus reallocating the evicted lines
+in one batched load-allocate-commit pass versus one unit of work per line.
+
+Uses the shared engine from ``config`` (the docker-compose Postgres, or whatever
+DB_URI points at). Run with ``python -m benchmarks.bench_reallocation``.
+"""
+
+import argparse
+import time
+import uuid
+from datetime import date
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+class OneAtATimeMessageBus(MessageBus):
+    BATCH_HANDLERS = {
+        event_type: batch_handlers
+        for event_type, batch_handlers in MessageBus.BATCH_HANDLERS.items()
+        if event_type not in MessageBus.HANDLERS
+    }
+
+
+def time_shrink(bus: MessageBus, lines: int, session_factory) -> float:
+    sku = f"shrink-{uuid.uuid4().hex[:8]}"
+    setup = MessageBus()
+    for ref, eta in ((f"{sku}-now", None), (f"{sku}-later", date(2099, 1, 1))):
+        setup.handle(
+            events.BatchCreated(ref, sku, lines, eta),
+            SqlAlchemyUnitOfWork(session_factory),
+        )
+    setup.handle(
+        events.AllocationsRequired(
+            [events.AllocationRequired(f"{sku}-{n}", sku, 1) for n in range(lines)]
+        ),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+
+    started = time.perf_counter()
+    results = bus.handle(
+        events.BatchQuantityChanged(f"{sku}-now", 0),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+    elapsed = time.perf_counter() - started
+    assert results[1:] == [f"{sku}-later"] * lines
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, nargs="+", default=[500, 1_000, 10_000])
+    parser.add_argument(
+        "--single-up-to",
+        type=int,
+        default=1_000,
+        help="largest N to also time one unit of work per line for; each of those"
+        " reloads the whole product, so it grows quadratically",
+    )
+    args = parser.parse_args()
+
+    session_factory = config.init_db()
+    orm.metadata.create_all(config.get_engine())
+
+    print(f"{'lines':>7} {'one at a time':>14} {'batched':>10} {'speedup':>8}")
+    for lines in args.lines:
+        batched = time_shrink(MessageBus(), lines, session_factory)
+        if lines > args.single_up_to:
+            print(f"{lines:>7} {'-':>14} {batched:>9.2f}s {'-':>8}")
+            continue
+        single = time_shrink(OneAtATimeMessageBus(), lines, session_factory)
+        print(
+            f"{lines:>7} {single:>13.2f}s {batched:>9.2f}s {single / batched:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Allocation throughput of the sharded worker pool: ``--lines`` allocations of
+one unit, spread over ``--skus`` products, through 1 to N worker processes.
+
+With ``--route sku`` (the default) each SKU belongs to one worker, which keeps
+its products cached and never conflicts with the others. ``--route any`` deals
+the lines out round robin instead, so every worker allocates every SKU: the
+same number of processes, but contending the way API workers do. Demand
+exceeds stock on purpose; every run checks no batch was over-allocated.
+
+Uses the shared engine from ``config`` (the docker-compose Postgres, or
+whatever DB_URI points at; the workers read the same variables). Run with
+``python -m benchmarks.bench_shards``.
+"""
+
+import argparse
+import itertools
+import time
+import uuid
+
+from sqlalchemy import text
+
+from cosmicpython import config
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.shards import ShardedAllocator, shard_for
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+from .bench_contention import allocated_quantity
+
+
+def round_robin():
+    dealt = itertools.count()
+    return lambda sku, shards: next(dealt) % shards
+
+
+def run(shards: int, route: str, lines: int, skus: int, batch_size: int) -> float:
+    prefix = f"shards-{uuid.uuid4().hex[:6]}"
+    names = [f"{prefix}-{n}" for n in range(skus)]
+    capacity = lines // skus * 3 // 4
+    bus = MessageBus()
+    for sku in names:
+        bus.handle(
+            events.BatchCreated(f"{sku}-batch", sku, capacity, None),
+            SqlAlchemyUnitOfWork(),
+        )
+
+    with ShardedAllocator(
+        shards,
+        batch_size=batch_size,
+        route=shard_for if route == "sku" else round_robin(),
+    ) as allocator:
+        # let every worker start up before timing
+        for sku in names:
+            allocator.allocate(f"{sku}-warmup", sku, 1).result()
+        started = time.perf_counter()
+        futures = [
+            allocator.allocate(f"{prefix}-o{n}", names[n % skus], 1)
+            for n in range(lines)
+        ]
+        for future in futures:
+            future.result()
+        seconds = time.perf_counter() - started
+
+    session_factory = config.get_session_factory()
+    for sku in names:
+        purchased, allocated = allocated_quantity(session_factory, sku)
+        assert allocated == purchased, (sku, purchased, allocated)
+    delete_seeded(prefix)
+    return lines / seconds
+
+
+def delete_seeded(prefix: str) -> None:
+    with config.get_engine().begin() as connection:
+        for statement in (
+            "DELETE FROM allocations WHERE batch_id IN"
+            " (SELECT id FROM batches WHERE sku LIKE :p)",
+            "DELETE FROM order_lines WHERE sku LIKE :p",
+            "DELETE FROM batches WHERE sku LIKE :p",
+            "DELETE FROM products WHERE sku LIKE :p",
+            "DELETE FROM allocations_view WHERE sku LIKE :p",
+        ):
+            connection.execute(text(statement), {"p": f"{prefix}-%"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--route", choices=["sku", "any"], nargs="+", default=["sku", "any"]
+    )
+    parser.add_argument("--lines", type=int, default=4_000)
+    parser.add_argument("--skus", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    orm.metadata.create_all(config.get_engine())
+    orm.start_mappers()
+
+    print(f"{'shards':>6} {'route':>5} {'lines/s':>10}")
+    for route in args.route:
+        for shards in args.shards:
+            rate = run(shards, route, args.lines, args.skus, args.batch_size)
+            print(f"{shards:>6} {route:>5} {rate:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import abc
+import csv
+import io
+from typing import List
+
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events, models
+
+BATCH_COLUMNS = ["reference", "sku", "_purchased_quantity", "eta"]
+COPY_BATCHES = (
+    f"COPY batches ({', '.join(BATCH_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+)
+# INSERT .. ON CONFLICT, for upserting products
+UPSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+existing_references = select(orm.batches.c.reference).where(
+    orm.batches.c.reference.in_(bindparam("references", expanding=True))
+)
+
+
+class DuplicateBatches(Exception):
+    def __init__(self, references) -> None:
+        super().__init__(f"Batches already exist: {', '.join(sorted(references))}")
+        self.references = references
+
+
+def check_unique(batches: List[events.BatchCreated]) -> List[str]:
+    references = [batch.ref for batch in batches]
+    seen, repeated = set(), set()
+    for reference in references:
+        (repeated if reference in seen else seen).add(reference)
+    if repeated:
+        raise DuplicateBatches(repeated)
+    return references
+
+
+def upsert_products(dialect: str):
+    """
+    Creates the products the batches are for (at version 1, as if each had been
+    given a batch by Product.add_batch), and bumps the version of those that
+    already exist: new batches change the aggregate, so a transaction that
+    loaded it before (or a cached snapshot) must not win.
+    """
+    # executed with many rows rather than given them as VALUES, so it compiles once
+    return (
+        UPSERTS[dialect](orm.products)
+        .values(sku=bindparam("sku"), version=1)
+        .on_conflict_do_update(
+            index_elements=[orm.products.c.sku],
+            set_={"version": orm.products.c.version + 1},
+        )
+    )
+
+
+def product_rows(batches: List[events.BatchCreated]) -> List[dict]:
+    # each product once: Postgres won't update a row twice in one statement
+    return [dict(sku=sku) for sku in dict.fromkeys(batch.sku for batch in batches)]
+
+
+def batch_rows(batches: List[events.BatchCreated]) -> List[dict]:
+    return [
+        dict(reference=b.ref, sku=b.sku, _purchased_quantity=b.qty, eta=b.eta)
+        for b in batches
+    ]
+
+
+def copy_buffer(batches: List[events.BatchCreated]) -> io.StringIO:
+    # COPY's csv format reads an unquoted empty field as NULL
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for b in batches:
+        writer.writerow((b.ref, b.sku, b.qty, b.eta.isoformat() if b.eta else ""))
+    buffer.seek(0)
+    return buffer
+
+
+class AbstractBatchLoader(abc.ABC):
+    """
+    Writes many new batches at once without loading their products, for bulk
+    ingestion. Raises DuplicateBatches, before writing anything, if any of the
+    references already exist or repeat.
+    """
+
+    @abc.abstractmethod
+    def load(self, batches: List[events.BatchCreated]) -> None: ...
+
+
+class SqlAlchemyBatchLoader(AbstractBatchLoader):
+    """On Postgres with psycopg2 the batches go in with COPY, elsewhere executemany."""
+
+    def __init__(self, session) -> None:
+        self._session = session
+
+    def load(self, batches):
+        if not batches:
+            return
+        references = check_unique(batches)
+        existing = self._session.scalars(
+            existing_references, dict(references=references)
+        ).all()
+        if existing:
+            raise DuplicateBatches(existing)
+        connection = self._session.connection()
+        self._session.execute(
+            upsert_products(connection.dialect.name), product_rows(batches)
+        )
+        if connection.dialect.driver == "psycopg2":
+            cursor = connection.connection.cursor()
+            try:
+                cursor.copy_expert(COPY_BATCHES, copy_buffer(batches))
+            finally:
+                cursor.close()
+        else:
+            self._session.execute(insert(orm.batches), batch_rows(batches))
+
+
+class FakeBatchLoader(AbstractBatchLoader):
+    def __init__(self, products) -> None:
+        self._products = products
+
+    def load(self, batches):
+        references = check_unique(batches)
+        existing = [r for r in references if self._products.get_by_batchref(r)]
+        if existing:
+            raise DuplicateBatches(existing)
+        for b in batches:
+            product = self._products.get(b.sku)
+            if product is None:
+                product = models.Product(b.sku, batches=[])
+                self._products.add(product)
+            product.add_batch(models.Batch(b.ref, b.sku, b.qty, b.eta))
+
+
+class AsyncSqlAlchemyBatchLoader:
+    """SqlAlchemyBatchLoader on an AsyncSession; COPY goes through asyncpg."""
+
+    def __init__(self, session) -> None:
+        self._session = session
+
+    async def load(self, batches):
+        if not batches:
+            return
+        references = check_unique(batches)
+        existing = (
+            await self._session.scalars(
+                existing_references, dict(references=references)
+            )
+        ).all()
+        if existing:
+            raise DuplicateBatches(existing)
+        connection = await self._session.connection()
+        await self._session.execute(
+            upsert_products(connection.dialect.name), product_rows(batches)
+        )
+        if connection.dialect.driver == "asyncpg":
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                "batches",
+                records=[(b.ref, b.sku, b.qty, b.eta) for b in batches],
+                columns=BATCH_COLUMNS,
+            )
+        else:
+            await self._session.execute(insert(orm.batches), batch_rows(batches))
+
+
+class FakeAsyncBatchLoader:
+    def __init__(self, products) -> None:
+        self._loader = FakeBatchLoader(products)
+
+    async def load(self, batches):
+        self._loader.load(batches)
@@ -0,0 +1,225 @@
+"""
+An external message broker, for events to and from other systems: streams of
+messages read through consumer groups, so several workers share a stream and a
+message is only gone once a worker acknowledges it.
+
+RedisBroker uses Redis streams (XADD, XREADGROUP, XACK) and needs the optional
+``redis`` package; FakeBroker keeps the streams in process, for tests and
+benchmarks.
+"""
+
+import abc
+import dataclasses
+import itertools
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Type
+
+from cosmicpython.domain import events
+
+# other systems send us commands on INBOUND; we publish to OUTBOUND
+INBOUND = "cosmicpython:inbound"
+OUTBOUND: Dict[Type[events.Event], str] = {
+    events.Allocated: "cosmicpython:allocated",
+    events.OutOfStock: "cosmicpython:out_of_stock",
+}
+# what may arrive on INBOUND, by message type
+INBOUND_EVENTS: Dict[str, Type[events.Event]] = {
+    "AllocationRequired": events.AllocationRequired,
+    "BatchQuantityChanged": events.BatchQuantityChanged,
+}
+
+
+class UnknownMessage(Exception):
+    def __init__(self, fields: dict) -> None:
+        super().__init__(f"Not an event we handle: {fields!r}")
+
+
+@dataclass(frozen=True)
+class BrokerMessage:
+    stream: str
+    id: str
+    fields: Dict[str, str]
+
+
+def encode(event: events.Event, idempotency_key: Optional[str] = None) -> dict:
+    fields = {
+        "type": type(event).__name__,
+        "payload": json.dumps(dataclasses.asdict(event)),
+    }
+    if idempotency_key is not None:
+        fields["idempotency_key"] = idempotency_key
+    return fields
+
+
+def decode(fields: dict, known=INBOUND_EVENTS) -> events.Event:
+    try:
+        return known[fields["type"]](**json.loads(fields["payload"]))
+    except (KeyError, TypeError, ValueError):
+        raise UnknownMessage(fields) from None
+
+
+class AbstractBroker(abc.ABC):
+    @abc.abstractmethod
+    def publish(self, stream: str, messages: List[dict]) -> List[str]:
+        """Appends ``messages`` (flat str dicts) to ``stream``; returns their ids."""
+
+    @abc.abstractmethod
+    def create_group(self, stream: str, group: str) -> None:
+        """A consumer group reading ``stream`` from its start; fine if it exists."""
+
+    @abc.abstractmethod
+    def read(
+        self,
+        group: str,
+        consumer: str,
+        streams: Sequence[str],
+        count: int,
+        block_ms: Optional[int] = None,
+        pending: bool = False,
+    ) -> List[BrokerMessage]:
+        """
+        Up to ``count`` messages no one in ``group`` has read yet, waiting up to
+        ``block_ms`` for some. With ``pending``, instead those this consumer read
+        before and never acknowledged, such as after a crash.
+        """
+
+    @abc.abstractmethod
+    def ack(self, stream: str, group: str, ids: List[str]) -> int: ...
+
+    def publish_events(
+        self, events_: Iterable[events.Event], idempotency_key: Optional[str] = None
+    ) -> None:
+        """Each event to its OUTBOUND stream, a call per stream."""
+        by_stream: Dict[str, List[dict]] = {}
+        for event in events_:
+            by_stream.setdefault(OUTBOUND[type(event)], []).append(
+                encode(event, idempotency_key)
+            )
+        for stream, messages in by_stream.items():
+            self.publish(stream, messages)
+
+
+class RedisBroker(AbstractBroker):
+    """
+    ``client`` is a ``redis.Redis`` made with ``decode_responses=True``. Streams
+    are trimmed to about ``maxlen`` messages.
+    """
+
+    def __init__(self, client, maxlen: Optional[int] = 1_000_000) -> None:
+        self._client = client
+        self.maxlen = maxlen
+
+    def publish(self, stream, messages):
+        pipeline = self._client.pipeline(transaction=False)
+        for fields in messages:
+            pipeline.xadd(stream, fields, maxlen=self.maxlen, approximate=True)
+        return pipeline.execute()
+
+    def create_group(self, stream, group):
+        from redis.exceptions import ResponseError
+
+        try:
+            self._client.xgroup_create(stream, group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, group, consumer, streams, count, block_ms=None, pending=False):
+        start = "0" if pending else ">"
+        replies = self._client.xreadgroup(
+            group,
+            consumer,
+            {stream: start for stream in streams},
+            count=count,
+            block=None if pending else block_ms,
+        )
+        return [
+            BrokerMessage(stream, id, fields)
+            for stream, entries in replies or []
+            for id, fields in entries
+            # a pending message trimmed from the stream comes back without fields
+            if fields
+        ]
+
+    def ack(self, stream, group, ids):
+        return self._client.xack(stream, group, *ids) if ids else 0
+
+
+@dataclass
+class _Group:
+    position: int = 0  # index of the next message to deliver
+    # id: consumer, for messages read but not acknowledged
+    pending: Dict[str, str] = field(default_factory=dict)
+
+
+class FakeBroker(AbstractBroker):
+    """Streams and consumer groups in memory; safe to share between threads."""
+
+    def __init__(self) -> None:
+        self.streams: Dict[str, List[BrokerMessage]] = {}
+        self._groups: Dict[tuple, _Group] = {}
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+
+    def publish(self, stream, messages):
+        with self._changed:
+            added = [
+                BrokerMessage(stream, f"{next(self._ids)}-0", dict(fields))
+                for fields in messages
+            ]
+            self.streams.setdefault(stream, []).extend(added)
+            self._changed.notify_all()
+        return [message.id for message in added]
+
+    def create_group(self, stream, group):
+        with self._changed:
+            self.streams.setdefault(stream, [])
+            self._groups.setdefault((stream, group), _Group())
+
+    def read(self, group, consumer, streams, count, block_ms=None, pending=False):
+        deadline = None if block_ms is None else time.monotonic() + block_ms / 1000
+        with self._changed:
+            while True:
+                if pending:
+                    return self._pending(group, consumer, streams, count)
+                messages = self._deliver(group, consumer, streams, count)
+                remaining = 0 if deadline is None else deadline - time.monotonic()
+                if messages or remaining <= 0:
+                    return messages
+                self._changed.wait(remaining)
+
+    def _deliver(self, group, consumer, streams, count):
+        messages = []
+        for stream in streams:
+            state = self._groups[(stream, group)]
+            new = self.streams[stream][state.position : state.position + count]
+            state.position += len(new)
+            state.pending.update((message.id, consumer) for message in new)
+            messages.extend(new)
+            count -= len(new)
+            if not count:
+                break
+        return messages
+
+    def _pending(self, group, consumer, streams, count):
+        messages = []
+        for stream in streams:
+            pending = self._groups[(stream, group)].pending
+            messages.extend(
+                message
+                for message in self.streams[stream]
+                if pending.get(message.id) == consumer
+            )
+        return messages[:count]
+
+    def ack(self, stream, group, ids):
+        with self._changed:
+            pending = self._groups[(stream, group)].pending
+            return sum(pending.pop(id, None) is not None for id in ids)
+
+    def pending_count(self, stream: str, group: str) -> int:
+        with self._changed:
+            return len(self._groups[(stream, group)].pending)
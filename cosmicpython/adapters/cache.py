@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional, Tuple
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import manager_of_class, set_committed_value
+
+from cosmicpython.domain.models import Batch, OrderLine, Product
+
+# (id, orderid, qty); a line's sku is always its batch's, see Batch.can_allocate
+LineRow = Tuple[int, str, int]
+# (id, reference, sku, purchased quantity, eta, allocated lines)
+BatchRow = Tuple[int, str, str, int, Optional[date], Tuple[LineRow, ...]]
+
+
+@dataclass(frozen=True)
+class ProductSnapshot:
+    """A committed Product aggregate as plain data, shareable between sessions."""
+
+    id: int
+    sku: str
+    version: int
+    batches: Tuple[BatchRow, ...]
+
+
+def snapshot(product: Product) -> Optional[ProductSnapshot]:
+    """
+    Copies a flushed product; None if part of its graph was never loaded (a
+    lazily loaded product), as the copy would then be incomplete.
+    """
+    if product.id is None or "batches" in inspect(product).unloaded:
+        return None
+    batches = []
+    for batch in product.batches:
+        if "_allocations" in inspect(batch).unloaded:
+            return None
+        lines = tuple(
+            (line.id, line.orderid, line.qty) for line in batch._allocations
+        )
+        batches.append(
+            (
+                batch.id,
+                batch.reference,
+                batch.sku,
+                batch._purchased_quantity,
+                batch.eta,
+                lines,
+            )
+        )
+    return ProductSnapshot(product.id, product.sku, product.version, tuple(batches))
+
+
+def loaded(cls, **columns):
+    # what the ORM does with a row: no __init__, no change events, and
+    # make_transient_to_detached later marks these values as committed
+    instance = manager_of_class(cls).new_instance()
+    instance.__dict__.update(columns)
+    return instance
+
+
+def rebuild(snapshot: ProductSnapshot) -> Product:
+    """
+    Recreates the aggregate as detached instances, as if just loaded by a query,
+    ready to ``session.add`` without touching the database.
+    """
+    product = loaded(
+        Product, id=snapshot.id, sku=snapshot.sku, version=snapshot.version
+    )
+    product.events = []
+    product._batch_index = None
+    instances = [product]
+    batches = []
+    for batch_id, reference, sku, qty, eta, lines in snapshot.batches:
+        batch = loaded(
+            Batch,
+            id=batch_id,
+            reference=reference,
+            sku=sku,
+            _purchased_quantity=qty,
+            eta=eta,
+        )
+        allocations = [
+            loaded(OrderLine, id=line_id, orderid=orderid, sku=sku, qty=line_qty)
+            for line_id, orderid, line_qty in lines
+        ]
+        # copied into the relationship's own set
+        set_committed_value(batch, "_allocations", allocations)
+        batch._allocated_quantity = sum(line[2] for line in lines)
+        batches.append(batch)
+        instances.append(batch)
+        instances.extend(allocations)
+    set_committed_value(product, "batches", batches)
+    for instance in instances:
+        make_transient_to_detached(instance)
+    return product
+
+
+class ProductCache:
+    """
+    Snapshots of recently committed Product aggregates, keyed by SKU: at most
+    ``max_size`` of them, least recently used dropped first, and none kept for
+    longer than ``ttl`` seconds (``None`` for no limit).
+
+    The cache only saves the graph load: a snapshot is used after checking its
+    version against ``products.version``, so a product changed elsewhere is
+    reloaded rather than served stale. Safe to share between threads.
+    """
+
+    def __init__(
+        self, max_size: int = 1024, ttl: Optional[float] = 60.0, clock=time.monotonic
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # type: OrderedDict[str, tuple]
+        self._lock = threading.Lock()
+        # hits, misses, stale, expired, evictions
+        self.metrics = Counter()  # type: Counter[str]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, sku: str) -> Optional[ProductSnapshot]:
+        with self._lock:
+            entry = self._entries.get(sku)
+            if entry is not None and self.ttl is not None:
+                if self._clock() - entry[0] > self.ttl:
+                    del self._entries[sku]
+                    self.metrics["expired"] += 1
+                    entry = None
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            self._entries.move_to_end(sku)
+            return entry[1]
+
+    def validate(self, snapshot: ProductSnapshot, version: Optional[int]) -> bool:
+        """Whether ``snapshot`` is still current; drops it if not."""
+        with self._lock:
+            if snapshot.version == version:
+                self.metrics["hits"] += 1
+                return True
+            self.metrics["stale"] += 1
+            entry = self._entries.get(snapshot.sku)
+            if entry is not None and entry[1] is snapshot:
+                del self._entries[snapshot.sku]
+            return False
+
+    def put(self, snapshot: ProductSnapshot) -> None:
+        with self._lock:
+            entry = self._entries.get(snapshot.sku)
+            # two commits racing to put: keep whichever is newer
+            if entry is not None and entry[1].version > snapshot.version:
+                return
+            self._entries[snapshot.sku] = (self._clock(), snapshot)
+            self._entries.move_to_end(snapshot.sku)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._entries.pop(sku, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,231 @@
+"""
+What allocation requests sent with an idempotency key got, so a client that
+retries one (after a timeout, say) gets the same batchref back rather than a
+second allocation.
+
+Records are written to ``allocation_requests`` in the same transaction as the
+allocation. IdempotencyCache keeps recently committed ones in process, in
+front of the table: as a record never changes once committed, a cached one
+needs no check against the database.
+"""
+
+import abc
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from cosmicpython.adapters import orm
+from cosmicpython.domain.models import OrderLine
+
+
+class IdempotencyKeyReused(Exception):
+    def __init__(self, key: str) -> None:
+        super().__init__(f"Idempotency key {key} was used for a different request")
+
+
+class IdempotencyKeyInFlight(Exception):
+    """
+    Another transaction wrote a record for the key after we looked for one.
+    Worth a retry, which finds and replays it.
+    """
+
+    def __init__(self, key: str) -> None:
+        super().__init__(f"Idempotency key {key} was recorded by another request")
+
+
+@dataclass(frozen=True, slots=True)
+class AllocationRecord:
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+    def matches(self, line: OrderLine) -> bool:
+        return line == OrderLine(self.orderid, self.sku, self.qty)
+
+
+class IdempotencyCache:
+    """
+    Up to ``max_size`` committed records by key, least recently used dropped
+    first. Safe to share between threads.
+    """
+
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # type: OrderedDict[str, AllocationRecord]
+        self._lock = threading.Lock()
+        # hits, misses, evictions
+        self.metrics = Counter()  # type: Counter[str]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[AllocationRecord]:
+        with self._lock:
+            record = self._entries.get(key)
+            if record is None:
+                self.metrics["misses"] += 1
+                return None
+            self.metrics["hits"] += 1
+            self._entries.move_to_end(key)
+            return record
+
+    def put(self, key: str, record: AllocationRecord) -> None:
+        with self._lock:
+            self._entries[key] = record
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+
+def to_row(key: str, record: AllocationRecord) -> dict:
+    return dict(
+        idempotency_key=key,
+        orderid=record.orderid,
+        sku=record.sku,
+        qty=record.qty,
+        batchref=record.batchref,
+    )
+
+
+def find(key: str):
+    table = orm.allocation_requests
+    return select(table.c.orderid, table.c.sku, table.c.qty, table.c.batchref).where(
+        table.c.idempotency_key == key
+    )
+
+
+class AbstractIdempotencyStore(abc.ABC):
+    """
+    ``get`` looks in ``cache`` before the table; records ``add``-ed go to the
+    cache once the unit of work calls ``committed``.
+    """
+
+    def __init__(self, cache: Optional[IdempotencyCache] = None):
+        self.cache = cache
+        self.added: List[Tuple[str, AllocationRecord]] = []
+
+    def get(self, key: str) -> Optional[AllocationRecord]:
+        record = self.cache.get(key) if self.cache is not None else None
+        if record is None:
+            record = self._get(key)
+            if record is not None and self.cache is not None:
+                self.cache.put(key, record)
+        return record
+
+    def add(self, key: str, record: AllocationRecord) -> None:
+        self._add(key, record)
+        self.added.append((key, record))
+
+    def committed(self) -> None:
+        if self.cache is not None:
+            for key, record in self.added:
+                self.cache.put(key, record)
+        self.added = []
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> Optional[AllocationRecord]: ...
+
+    @abc.abstractmethod
+    def _add(self, key: str, record: AllocationRecord) -> None: ...
+
+
+class SqlAlchemyIdempotencyStore(AbstractIdempotencyStore):
+    def __init__(self, session, cache: Optional[IdempotencyCache] = None) -> None:
+        super().__init__(cache)
+        self._session = session
+
+    def _get(self, key):
+        row = self._session.execute(find(key)).first()
+        return None if row is None else AllocationRecord(*row)
+
+    def _add(self, key, record):
+        # waits on the key of a transaction still in flight, then fails once it
+        # commits: the key is the table's only unique constraint
+        try:
+            self._session.execute(
+                insert(orm.allocation_requests), [to_row(key, record)]
+            )
+        except IntegrityError as e:
+            raise IdempotencyKeyInFlight(key) from e
+
+
+class FakeIdempotencyStore(AbstractIdempotencyStore):
+    def __init__(self) -> None:
+        super().__init__()
+        self._records: Dict[str, AllocationRecord] = {}
+
+    def _get(self, key):
+        return self._records.get(key)
+
+    def _add(self, key, record):
+        self._records[key] = record
+
+
+class AbstractAsyncIdempotencyStore(abc.ABC):
+    """AbstractIdempotencyStore with ``get`` and ``add`` awaited."""
+
+    def __init__(self, cache: Optional[IdempotencyCache] = None):
+        self.cache = cache
+        self.added: List[Tuple[str, AllocationRecord]] = []
+
+    async def get(self, key: str) -> Optional[AllocationRecord]:
+        record = self.cache.get(key) if self.cache is not None else None
+        if record is None:
+            record = await self._get(key)
+            if record is not None and self.cache is not None:
+                self.cache.put(key, record)
+        return record
+
+    async def add(self, key: str, record: AllocationRecord) -> None:
+        await self._add(key, record)
+        self.added.append((key, record))
+
+    def committed(self) -> None:
+        if self.cache is not None:
+            for key, record in self.added:
+                self.cache.put(key, record)
+        self.added = []
+
+    @abc.abstractmethod
+    async def _get(self, key: str) -> Optional[AllocationRecord]: ...
+
+    @abc.abstractmethod
+    async def _add(self, key: str, record: AllocationRecord) -> None: ...
+
+
+class AsyncSqlAlchemyIdempotencyStore(AbstractAsyncIdempotencyStore):
+    """SqlAlchemyIdempotencyStore on an AsyncSession."""
+
+    def __init__(self, session, cache: Optional[IdempotencyCache] = None) -> None:
+        super().__init__(cache)
+        self._session = session
+
+    async def _get(self, key):
+        row = (await self._session.execute(find(key))).first()
+        return None if row is None else AllocationRecord(*row)
+
+    async def _add(self, key, record):
+        try:
+            await self._session.execute(
+                insert(orm.allocation_requests), [to_row(key, record)]
+            )
+        except IntegrityError as e:
+            raise IdempotencyKeyInFlight(key) from e
+
+
+class FakeAsyncIdempotencyStore(AbstractAsyncIdempotencyStore):
+    def __init__(self) -> None:
+        super().__init__()
+        self._records: Dict[str, AllocationRecord] = {}
+
+    async def _get(self, key):
+        return self._records.get(key)
+
+    async def _add(self, key, record):
+        self._records[key] = record
@@ -0,0 +1,265 @@
+"""
+Request metrics: how long handlers, commits, repository loads and domain calls
+take, how many events of each type the bus handles, how many queries a request
+sends and why units of work roll back.
+
+PrometheusMetrics keeps them in process and renders them in the Prometheus text
+format for the API's ``/metrics``; NoopMetrics records nothing. Which one the
+app uses is ``config.get_metrics()``.
+"""
+
+import abc
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+NAMESPACE = "cosmicpython"
+
+# seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    "bus_events_total": ("counter", "Events handled by the message bus", None),
+    "bus_handler_seconds": (
+        "histogram",
+        "Time spent in a handler, retries included",
+        LATENCY_BUCKETS,
+    ),
+    "bus_handler_errors_total": ("counter", "Handlers that raised", None),
+    "bus_queries_per_request": (
+        "histogram",
+        "SQL statements sent while handling one message",
+        QUERY_BUCKETS,
+    ),
+    "uow_commit_seconds": ("histogram", "Unit of work commit time", LATENCY_BUCKETS),
+    "uow_rollbacks_total": (
+        "counter",
+        "Units of work rolled back by an exception, by its type",
+        None,
+    ),
+    "repository_get_seconds": (
+        "histogram",
+        "Time to load a Product aggregate",
+        LATENCY_BUCKETS,
+    ),
+    "domain_call_seconds": (
+        "histogram",
+        "Time spent in Product methods",
+        LATENCY_BUCKETS,
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+# (name, type, help, labels, value), as returned by a collector
+Sample = Tuple[str, str, str, dict, float]
+
+# the query count of the message being handled, see AbstractMetrics.count_queries
+_queries: ContextVar[Optional[List[int]]] = ContextVar("queries", default=None)
+
+
+def _count_query(*_) -> None:
+    queries = _queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+class AbstractMetrics(abc.ABC):
+    @abc.abstractmethod
+    def increment(self, name: str, value: float = 1, **labels) -> None: ...
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, **labels) -> None: ...
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextmanager
+    def count_queries(self):
+        """Observes the statements sent, by engines ``attach``ed, until exit."""
+        if _queries.get() is not None:
+            # nested: the outer message counts these
+            yield
+            return
+        queries = [0]
+        token = _queries.set(queries)
+        try:
+            yield
+        finally:
+            _queries.reset(token)
+            self.observe("bus_queries_per_request", queries[0])
+
+    def attach(self, engine) -> None:
+        event.listen(engine, "before_cursor_execute", _count_query)
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        """``collector`` is called on each render, for values kept elsewhere."""
+
+    def render(self) -> str:
+        return ""
+
+
+class NoopMetrics(AbstractMetrics):
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return nullcontext()
+
+    def count_queries(self):
+        return nullcontext()
+
+    def attach(self, engine):
+        pass
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = (f'{key}="{escape(str(value))}"' for key, value in sorted(labels.items()))
+    return "{" + ",".join(pairs) + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusMetrics(AbstractMetrics):
+    """Thread safe; only the names in ``METRICS`` can be recorded."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def _key(self, name: str, kind: str, labels: dict):
+        if METRICS.get(name, (None,))[0] != kind:
+            raise ValueError(f"Unknown {kind} {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, "counter", labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, "histogram", labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def value(self, name: str, **labels) -> float:
+        """A counter's value, or a histogram's count."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key].count
+            return self._counters.get(key, 0)
+
+    def render(self) -> str:
+        samples: Dict[str, List[str]] = {}
+        headers: Dict[str, Tuple[str, str]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                headers[name] = METRICS[name][:2]
+                samples.setdefault(name, []).append(
+                    f"{NAMESPACE}_{name}{format_labels(dict(labels))} {value}"
+                )
+            for (name, labels), histogram in self._histograms.items():
+                headers[name] = METRICS[name][:2]
+                samples.setdefault(name, []).extend(
+                    self._histogram_lines(name, dict(labels), histogram)
+                )
+        for collector in self._collectors:
+            for name, kind, help, labels, value in collector():
+                headers.setdefault(name, (kind, help))
+                samples.setdefault(name, []).append(
+                    f"{NAMESPACE}_{name}{format_labels(labels)} {format_value(value)}"
+                )
+        lines = []
+        for name, (kind, help) in headers.items():
+            lines.append(f"# HELP {NAMESPACE}_{name} {help}")
+            lines.append(f"# TYPE {NAMESPACE}_{name} {kind}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def _histogram_lines(self, name, labels, histogram) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            bucket = format_labels({**labels, "le": format_value(bound)})
+            lines.append(f"{NAMESPACE}_{name}_bucket{bucket} {cumulative}")
+        bucket = format_labels({**labels, "le": "+Inf"})
+        lines.append(f"{NAMESPACE}_{name}_bucket{bucket} {histogram.count}")
+        lines.append(f"{NAMESPACE}_{name}_sum{format_labels(labels)} {histogram.sum}")
+        lines.append(
+            f"{NAMESPACE}_{name}_count{format_labels(labels)} {histogram.count}"
+        )
+        return lines
+
+
+def labelled_samples(
+    name: str, kind: str, help: str, values, label: str
+) -> List[Sample]:
+    """One sample per item of a mapping, such as a component's metrics Counter."""
+    return [(name, kind, help, {label: key}, value) for key, value in values.items()]
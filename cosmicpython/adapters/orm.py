@@ -1,12 +1,28 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, String, Table, event
+import sys
+
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+    Text,
+    event,
+    func,
+)
 from sqlalchemy.orm import (
     clear_mappers,
+    joinedload,
     registry,
     relationship,
+    selectinload,
     sessionmaker,
     synonym,
 )
-from sqlalchemy.types import JSON
+from sqlalchemy.types import JSON, TypeDecorator
 
 from cosmicpython.domain import models
 
@@ -18,13 +34,29 @@ def create_mapping(model, table_definition, **kwargs):
     mapper_registry.map_imperatively(model, table_definition, **kwargs)
 
 
+class Sku(TypeDecorator):
+    """
+    A SKU column. Loaded values are interned, so a product's batches and lines
+    (and their cached snapshots) share one string rather than holding a copy
+    each; the driver makes a new one per row.
+    """
+
+    impl = String(255)
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return value if value is None else sys.intern(value)
+
+
 order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255)),
+    Column("sku", Sku),
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
+    # find_containing_line and deallocation look lines up by order
+    Index("ix_order_lines_orderid", "orderid"),
 )
 
 
@@ -33,16 +65,19 @@ batches = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("reference", String(255)),
-    Column("sku", String(255), ForeignKey("products.sku")),
+    Column("sku", Sku, ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batches_reference", "reference", unique=True),
+    # Product.batches joins on sku
+    Index("ix_batches_sku", "sku"),
 )
 
 products = Table(
     "products",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("sku", String(255), unique=True, index=True),
+    Column("sku", Sku, unique=True, index=True),
     Column("version", Integer, nullable=False, server_default="0"),
 )
 allocations = Table(
@@ -51,6 +86,61 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    # loading a batch's allocations goes by batch_id; removing one by both
+    Index("ix_allocations_batch_id", "batch_id"),
+    Index("ix_allocations_orderline_id", "orderline_id"),
+)
+
+# Read model kept up to date by the Allocated/Deallocated handlers, so queries
+# about an order never have to load Product aggregates.
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+    Index("ix_allocations_view_orderid", "orderid"),
+)
+
+# Events for the outside world, written in the same transaction as the change
+# that raised them and delivered afterwards by the outbox worker.
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("idempotency_key", String(36), nullable=False, unique=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    ),
+    Column("attempts", Integer, nullable=False, server_default="0"),
+    Column("last_error", Text, nullable=True),
+    Column("dispatched_at", DateTime(timezone=True), nullable=True),
+    Index("ix_outbox_pending", "dispatched_at", "id"),
+)
+
+# What each allocation request sent with an idempotency key got, written in the
+# same transaction as the allocation; a retry is answered from here.
+allocation_requests = Table(
+    "allocation_requests",
+    metadata,
+    Column("idempotency_key", String(255), primary_key=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    ),
 )
 
 
@@ -75,9 +165,53 @@ def start_mappers():
             # Relationship to all the batches that have this product's SKU
             "batches": relationship(models.Batch, backref="product"),
         },
+        # Product bumps its own version on every change; flushing checks the
+        # row still holds the version we loaded and raises StaleDataError if not.
+        version_id_col=products.c.version,
+        version_id_generator=False,
     )
 
 
+# How SqlAlchemyProductRepository loads a product's batches and their allocations.
+# "lazy" leaves the mapping's default: one query per batch for its allocations.
+LOADING_STRATEGIES = {
+    "lazy": None,
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+
+
+def product_loader_options(strategy: str) -> list:
+    try:
+        loader = LOADING_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(f"Unknown loading strategy {strategy!r}") from None
+    if loader is None:
+        return []
+    return [loader(models.Product.batches).options(loader(models.Batch._allocations))]
+
+
 @event.listens_for(models.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._batch_index = None
+
+
+@event.listens_for(models.Product, "expire")
+def receive_product_expire(product, _):
+    # batches may come back from the database with different quantities
+    if product is not None:
+        product._batch_index = None
+
+
+@event.listens_for(models.Batch, "load")
+def receive_batch_load(batch, _):
+    # _allocations may not be loaded yet; the running total is summed lazily
+    batch._allocated_quantity = None
+
+
+@event.listens_for(models.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    # the session may expire states whose objects were already garbage collected
+    if batch is not None and (attrs is None or "_allocations" in attrs):
+        batch._allocated_quantity = None
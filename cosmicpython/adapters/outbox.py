@@ -0,0 +1,97 @@
+import dataclasses
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Set, Type
+
+from sqlalchemy import select, update
+
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+
+# Events that leave the service (notifications, publishing to the broker and the
+# like). SqlAlchemy units of work write these to the outbox table in the same
+# commit as the aggregate change instead of handing them to the message bus; the
+# fakes still handle them inline. Their fields must be JSON serializable.
+OUTBOX_EVENTS: Dict[str, Type[events.Event]] = {
+    "OutOfStock": events.OutOfStock,
+    "Allocated": events.Allocated,
+}
+
+# Outbox events the service also handles itself (the read model): these are
+# written to the outbox and still handed to the message bus.
+ALSO_INTERNAL: Set[Type[events.Event]] = {events.Allocated}
+
+
+@dataclass
+class OutboxMessage:
+    id: int
+    idempotency_key: str
+    event: events.Event
+    attempts: int
+
+
+def is_external(event: events.Event) -> bool:
+    return OUTBOX_EVENTS.get(type(event).__name__) is type(event)
+
+
+def is_internal(event: events.Event) -> bool:
+    return not is_external(event) or type(event) in ALSO_INTERNAL
+
+
+def to_rows(external: Iterable[events.Event]) -> List[dict]:
+    return [
+        dict(
+            idempotency_key=str(uuid.uuid4()),
+            event_type=type(event).__name__,
+            payload=dataclasses.asdict(event),
+        )
+        for event in external
+    ]
+
+
+class SqlAlchemyOutbox:
+    """
+    Reads and acknowledges outbox rows for the dispatcher. ``pending`` locks the
+    rows it returns with SKIP LOCKED, so several workers can drain the same
+    table without delivering a message twice at once.
+    """
+
+    def __init__(self, session) -> None:
+        self._session = session
+
+    def pending(self, limit: int, max_attempts: int) -> List[OutboxMessage]:
+        rows = self._session.execute(
+            select(orm.outbox)
+            .where(
+                orm.outbox.c.dispatched_at.is_(None),
+                orm.outbox.c.attempts < max_attempts,
+            )
+            .order_by(orm.outbox.c.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        return [
+            OutboxMessage(
+                id=row.id,
+                idempotency_key=row.idempotency_key,
+                event=OUTBOX_EVENTS[row.event_type](**row.payload),
+                attempts=row.attempts,
+            )
+            for row in rows
+        ]
+
+    def mark_dispatched(self, ids: List[int]) -> None:
+        if ids:
+            self._session.execute(
+                update(orm.outbox)
+                .where(orm.outbox.c.id.in_(ids))
+                .values(dispatched_at=datetime.now(timezone.utc))
+            )
+
+    def mark_failed(self, id: int, error: str) -> None:
+        self._session.execute(
+            update(orm.outbox)
+            .where(orm.outbox.c.id == id)
+            .values(attempts=orm.outbox.c.attempts + 1, last_error=error)
+        )
@@ -0,0 +1,82 @@
+import threading
+import time
+from dataclasses import dataclass, field, fields
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+
+@dataclass
+class PoolMetrics:
+    checkouts: int = 0
+    checkins: int = 0
+    connects: int = 0
+    invalidations: int = 0
+    timeouts: int = 0
+    wait_seconds_total: float = 0.0
+    wait_seconds_max: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def _increment(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def attach(self, engine) -> None:
+        """Counts the engine's pool events; waits are timed by MeteredQueuePool."""
+        event.listen(engine, "checkout", lambda *_: self._increment("checkouts"))
+        event.listen(engine, "checkin", lambda *_: self._increment("checkins"))
+        event.listen(engine, "connect", lambda *_: self._increment("connects"))
+        event.listen(
+            engine, "invalidate", lambda *_: self._increment("invalidations")
+        )
+        if isinstance(engine.pool, MeteredQueuePool):
+            engine.pool.metrics = self
+
+    def snapshot(self, pool=None) -> dict:
+        with self._lock:
+            values = {
+                f.name: getattr(self, f.name)
+                for f in fields(self)
+                if not f.name.startswith("_")
+            }
+        if isinstance(pool, QueuePool):
+            values.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+            )
+        return values
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that reports how long callers wait to get a connection."""
+
+    metrics: PoolMetrics | None = None
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeout:
+            if self.metrics:
+                self.metrics.record_wait(
+                    time.perf_counter() - started, timed_out=True
+                )
+            raise
+        if self.metrics:
+            self.metrics.record_wait(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a fresh pool; keep reporting to the same place
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
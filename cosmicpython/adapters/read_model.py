@@ -0,0 +1,122 @@
+import abc
+from typing import List
+
+from sqlalchemy import and_, bindparam, delete, insert, text
+
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+
+# One indexed lookup on allocations_view; deliberately plain SQL rather than
+# anything that goes through the ORM mapping of the aggregate.
+ALLOCATIONS_FOR_ORDER = text(
+    "SELECT sku, qty, batchref FROM allocations_view"
+    " WHERE orderid = :orderid ORDER BY id"
+)
+
+remove_allocation = delete(orm.allocations_view).where(
+    and_(
+        orm.allocations_view.c.orderid == bindparam("b_orderid"),
+        orm.allocations_view.c.sku == bindparam("b_sku"),
+        orm.allocations_view.c.qty == bindparam("b_qty"),
+    )
+)
+
+
+def added_rows(allocated: List[events.Allocated]) -> List[dict]:
+    return [
+        dict(orderid=e.orderid, sku=e.sku, qty=e.qty, batchref=e.batchref)
+        for e in allocated
+    ]
+
+
+def removed_rows(deallocated: List[events.Deallocated]) -> List[dict]:
+    return [dict(b_orderid=e.orderid, b_sku=e.sku, b_qty=e.qty) for e in deallocated]
+
+
+class AbstractAllocationsView(abc.ABC):
+    @abc.abstractmethod
+    def add(self, allocated: List[events.Allocated]) -> None: ...
+
+    @abc.abstractmethod
+    def remove(self, deallocated: List[events.Deallocated]) -> None: ...
+
+    @abc.abstractmethod
+    def for_order(self, orderid: str) -> List[dict]: ...
+
+
+class SqlAlchemyAllocationsView(AbstractAllocationsView):
+    def __init__(self, session) -> None:
+        self._session = session
+
+    def add(self, allocated):
+        if allocated:
+            self._session.execute(insert(orm.allocations_view), added_rows(allocated))
+
+    def remove(self, deallocated):
+        if deallocated:
+            self._session.execute(remove_allocation, removed_rows(deallocated))
+
+    def for_order(self, orderid):
+        rows = self._session.execute(ALLOCATIONS_FOR_ORDER, dict(orderid=orderid))
+        return [dict(row._mapping) for row in rows]
+
+
+class FakeAllocationsView(AbstractAllocationsView):
+    def __init__(self) -> None:
+        self._rows: List[dict] = []
+
+    def add(self, allocated):
+        self._rows.extend(added_rows(allocated))
+
+    def remove(self, deallocated):
+        for e in deallocated:
+            self._rows = [
+                row
+                for row in self._rows
+                if (row["orderid"], row["sku"], row["qty"])
+                != (e.orderid, e.sku, e.qty)
+            ]
+
+    def for_order(self, orderid):
+        return [
+            dict(sku=row["sku"], qty=row["qty"], batchref=row["batchref"])
+            for row in self._rows
+            if row["orderid"] == orderid
+        ]
+
+
+class AsyncSqlAlchemyAllocationsView:
+    """SqlAlchemyAllocationsView on an AsyncSession."""
+
+    def __init__(self, session) -> None:
+        self._session = session
+
+    async def add(self, allocated):
+        if allocated:
+            await self._session.execute(
+                insert(orm.allocations_view), added_rows(allocated)
+            )
+
+    async def remove(self, deallocated):
+        if deallocated:
+            await self._session.execute(remove_allocation, removed_rows(deallocated))
+
+    async def for_order(self, orderid):
+        rows = await self._session.execute(
+            ALLOCATIONS_FOR_ORDER, dict(orderid=orderid)
+        )
+        return [dict(row._mapping) for row in rows]
+
+
+class FakeAsyncAllocationsView:
+    def __init__(self) -> None:
+        self._view = FakeAllocationsView()
+
+    async def add(self, allocated):
+        self._view.add(allocated)
+
+    async def remove(self, deallocated):
+        self._view.remove(deallocated)
+
+    async def for_order(self, orderid):
+        return self._view.for_order(orderid)
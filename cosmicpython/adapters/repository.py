@@ -1,59 +1,197 @@
 import abc
-from typing import Optional, Set
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.util import identity_key
 
 from cosmicpython.adapters import orm
+from cosmicpython.adapters.cache import ProductCache, ProductSnapshot, rebuild
+from cosmicpython.adapters.metrics import AbstractMetrics, NoopMetrics
 from cosmicpython.domain.models import Batch, OrderLine, Product
 
+# Row locks SqlAlchemyProductRepository can take on the product it loads, as an
+# alternative to relying on the optimistic version check alone.
+LOCK_MODES = {
+    "update": {},
+    "nowait": {"nowait": True},
+    "skip_locked": {"skip_locked": True},
+}
+# Postgres SQLSTATE for a NOWAIT lock that could not be taken
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class ProductLocked(Exception):
+    def __init__(self, key) -> None:
+        super().__init__(f"Product {key} is locked by another transaction")
+
+
+def lock_product_row(statement, lock: str):
+    # Only the products row: Postgres can't lock the nullable side of the outer
+    # join that a joined eager load adds, and the product guards its batches.
+    return statement.with_for_update(of=orm.products, **LOCK_MODES[lock])
+
+
+def lock_not_available(error: DBAPIError) -> bool:
+    code = getattr(error.orig, "pgcode", None) or getattr(
+        error.orig, "sqlstate", None
+    )
+    return code == LOCK_NOT_AVAILABLE
+
+
+def current_version(sku):
+    return select(orm.products.c.version).where(orm.products.c.sku == sku)
+
+
+class SeenProducts:
+    """
+    The products a repository has handed out (``seen``), and of those the ones
+    that recorded events since they were last collected (``dirty``, in the
+    order they first did). Collecting is then proportional to the new events,
+    not to how many products a bulk handler has touched.
+    """
+
+    def __init__(self):
+        self.seen = set()  # type: Set[Product]
+        self.dirty = {}  # type: Dict[Product, None]
+
+    def track(self, product: Product) -> None:
+        self.seen.add(product)
+        product.event_sink = self.mark_dirty
+        if product.events:
+            self.mark_dirty(product)
+
+    def mark_dirty(self, product: Product) -> None:
+        self.dirty[product] = None
+
+    def take_dirty(self) -> List[Product]:
+        dirty = list(self.dirty)
+        self.dirty.clear()
+        return dirty
+
+
+def attach_snapshot(session, snapshot: ProductSnapshot) -> Product:
+    # the session may already hold this product, e.g. from an earlier get
+    product = session.identity_map.get(identity_key(Product, snapshot.id))
+    if product is None:
+        product = rebuild(snapshot)
+        session.add(product)
+    return product
+
 
 class AbstractProductRepository(abc.ABC):
     def __init__(self):
-        self.seen = set()  # type: Set[Product]  #(1)
+        self.tracked = SeenProducts()
+        self.seen = self.tracked.seen  # (1)
 
     def add(self, product: Product):  # (2)
         self._add(product)
-        self.seen.add(product)
+        self.tracked.track(product)
 
-    def get(self, sku) -> Product:  # (3)
-        product = self._get(sku)
+    def get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:  # (3)
+        product = self._get(sku, loading=loading, lock=lock)
         if product:
-            self.seen.add(product)
+            self.tracked.track(product)
         return product
 
-    def get_by_batchref(self, batchref) -> Product:
-        product = self._get_by_batchref(batchref)
+    def get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        product = self._get_by_batchref(batchref, loading=loading, lock=lock)
         if product:
-            self.seen.add(product)
+            self.tracked.track(product)
         return product
 
     @abc.abstractmethod
-    def _get_by_batchref(self, batchref) -> Product:
+    def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
         raise NotImplementedError
 
     @abc.abstractmethod
     def _add(self, product): ...
 
     @abc.abstractmethod
-    def _get(self, sku) -> Product: ...
+    def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product: ...
 
 
 class SqlAlchemyProductRepository(AbstractProductRepository):
-    def __init__(self, session) -> None:
+    """
+    ``loading`` picks how a product's batches and allocations are fetched (see
+    ``orm.LOADING_STRATEGIES``); it can be overridden on each ``get`` call.
+
+    ``lock`` takes a row lock on the product (see ``LOCK_MODES``) until the
+    transaction ends. With "nowait" or "skip_locked" a product another
+    transaction holds raises ProductLocked rather than waiting.
+
+    With a ``cache``, an unlocked ``get`` of a cached SKU only reads the
+    product's version; if it still matches, the aggregate is rebuilt from the
+    snapshot instead of loaded. The unit of work refreshes the cache on commit.
+
+    Load times go to ``metrics`` as repository_get_seconds.
+    """
+
+    def __init__(
+        self,
+        session,
+        loading: str = "selectin",
+        cache: Optional[ProductCache] = None,
+        metrics: Optional[AbstractMetrics] = None,
+    ) -> None:
         super().__init__()
         self._session = session
+        self.loading = loading
+        self.cache = cache
+        self.metrics = NoopMetrics() if metrics is None else metrics
 
     def _add(self, product):
         self._session.add(product)
 
-    def _get(self, sku) -> Product:
-        return self._session.query(Product).filter_by(sku=sku).first()
+    def _query(self, loading: Optional[str]):
+        return self._session.query(Product).options(
+            *orm.product_loader_options(loading or self.loading)
+        )
+
+    def _first(self, query, lock: Optional[str], key) -> Optional[Product]:
+        if lock is None:
+            return query.first()
+        try:
+            product = lock_product_row(query, lock).first()
+        except DBAPIError as e:
+            if lock == "nowait" and lock_not_available(e):
+                raise ProductLocked(key) from e
+            raise
+        if product is None and lock == "skip_locked":
+            if self._session.query(query.exists()).scalar():
+                raise ProductLocked(key)
+        return product
 
-    def _get_by_batchref(self, batchref):
-        return (
-            self._session.query(Product)
+    def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        with self.metrics.timer("repository_get_seconds", by="sku"):
+            if self.cache is not None and lock is None:
+                snapshot = self.cache.get(sku)
+                if snapshot is not None:
+                    version = self._session.scalar(current_version(sku))
+                    if self.cache.validate(snapshot, version):
+                        return attach_snapshot(self._session, snapshot)
+            return self._first(self._query(loading).filter_by(sku=sku), lock, sku)
+
+    def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ):
+        query = (
+            self._query(loading)
             .join(Batch)
             .filter(orm.batches.c.reference == batchref)
-            .first()
         )
+        with self.metrics.timer("repository_get_seconds", by="batchref"):
+            return self._first(query, lock, batchref)
 
 
 class FakeProductRepository(AbstractProductRepository):
@@ -69,16 +207,147 @@ class FakeProductRepository(AbstractProductRepository):
     def _add(self, product):
         self._products.add(product)
 
-    def _get(self, sku) -> Product:
+    def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
         return next((p for p in self._products if p.sku == sku), None)
 
-    def _get_by_batchref(self, batchref):
+    def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ):
         return next(
             (p for p in self._products for b in p.batches if b.reference == batchref),
             None,
         )
 
 
+class AbstractAsyncProductRepository(abc.ABC):
+    def __init__(self):
+        self.tracked = SeenProducts()
+        self.seen = self.tracked.seen
+
+    def add(self, product: Product):
+        self._add(product)
+        self.tracked.track(product)
+
+    async def get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        product = await self._get(sku, loading=loading, lock=lock)
+        if product:
+            self.tracked.track(product)
+        return product
+
+    async def get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        product = await self._get_by_batchref(batchref, loading=loading, lock=lock)
+        if product:
+            self.tracked.track(product)
+        return product
+
+    @abc.abstractmethod
+    def _add(self, product): ...
+
+    @abc.abstractmethod
+    async def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product: ...
+
+    @abc.abstractmethod
+    async def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product: ...
+
+
+class AsyncSqlAlchemyProductRepository(AbstractAsyncProductRepository):
+    """
+    Same queries (and cache) as SqlAlchemyProductRepository on an AsyncSession.
+    An async session can't lazy load, so the aggregate is always eagerly loaded.
+    """
+
+    def __init__(
+        self,
+        session,
+        loading: str = "selectin",
+        cache: Optional[ProductCache] = None,
+        metrics: Optional[AbstractMetrics] = None,
+    ) -> None:
+        super().__init__()
+        self._session = session
+        self.loading = loading
+        self.cache = cache
+        self.metrics = NoopMetrics() if metrics is None else metrics
+
+    def _add(self, product):
+        self._session.add(product)
+
+    def _select(self, loading: Optional[str]):
+        loading = loading or self.loading
+        if loading == "lazy":
+            raise ValueError("AsyncSession can't lazy load; use selectin or joined")
+        return select(Product).options(*orm.product_loader_options(loading))
+
+    async def _first(self, statement, lock: Optional[str], key) -> Optional[Product]:
+        locked = statement
+        if lock is not None:
+            locked = lock_product_row(statement, lock)
+        try:
+            result = await self._session.execute(locked.limit(1))
+        except DBAPIError as e:
+            if lock == "nowait" and lock_not_available(e):
+                raise ProductLocked(key) from e
+            raise
+        product = result.unique().scalars().first()
+        if product is None and lock == "skip_locked":
+            if await self._session.scalar(select(statement.exists())):
+                raise ProductLocked(key)
+        return product
+
+    async def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        with self.metrics.timer("repository_get_seconds", by="sku"):
+            if self.cache is not None and lock is None:
+                snapshot = self.cache.get(sku)
+                if snapshot is not None:
+                    version = await self._session.scalar(current_version(sku))
+                    if self.cache.validate(snapshot, version):
+                        return attach_snapshot(self._session, snapshot)
+            statement = self._select(loading).filter_by(sku=sku)
+            return await self._first(statement, lock, sku)
+
+    async def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ):
+        statement = (
+            self._select(loading)
+            .join(Batch)
+            .where(orm.batches.c.reference == batchref)
+        )
+        with self.metrics.timer("repository_get_seconds", by="batchref"):
+            return await self._first(statement, lock, batchref)
+
+
+class FakeAsyncProductRepository(AbstractAsyncProductRepository):
+    def __init__(self, products) -> None:
+        super().__init__()
+        self._products = FakeProductRepository(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(
+        self, sku, loading: Optional[str] = None, lock: Optional[str] = None
+    ) -> Product:
+        return self._products.get(sku)
+
+    async def _get_by_batchref(
+        self, batchref, loading: Optional[str] = None, lock: Optional[str] = None
+    ):
+        return self._products.get_by_batchref(batchref)
+
+
 class ProductNotFoundForSku(Exception):
     def __init__(self, sku) -> None:
         super().__init__(f"No product found for sku {sku}")
@@ -1,9 +1,22 @@
+import functools
 import os
 from dataclasses import dataclass
+from typing import Optional
 
 from sqlalchemy import create_engine
 
+from cosmicpython import logs
+from cosmicpython.adapters.broker import AbstractBroker, FakeBroker, RedisBroker
+from cosmicpython.adapters.cache import ProductCache
+from cosmicpython.adapters.idempotency import IdempotencyCache
+from cosmicpython.adapters.metrics import (
+    AbstractMetrics,
+    NoopMetrics,
+    PrometheusMetrics,
+    labelled_samples,
+)
 from cosmicpython.adapters.orm import sessionmaker, start_mappers
+from cosmicpython.adapters.pool import MeteredQueuePool, PoolMetrics
 
 
 @dataclass(frozen=True)
@@ -16,6 +29,22 @@ class ServerDetails:
         return f"http://{self.host}:{self.port}"
 
 
+@dataclass(frozen=True)
+class PoolSettings:
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30.0
+    pool_recycle: int = 1800
+    pre_ping: bool = True
+    statement_timeout_ms: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class LogSettings:
+    level: str = "INFO"
+    sample_rate: float = 1.0
+
+
 def get_postgres_uri() -> str:
     user = os.environ.get("DB_USER")
     password = os.environ.get("DB_PASSWORD")
@@ -26,12 +55,234 @@ def get_postgres_uri() -> str:
     return f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
 
 
+def get_database_uri() -> str:
+    """``DB_URI`` overrides the Postgres URI assembled from the DB_* variables."""
+    return os.environ.get("DB_URI") or get_postgres_uri()
+
+
+# async drivers SQLAlchemy's AsyncSession uses for each database
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+
+def get_async_database_uri() -> str:
+    scheme, rest = get_database_uri().split("://", 1)
+    dialect = scheme.split("+", 1)[0]
+    return f"{dialect}+{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
 def get_api_url() -> ServerDetails:
     host = os.environ.get("API_HOST", "localhost")
     port = os.environ.get("API_PORT", "8001")
     return ServerDetails(host=host, port=port)
 
 
+def get_pool_settings() -> PoolSettings:
+    defaults = PoolSettings()
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT_MS")
+    return PoolSettings(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", defaults.pool_size)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", defaults.max_overflow)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", defaults.pool_timeout)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", defaults.pool_recycle)),
+        pre_ping=os.environ.get("DB_POOL_PRE_PING", str(defaults.pre_ping)).lower()
+        in ("1", "true", "yes"),
+        statement_timeout_ms=int(statement_timeout) if statement_timeout else None,
+    )
+
+
+def get_log_settings() -> LogSettings:
+    defaults = LogSettings()
+    return LogSettings(
+        level=os.environ.get("LOG_LEVEL", defaults.level),
+        sample_rate=float(os.environ.get("LOG_SAMPLE_RATE", defaults.sample_rate)),
+    )
+
+
+def configure_logging() -> None:
+    """Called by each entrypoint; library code only gets loggers."""
+    settings = get_log_settings()
+    logs.configure(settings.level, settings.sample_rate)
+
+
+def engine_options(settings: PoolSettings, uri: str = "postgresql://") -> dict:
+    if uri.startswith("sqlite"):
+        # SQLite uses its own single-connection pools
+        return {}
+    options = dict(
+        poolclass=MeteredQueuePool,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_recycle=settings.pool_recycle,
+        pool_pre_ping=settings.pre_ping,
+    )
+    if settings.statement_timeout_ms is not None:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={settings.statement_timeout_ms}"
+        }
+    return options
+
+
+def async_engine_options(settings: PoolSettings, uri: str) -> dict:
+    options = engine_options(settings, uri)
+    # async engines wrap their own queue pool; waits are not timed there
+    options.pop("poolclass", None)
+    if settings.statement_timeout_ms is not None and "connect_args" in options:
+        options["connect_args"] = {
+            "server_settings": {
+                "statement_timeout": str(settings.statement_timeout_ms)
+            }
+        }
+    return options
+
+
+@functools.cache
+def get_product_cache() -> Optional[ProductCache]:
+    """
+    The process's cache of Product snapshots, used by the SqlAlchemy units of
+    work; off (None) unless PRODUCT_CACHE_SIZE is a positive number.
+    """
+    size = int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+    if size <= 0:
+        return None
+    ttl = os.environ.get("PRODUCT_CACHE_TTL", "60")
+    return ProductCache(max_size=size, ttl=float(ttl) if ttl else None)
+
+
+@functools.cache
+def get_idempotency_cache() -> Optional[IdempotencyCache]:
+    """
+    The process's cache of idempotency records, in front of the table; up to
+    IDEMPOTENCY_CACHE_SIZE of them (default 10000, 0 turns it off).
+    """
+    size = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10_000))
+    return IdempotencyCache(max_size=size) if size > 0 else None
+
+
+@functools.cache
+def get_broker() -> Optional[AbstractBroker]:
+    """
+    The broker at BROKER_URL: Redis for a redis:// URL, or memory:// for one in
+    process. None, and nothing published or consumed, when it isn't set.
+    """
+    url = os.environ.get("BROKER_URL")
+    if not url:
+        return None
+    if url == "memory://":
+        return FakeBroker()
+    # only installed where a broker is used
+    import redis
+
+    return RedisBroker(redis.Redis.from_url(url, decode_responses=True))
+
+
+@functools.cache
+def get_pool_metrics() -> PoolMetrics:
+    return PoolMetrics()
+
+
+@functools.cache
+def get_metrics() -> AbstractMetrics:
+    """
+    The process's request metrics: kept in memory for ``/metrics`` unless
+    METRICS_BACKEND is "noop". They include the pool and cache figures.
+    """
+    if os.environ.get("METRICS_BACKEND", "prometheus") == "noop":
+        return NoopMetrics()
+    metrics = PrometheusMetrics()
+    metrics.add_collector(
+        lambda: labelled_samples(
+            "db_pool", "gauge", "Connection pool statistics", pool_status(), "stat"
+        )
+    )
+    metrics.add_collector(product_cache_samples)
+    metrics.add_collector(idempotency_cache_samples)
+    return metrics
+
+
+def product_cache_samples():
+    cache = get_product_cache()
+    if cache is None:
+        return []
+    return labelled_samples(
+        "product_cache_total",
+        "counter",
+        "Product cache lookups and removals",
+        cache.metrics,
+        "outcome",
+    ) + [("product_cache_size", "gauge", "Products cached", {}, len(cache))]
+
+
+def idempotency_cache_samples():
+    cache = get_idempotency_cache()
+    if cache is None:
+        return []
+    return labelled_samples(
+        "idempotency_cache_total",
+        "counter",
+        "Idempotency cache lookups and evictions",
+        cache.metrics,
+        "outcome",
+    )
+
+
+@functools.cache
+def get_engine():
+    """The process-wide engine shared by the API and every SqlAlchemyUnitOfWork."""
+    uri = get_database_uri()
+    engine = create_engine(uri, **engine_options(get_pool_settings(), uri))
+    get_pool_metrics().attach(engine)
+    get_metrics().attach(engine)
+    return engine
+
+
+@functools.cache
+def get_session_factory():
+    return sessionmaker(bind=get_engine())
+
+
+@functools.cache
+def get_async_engine():
+    # imported here so processes that never go async don't pay for it
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    uri = get_async_database_uri()
+    engine = create_async_engine(
+        uri, **async_engine_options(get_pool_settings(), uri)
+    )
+    get_pool_metrics().attach(engine.sync_engine)
+    get_metrics().attach(engine.sync_engine)
+    return engine
+
+
+@functools.cache
+def get_async_session_factory():
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    # nothing can lazy load after commit in async code, so don't expire
+    return async_sessionmaker(bind=get_async_engine(), expire_on_commit=False)
+
+
+def pool_status() -> dict:
+    if not get_engine.cache_info().currsize:
+        return get_pool_metrics().snapshot()
+    return get_pool_metrics().snapshot(get_engine().pool)
+
+
+def dispose_engine():
+    if get_engine.cache_info().currsize:
+        get_engine().dispose()
+    get_session_factory.cache_clear()
+    get_engine.cache_clear()
+
+
+async def dispose_async_engine():
+    if get_async_engine.cache_info().currsize:
+        await get_async_engine().dispose()
+    get_async_session_factory.cache_clear()
+    get_async_engine.cache_clear()
+
+
 def init_db():
     start_mappers()
-    return sessionmaker(bind=create_engine(get_postgres_uri()))
+    return get_session_factory()
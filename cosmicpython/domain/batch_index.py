@@ -0,0 +1,93 @@
+from bisect import bisect_right
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from cosmicpython.domain.models import Batch, OrderLine
+
+
+class BatchIndex:
+    """
+    A product's batches kept in allocation order, alongside a max-segment-tree
+    of their available quantities.
+
+    The order is the one ``sorted(batches)`` gives through ``Batch.__gt__``:
+    in-stock batches (``eta=None``) first, then ascending ETA, with ties kept in
+    the order the batches were added. The tree lets ``first_available`` skip
+    every batch that is too small for a line in O(log n) instead of scanning.
+
+    Batches must be changed through their ``Product`` (the aggregate root), which
+    calls ``update`` whenever a batch's available quantity moves.
+    """
+
+    def __init__(self, batches: Iterable["Batch"]) -> None:
+        self._keys: List[Tuple] = []
+        self._batches: List["Batch"] = []
+        self._positions: Dict["Batch", int] = {}
+        self._sequence = 0
+        for batch in batches:
+            self._insert(batch)
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def add(self, batch: "Batch") -> None:
+        self._insert(batch)
+        self._rebuild()
+
+    def update(self, batch: "Batch") -> None:
+        node = self._size + self._positions[batch]
+        self._tree[node] = batch.available_quantity
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_available(self, line: "OrderLine") -> Optional["Batch"]:
+        position = self._first_at_least(line.qty, 0)
+        while position is not None:
+            batch = self._batches[position]
+            if batch.can_allocate(line):
+                return batch
+            position = self._first_at_least(line.qty, position + 1)
+        return None
+
+    def _insert(self, batch: "Batch") -> None:
+        if batch.eta is None:
+            key: Tuple = (0, self._sequence)
+        else:
+            key = (1, batch.eta, self._sequence)
+        self._sequence += 1
+        position = bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self._batches.insert(position, batch)
+
+    def _rebuild(self) -> None:
+        self._positions = {batch: i for i, batch in enumerate(self._batches)}
+        self._size = 1
+        while self._size < len(self._batches):
+            self._size *= 2
+        # empty leaves can never satisfy a request
+        self._tree = [float("-inf")] * (2 * self._size)
+        for i, batch in enumerate(self._batches):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def _first_at_least(self, qty: int, start: int) -> Optional[int]:
+        """Leftmost position >= ``start`` whose available quantity is >= ``qty``."""
+        return self._descend(1, 0, self._size, qty, start)
+
+    def _descend(self, node: int, lo: int, hi: int, qty: int, start: int):
+        if hi <= start or self._tree[node] < qty:
+            return None
+        if hi - lo == 1:
+            return lo
+        mid = (lo + hi) // 2
+        found = self._descend(2 * node, lo, mid, qty, start)
+        if found is None:
+            found = self._descend(2 * node + 1, mid, hi, qty, start)
+        return found
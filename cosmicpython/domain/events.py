@@ -1,24 +1,26 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 
 class Event:
-    pass
+    # with slotted subclasses, events carry no per-instance __dict__: bulk jobs
+    # and allocation runs hold hundreds of thousands of them at once
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class BatchQuantityChanged(Event):
     ref: str
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(slots=True)
 class BatchCreated(Event):
     ref: str
     sku: str
@@ -26,8 +28,42 @@ class BatchCreated(Event):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(slots=True)
+class BatchesCreated(Event):
+    batches: List[BatchCreated]
+
+
+@dataclass(slots=True)
 class AllocationRequired(Event):
     orderid: str
     sku: str
     qty: int
+    # a client's retry of the same request carries the same key
+    idempotency_key: Optional[str] = None
+
+
+@dataclass(slots=True)
+class AllocationsRequired(Event):
+    lines: List[AllocationRequired]
+
+
+@dataclass(slots=True)
+class DeallocationRequired(Event):
+    orderid: str
+    sku: str
+    qty: int
+
+
+@dataclass(slots=True)
+class Allocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass(slots=True)
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Iterable, List, Optional
 
 from cosmicpython.domain import events
+from cosmicpython.domain.batch_index import BatchIndex
 from cosmicpython.domain.events import Event
 
 
@@ -10,6 +11,17 @@ class InvalidSku(Exception):
         super().__init__(f"Invalid sku {sku}")
 
 
+class InconsistentAllocatedQuantity(Exception):
+    def __init__(self, reference: str, tracked: int, actual: int) -> None:
+        super().__init__(
+            f"Batch {reference} tracks {tracked} allocated but its lines sum to {actual}"
+        )
+        self.reference = reference
+
+
+# Mapped classes can't be slotted: the ORM replaces their attributes with its
+# own descriptors, which keep the values in the instance __dict__. Loaded SKUs
+# are interned instead (see orm.Sku).
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: str
@@ -24,14 +36,28 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()
+        # Running total of the allocated lines' qty. ``None`` means "unknown"
+        # (e.g. just loaded by the ORM) and is recomputed on first access.
+        self._allocated_quantity: Optional[int] = 0
 
     def allocate(self, orderline: OrderLine) -> None:
-        if self.can_allocate(orderline):
+        if self.can_allocate(orderline) and orderline not in self._allocations:
+            allocated = self.allocated_quantity
             self._allocations.add(orderline)
+            self._allocated_quantity = allocated + orderline.qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
+
+    def check_allocated_quantity(self) -> None:
+        actual = sum(line.qty for line in self._allocations)
+        if self.allocated_quantity != actual:
+            raise InconsistentAllocatedQuantity(
+                self.reference, self.allocated_quantity, actual
+            )
 
     @property
     def available_quantity(self) -> int:
@@ -39,7 +65,9 @@ class Batch:
 
     def deallocate(self, line: OrderLine) -> None:
         if self.contains(line):
+            allocated = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated - line.qty
 
     def contains(self, line: OrderLine) -> bool:
         return line in self._allocations
@@ -55,7 +83,10 @@ class Batch:
         return self.eta > other.eta
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
 
 
 class NoBatchContainingOrderLine(Exception):
@@ -68,35 +99,82 @@ class Product:
     sku: str
     batches: List[Batch]
     events: List[Event]
+    # called with the product whenever it records events; the repository that
+    # handed it out sets this, so the unit of work only visits products that
+    # have something to collect rather than every one it has seen
+    event_sink: Optional[Callable[["Product"], None]] = None
 
     def __init__(self, sku: str, batches: List[Batch], version=0) -> None:
         self.sku = sku
         self.batches = batches
         self.version = version
         self.events = []
+        self._batch_index: Optional[BatchIndex] = None
+
+    @property
+    def batch_index(self) -> BatchIndex:
+        # Rebuilt lazily; the length check also catches batches appended to
+        # ``self.batches`` directly rather than through ``add_batch``.
+        if self._batch_index is None or len(self._batch_index) != len(self.batches):
+            self._batch_index = BatchIndex(self.batches)
+        return self._batch_index
+
+    def add_batch(self, batch: Batch) -> None:
+        index = self.batch_index
+        # a new batch changes the aggregate too, so cached copies must go stale
+        self.version += 1
+        self.batches.append(batch)
+        index.add(batch)
 
     def deallocate(self, line: OrderLine):
         for batch in self.batches:
             if batch.contains(line):
+                self.version += 1
                 batch.deallocate(line)
+                self.batch_index.update(batch)
+                self._record([events.Deallocated(line.orderid, line.sku, line.qty)])
                 return
         raise NoBatchContainingOrderLine(line)
 
     def allocate(self, line: OrderLine) -> str | None:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            self.version += 1
-            batch.allocate(line)
-            return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
+        index = self.batch_index
+        batch = index.first_available(line)
+        if batch is None:
+            self._record([events.OutOfStock(line.sku)])
             return None
+        if batch.contains(line):
+            # allocating it again changes nothing, so there is nothing to record
+            return batch.reference
+        self.version += 1
+        batch.allocate(line)
+        index.update(batch)
+        self._record(
+            [events.Allocated(line.orderid, line.sku, line.qty, batch.reference)]
+        )
+        return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
+        self.version += 1
         batch._purchased_quantity = qty
+        evicted = []
         while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(
-                events.AllocationRequired(line.orderid, line.sku, line.qty)
-            )
+            evicted.append(batch.deallocate_one())
+        self.batch_index.update(batch)
+        # every Deallocated first, so the bus gets each kind as one run
+        self._record(
+            events.Deallocated(line.orderid, line.sku, line.qty) for line in evicted
+        )
+        self._record(
+            events.AllocationRequired(line.orderid, line.sku, line.qty)
+            for line in evicted
+        )
+
+    def _record(self, new: Iterable[Event]) -> None:
+        self.events.extend(new)
+        if self.event_sink is not None:
+            self.event_sink(self)
+
+    def check_consistency(self) -> None:
+        for batch in self.batches:
+            batch.check_allocated_quantity()
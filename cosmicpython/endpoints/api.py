@@ -1,20 +1,55 @@
+from contextlib import asynccontextmanager
 from datetime import date
-from typing import Optional
+from typing import Annotated, Optional
 
-from fastapi import FastAPI, Response, status
+from fastapi import FastAPI, Header, Request, Response, status
 from pydantic import BaseModel
 from starlette.status import HTTP_201_CREATED, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND
 
 from cosmicpython import config
+from cosmicpython.adapters import metrics
+from cosmicpython.adapters.batch_loader import DuplicateBatches
+from cosmicpython.adapters.idempotency import IdempotencyKeyReused
 from cosmicpython.domain import events, models
-from cosmicpython.service_layer import handlers, services
-from cosmicpython.service_layer.message_bus import MessageBus
-from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+from cosmicpython.service_layer import handlers, ingest, views
+from cosmicpython.service_layer.message_bus import AsyncMessageBus
+from cosmicpython.service_layer.unit_of_work import AsyncSqlAlchemyUnitOfWork
 
-app = FastAPI(swagger_ui_parameters={"syntaxHighlight.theme": "obsidian"})
-message_bus = MessageBus()
 
-get_session = config.init_db()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    config.configure_logging()
+    # Mapping is cheap; the engine itself is created by the first unit of work.
+    config.start_mappers()
+    yield
+    # let fire-and-forget handlers finish before their connections go away
+    await message_bus.join()
+    await config.dispose_async_engine()
+
+
+app = FastAPI(
+    lifespan=lifespan, swagger_ui_parameters={"syntaxHighlight.theme": "obsidian"}
+)
+message_bus = AsyncMessageBus()
+
+
+def bus_samples():
+    return metrics.labelled_samples(
+        "bus_retries_total",
+        "counter",
+        "Handler runs that hit a conflict, and their retries",
+        message_bus.metrics,
+        "outcome",
+    ) + metrics.labelled_samples(
+        "background_handlers_total",
+        "counter",
+        "Fire-and-forget handlers, by outcome",
+        message_bus.background.metrics,
+        "outcome",
+    )
+
+
+message_bus.request_metrics.add_collector(bus_samples)
 
 
 class OrderRequest(BaseModel):
@@ -30,15 +65,19 @@ class AllocationRequest(BaseModel):
     qty: int
 
 
+class BulkAllocationRequest(BaseModel):
+    lines: list[AllocationRequest]
+
+
 def order_line_from_request(req: AllocationRequest):
     return models.OrderLine(req.orderid, req.sku, req.qty)
 
 
 @app.post("/add_batch", status_code=status.HTTP_201_CREATED)
-def add_batch(request: OrderRequest, response: Response):
-    uow = SqlAlchemyUnitOfWork()
+async def add_batch(request: OrderRequest, response: Response):
+    uow = AsyncSqlAlchemyUnitOfWork()
     try:
-        message_bus.handle(
+        await message_bus.handle(
             events.BatchCreated(
                 ref=request.ref, sku=request.sku, qty=request.qty, eta=request.eta
             ),
@@ -50,12 +89,48 @@ def add_batch(request: OrderRequest, response: Response):
         return {"message": str(e)}
 
 
+# request content types accepted by /batches/bulk
+BULK_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+@app.post("/batches/bulk", status_code=status.HTTP_201_CREATED)
+async def add_batches(request: Request, response: Response):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in BULK_FORMATS:
+        response.status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        return {"message": f"Send one of {', '.join(BULK_FORMATS)}"}
+    try:
+        report = await ingest.ingest_async(
+            request.stream(),
+            message_bus,
+            AsyncSqlAlchemyUnitOfWork,
+            format=BULK_FORMATS[content_type],
+        )
+    except ingest.IngestFailed as e:
+        if not isinstance(e.__cause__, (ingest.InvalidShipmentRow, DuplicateBatches)):
+            raise
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": str(e.__cause__), "rows": e.report.rows}
+    return {"rows": report.rows, "chunks": report.chunks}
+
+
 @app.post("/allocations")
-def allocate(request: AllocationRequest, response: Response):
-    uow = SqlAlchemyUnitOfWork()
+async def allocate(
+    request: AllocationRequest,
+    response: Response,
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
+):
+    uow = AsyncSqlAlchemyUnitOfWork()
     try:
-        result = message_bus.handle(
-            events.AllocationRequired(request.orderid, request.sku, request.qty), uow
+        result = await message_bus.handle(
+            events.AllocationRequired(
+                request.orderid, request.sku, request.qty, idempotency_key
+            ),
+            uow,
         )
         batchref = result.pop()
         if not batchref:
@@ -64,21 +139,70 @@ def allocate(request: AllocationRequest, response: Response):
     except handlers.InvalidSku as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"message": str(e)}
+    except IdempotencyKeyReused as e:
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return {"message": str(e)}
 
     response.status_code = status.HTTP_201_CREATED
     return {"batchref": batchref}
 
 
+@app.post("/allocations/bulk")
+async def allocate_many(request: BulkAllocationRequest, response: Response):
+    uow = AsyncSqlAlchemyUnitOfWork()
+    lines = [
+        events.AllocationRequired(line.orderid, line.sku, line.qty)
+        for line in request.lines
+    ]
+    try:
+        [batchrefs, *_] = await message_bus.handle(
+            events.AllocationsRequired(lines), uow
+        )
+    except handlers.InvalidSku as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": str(e)}
+
+    response.status_code = status.HTTP_201_CREATED
+    return {
+        "allocations": [
+            {"orderid": line.orderid, "sku": line.sku, "batchref": batchref}
+            for line, batchref in zip(lines, batchrefs)
+        ]
+    }
+
+
+@app.get("/allocations/{orderid}")
+async def allocations_for_order(orderid: str, response: Response):
+    result = await views.allocations_async(orderid, AsyncSqlAlchemyUnitOfWork())
+    if not result:
+        response.status_code = HTTP_404_NOT_FOUND
+        return {"message": f"No allocations for order {orderid}"}
+    return result
+
+
 @app.delete("/allocations")
-def deallocate(request: AllocationRequest, response: Response):
-    uow = SqlAlchemyUnitOfWork()
+async def deallocate(request: AllocationRequest, response: Response):
+    uow = AsyncSqlAlchemyUnitOfWork()
     try:
-        services.deallocate(request.orderid, request.sku, request.qty, uow)
+        await message_bus.handle(
+            events.DeallocationRequired(request.orderid, request.sku, request.qty),
+            uow,
+        )
         response.status_code = HTTP_204_NO_CONTENT
         return {"message": "deleted"}
     except models.NoBatchContainingOrderLine as e:
         response.status_code = HTTP_404_NOT_FOUND
         return {"message": str(e)}
+    except handlers.InvalidSku as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": str(e)}
+
+
+@app.get("/metrics")
+def read_metrics():
+    return Response(
+        message_bus.request_metrics.render(), media_type=metrics.CONTENT_TYPE
+    )
 
 
 @app.get("/")
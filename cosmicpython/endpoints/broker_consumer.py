@@ -0,0 +1,64 @@
+"""
+Worker that handles the commands other systems send through the broker at
+BROKER_URL (AllocationRequired, BatchQuantityChanged). The allocations they
+make are published back to it by the outbox worker.
+
+Run one per consumer name alongside the API with
+``python -m cosmicpython.endpoints.broker_consumer --consumer worker-1``; those
+sharing a ``--group`` split the messages between them. It uses the same database
+settings (DB_URI or DB_*) as the app.
+"""
+
+import argparse
+import signal
+import socket
+
+from cosmicpython import config
+from cosmicpython.service_layer.broker_consumer import BrokerConsumer
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--group", default="cosmicpython")
+    parser.add_argument("--consumer", default=socket.gethostname())
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--block-ms",
+        type=int,
+        default=1000,
+        help="how long a read waits for messages",
+    )
+    args = parser.parse_args(argv)
+    config.configure_logging()
+
+    broker = config.get_broker()
+    if broker is None:
+        parser.exit(1, "BROKER_URL is not set\n")
+    config.start_mappers()
+    bus = MessageBus()
+    consumer = BrokerConsumer(
+        broker,
+        bus,
+        SqlAlchemyUnitOfWork,
+        group=args.group,
+        consumer=args.consumer,
+        batch_size=args.batch_size,
+        block_ms=args.block_ms,
+    )
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    consumer.run(stop=lambda: stopping)
+    bus.join()
+
+
+if __name__ == "__main__":
+    main()
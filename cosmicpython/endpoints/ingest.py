@@ -0,0 +1,61 @@
+"""
+Loads a file of inbound shipments (CSV with a ref,sku,qty,eta header, or NDJSON)
+in bulk, then prints how many rows it loaded and how fast.
+
+Run with ``python -m cosmicpython.endpoints.ingest shipments.csv`` (``-`` reads
+stdin); it uses the same database settings (DB_URI or DB_*) as the app.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from cosmicpython import config
+from cosmicpython.service_layer import ingest
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+SUFFIXES = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="file to load, or - for stdin")
+    parser.add_argument(
+        "--format",
+        choices=sorted(ingest.READERS),
+        help="defaults to the file's suffix, or csv",
+    )
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+    format = args.format or SUFFIXES.get(Path(args.path).suffix, "csv")
+
+    config.configure_logging()
+    config.start_mappers()
+    bus = MessageBus()
+    # newline="" as the csv module wants; NDJSON doesn't mind
+    stream = (
+        sys.stdin
+        if args.path == "-"
+        else open(args.path, newline="", encoding="utf-8")
+    )
+    try:
+        report = ingest.ingest(
+            stream,
+            bus,
+            SqlAlchemyUnitOfWork,
+            format=format,
+            chunk_size=args.chunk_size,
+        )
+    except ingest.IngestFailed as e:
+        sys.exit(str(e))
+    finally:
+        stream.close()
+    print(
+        f"loaded {report.rows} batches in {report.chunks} chunks, {report.seconds:.1f}s"
+        f" ({report.rows_per_second:,.0f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Background worker that delivers the events waiting in the outbox table, and
+publishes them to the broker at BROKER_URL if one is set.
+
+Run as many as you like alongside the API with
+``python -m cosmicpython.endpoints.outbox_worker``; it uses the same database
+settings (DB_URI or DB_*) as the app.
+"""
+
+import argparse
+import signal
+
+from cosmicpython import config
+from cosmicpython.service_layer.outbox_dispatcher import (
+    OutboxDispatcher,
+    external_handlers,
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-attempts", type=int, default=10)
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="seconds to wait when the outbox is empty",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="drain what is pending, then exit"
+    )
+    args = parser.parse_args(argv)
+    config.configure_logging()
+
+    dispatcher = OutboxDispatcher(
+        handlers=external_handlers(config.get_broker()),
+        batch_size=args.batch_size,
+        max_attempts=args.max_attempts,
+    )
+    if args.once:
+        while dispatcher.dispatch_batch() == args.batch_size:
+            pass
+        return
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    dispatcher.run(poll_interval=args.poll_interval, stop=lambda: stopping)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Structured logging: an event name plus key=value fields, formatted only if a
+handler actually emits the record.
+
+``get_logger(__name__).debug("allocated", sku=sku, batchref=ref)`` costs one
+level check when DEBUG is off. Expensive values go in as ``lazy(func, *args)``,
+which is called only when the record is formatted. DEBUG and INFO records can
+be sampled, keeping about ``sample_rate`` of them; warnings and errors are
+always kept. The fields are also on the record as ``record.fields``, for
+handlers that want them as data rather than text.
+"""
+
+import logging
+import random
+from typing import Callable, Optional
+
+# the sample rate of loggers that don't set their own, see ``configure``
+_sample_rate = 1.0
+
+
+class lazy:
+    """A field value computed when the record is formatted, not when logged."""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable, *args) -> None:
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
+def format_value(value) -> str:
+    text = str(value)
+    if not text or any(c.isspace() or c in '"=' for c in text):
+        return repr(text)
+    return text
+
+
+class Fields:
+    """The message of a structured record; rendered by ``str``."""
+
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event: str, fields: dict) -> None:
+        self.event = event
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(
+            [self.event]
+            + [f"{key}={format_value(value)}" for key, value in self.fields.items()]
+        )
+
+
+class StructuredLogger:
+    """
+    Wraps a ``logging.Logger``. ``sample_rate`` overrides the rate set by
+    ``configure`` for this logger's DEBUG and INFO records.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        sample_rate: Optional[float] = None,
+        random=random.random,
+    ) -> None:
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self._random = random
+
+    def log(self, level: int, event: str, /, exc_info=None, **fields) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = _sample_rate if self.sample_rate is None else self.sample_rate
+        if level < logging.WARNING and rate < 1.0 and self._random() >= rate:
+            return
+        self.logger.log(
+            level,
+            "%s",
+            Fields(event, fields),
+            exc_info=exc_info,
+            extra={"event": event, "fields": fields},
+            stacklevel=3,
+        )
+
+    def debug(self, event: str, /, **fields) -> None:
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, /, **fields) -> None:
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, /, **fields) -> None:
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, /, **fields) -> None:
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, /, **fields) -> None:
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+
+def get_logger(name: str, sample_rate: Optional[float] = None) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(name), sample_rate)
+
+
+def configure(level: str = "INFO", sample_rate: float = 1.0) -> None:
+    """For entrypoints: root handler, level and default sample rate."""
+    global _sample_rate
+    if not 0.0 <= sample_rate <= 1.0:
+        raise ValueError(f"Sample rate must be between 0 and 1, got {sample_rate}")
+    _sample_rate = sample_rate
+    logging.basicConfig(
+        level=level.upper(),
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
@@ -0,0 +1,186 @@
+"""
+Async counterparts of ``handlers`` for AsyncMessageBus. The domain calls are the
+same; only loading and committing the aggregate are awaited.
+"""
+
+from typing import Optional
+
+from cosmicpython import logs
+from cosmicpython.adapters.idempotency import AllocationRecord
+from cosmicpython.domain import events, models
+from cosmicpython.domain.models import InvalidSku, OrderLine
+from cosmicpython.service_layer import email, unit_of_work
+from cosmicpython.service_layer.handlers import replay
+
+logger = logs.get_logger(__name__)
+
+
+async def add_batch(
+    event: events.BatchCreated,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        product = await uow.products.get(sku=event.sku)
+        if product is None:
+            product = models.Product(event.sku, batches=[])
+            uow.products.add(product)
+        batch = models.Batch(event.ref, event.sku, event.qty, event.eta)
+        product.add_batch(batch)
+        await uow.commit()
+        logger.debug(
+            "batch_added", ref=event.ref, sku=event.sku, qty=event.qty, eta=event.eta
+        )
+        return batch
+
+
+async def add_batches(
+    event: events.BatchesCreated,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+) -> int:
+    async with uow:
+        await uow.batch_loader.load(event.batches)
+        await uow.commit()
+        return len(event.batches)
+
+
+async def allocate(
+    event: events.AllocationRequired,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    lock: Optional[str] = None,
+) -> str | None:
+    line = OrderLine(event.orderid, event.sku, event.qty)
+    key = event.idempotency_key
+
+    async with uow:
+        if key is not None:
+            # a retry: answer it without loading the product
+            done = await uow.idempotency.get(key)
+            if done is not None:
+                return replay(done, line, key)
+        product = await uow.products.get(sku=line.sku, lock=lock)
+        if product is None:
+            raise InvalidSku(line.sku)
+
+        with uow.metrics.timer("domain_call_seconds", call="allocate"):
+            batchref = product.allocate(line)
+        if key is not None and batchref is not None:
+            await uow.idempotency.add(
+                key, AllocationRecord(line.orderid, line.sku, line.qty, batchref)
+            )
+        await uow.commit()
+        logger.debug(
+            "allocated", orderid=line.orderid, sku=line.sku, batchref=batchref
+        )
+        return batchref
+
+
+async def allocate_many(
+    event: events.AllocationsRequired,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    lock: Optional[str] = None,
+) -> list[str | None]:
+    return await allocate_all(event.lines, uow, lock=lock)
+
+
+async def allocate_all(
+    batch: list[events.AllocationRequired],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    lock: Optional[str] = None,
+) -> list[str | None]:
+    lines = [OrderLine(e.orderid, e.sku, e.qty) for e in batch]
+    keys = [e.idempotency_key for e in batch]
+
+    async with uow:
+        # retries: answered from their records, without loading the product
+        done = {}
+        for key in dict.fromkeys(key for key in keys if key is not None):
+            record = await uow.idempotency.get(key)
+            if record is not None:
+                done[key] = record
+        products = {}
+        for sku in dict.fromkeys(
+            line.sku for line, key in zip(lines, keys) if key not in done
+        ):
+            product = await uow.products.get(sku=sku, lock=lock)
+            if product is None:
+                raise InvalidSku(sku)
+            products[sku] = product
+
+        batchrefs = []
+        with uow.metrics.timer("domain_call_seconds", call="allocate_all"):
+            for line, key in zip(lines, keys):
+                if key in done:
+                    batchrefs.append(replay(done[key], line, key))
+                    continue
+                batchref = products[line.sku].allocate(line)
+                if key is not None and batchref is not None:
+                    # a repeat of the key further on replays this one
+                    done[key] = AllocationRecord(
+                        line.orderid, line.sku, line.qty, batchref
+                    )
+                    await uow.idempotency.add(key, done[key])
+                batchrefs.append(batchref)
+        await uow.commit()
+        logger.debug(
+            "allocated_many",
+            lines=len(lines),
+            skus=len(products),
+            out_of_stock=logs.lazy(batchrefs.count, None),
+        )
+        return batchrefs
+
+
+async def deallocate(
+    event: events.DeallocationRequired,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    lock: Optional[str] = None,
+):
+    line = OrderLine(event.orderid, event.sku, event.qty)
+
+    async with uow:
+        product = await uow.products.get(sku=line.sku, lock=lock)
+        if product is None:
+            raise InvalidSku(line.sku)
+
+        with uow.metrics.timer("domain_call_seconds", call="deallocate"):
+            product.deallocate(line)
+        await uow.commit()
+        logger.debug("deallocated", orderid=line.orderid, sku=line.sku)
+
+
+async def change_batch_quantity(
+    event: events.BatchQuantityChanged,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+    lock: Optional[str] = None,
+):
+    async with uow:
+        product = await uow.products.get_by_batchref(batchref=event.ref, lock=lock)
+        with uow.metrics.timer("domain_call_seconds", call="change_batch_quantity"):
+            product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        await uow.commit()
+        logger.debug("batch_quantity_changed", ref=event.ref, qty=event.qty)
+
+
+async def send_out_of_stock_notification(
+    event: events.OutOfStock,
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    email.send("stock@made.com", f"Out of stock for {event.sku}")
+
+
+async def add_allocations_to_read_model(
+    batch: list[events.Allocated],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        await uow.allocations_view.add(batch)
+        await uow.commit()
+
+
+async def remove_allocations_from_read_model(
+    batch: list[events.Deallocated],
+    uow: unit_of_work.AbstractAsyncUnitOfWork,
+):
+    async with uow:
+        await uow.allocations_view.remove(batch)
+        await uow.commit()
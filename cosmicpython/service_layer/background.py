@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import threading
+from collections import Counter, defaultdict, deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundQueueFull(Exception):
+    def __init__(self, key) -> None:
+        name = getattr(key, "__name__", key)
+        super().__init__(f"Too many background {name} calls waiting to run")
+
+
+class ThreadedHandlerPool:
+    """
+    Runs fire-and-forget calls on a bounded thread pool.
+
+    Calls are grouped by ``key`` (the handler) and at most ``limit`` calls of a
+    key run at once; the rest wait in that key's queue without holding a
+    thread. At most ``max_pending`` calls may be queued or running in total:
+    ``submit`` blocks for up to ``submit_timeout`` seconds for room, then raises
+    BackgroundQueueFull. A call that raises is logged and counted, never
+    re-raised to whoever submitted it.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending: int = 1000,
+        submit_timeout: Optional[float] = 1.0,
+    ):
+        self.max_workers = max_workers
+        self.submit_timeout = submit_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._waiting: Dict[object, deque] = defaultdict(deque)
+        self._running = Counter()  # type: Counter[object]
+        self._outstanding = 0
+        # submitted, completed, failed, rejected
+        self.metrics = Counter()  # type: Counter[str]
+
+    def submit(self, key, limit: int, fn: Callable, *args) -> None:
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self.metrics["rejected"] += 1
+            raise BackgroundQueueFull(key)
+        with self._lock:
+            self.metrics["submitted"] += 1
+            self._outstanding += 1
+            if self._running[key] < limit:
+                self._running[key] += 1
+                self._start(key, fn, args)
+            else:
+                self._waiting[key].append((fn, args))
+
+    def _start(self, key, fn, args) -> None:
+        # called with the lock held; threads are only started once needed
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="bus-handler"
+            )
+        self._executor.submit(self._run, key, fn, args)
+
+    def _run(self, key, fn, args) -> None:
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Background handler %s failed", key)
+            outcome = "failed"
+        else:
+            outcome = "completed"
+        self._slots.release()
+        with self._lock:
+            self.metrics[outcome] += 1
+            self._outstanding -= 1
+            if self._waiting[key]:
+                self._start(key, *self._waiting[key].popleft())
+            else:
+                self._running[key] -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits for every submitted call to finish; False if ``timeout`` ran out."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._outstanding, timeout)
+
+    def shutdown(self) -> None:
+        self.join()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class AsyncHandlerTasks:
+    """
+    The asyncio counterpart of ThreadedHandlerPool: each call becomes a task on
+    the running loop, with the same per-key ``limit``, ``max_pending`` bound and
+    error isolation. A task waiting for its key's limit costs no thread.
+    """
+
+    def __init__(
+        self, max_pending: int = 1000, submit_timeout: Optional[float] = 1.0
+    ):
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.metrics = Counter()  # type: Counter[str]
+
+    def _bind(self) -> None:
+        # asyncio primitives belong to one loop; start afresh on a new one
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._slots = asyncio.BoundedSemaphore(self.max_pending)
+            self._limits: Dict[object, asyncio.Semaphore] = {}
+            self._tasks: set = set()
+
+    async def submit(
+        self, key, limit: int, fn: Callable[..., Awaitable], *args
+    ) -> None:
+        self._bind()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.submit_timeout)
+        except asyncio.TimeoutError:
+            self.metrics["rejected"] += 1
+            raise BackgroundQueueFull(key) from None
+        self.metrics["submitted"] += 1
+        limiter = self._limits.setdefault(key, asyncio.Semaphore(limit))
+        task = asyncio.create_task(self._run(key, limiter, fn, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, limiter, fn, args) -> None:
+        try:
+            async with limiter:
+                await fn(*args)
+        except Exception:
+            logger.exception("Background handler %s failed", key)
+            self.metrics["failed"] += 1
+        else:
+            self.metrics["completed"] += 1
+        finally:
+            self._slots.release()
+
+    async def join(self) -> None:
+        """Waits for every task submitted on the running loop to finish."""
+        self._bind()
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
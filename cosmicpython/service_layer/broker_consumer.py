@@ -0,0 +1,129 @@
+from collections import Counter
+from itertools import groupby
+from typing import Callable, List, Sequence
+
+from cosmicpython import logs
+from cosmicpython.adapters import broker as brokers
+from cosmicpython.service_layer.message_bus import allocate_together
+
+logger = logs.get_logger(__name__)
+
+
+def dead_letter_stream(stream: str) -> str:
+    return f"{stream}:dead"
+
+
+class BrokerConsumer:
+    """
+    Feeds the messages other systems put on ``streams`` into ``bus``, as one of
+    the consumers (``consumer``) of ``group``, reading up to ``batch_size`` at a
+    time. Each message is handled on a fresh ``uow_factory()``; a run of
+    AllocationRequired goes to the bus as one AllocationsRequired.
+
+    Delivery is at least once: messages are acknowledged, a call per stream,
+    only once the whole batch has been handled, and a restarted consumer first
+    handles what it had read but not acknowledged. A message that can't be
+    decoded, or whose handling raises, is copied to the stream's dead letter
+    stream (see ``dead_letter_stream``) and acknowledged; conflicts are already
+    retried by the bus. A run only goes one message at a time again to find a
+    bad one when nothing was committed (see ``allocate_together``); otherwise
+    the whole run is dead lettered, as handling it again could allocate twice.
+    """
+
+    def __init__(
+        self,
+        broker: brokers.AbstractBroker,
+        bus,
+        uow_factory: Callable,
+        group: str = "cosmicpython",
+        consumer: str = "consumer-1",
+        streams: Sequence[str] = (brokers.INBOUND,),
+        batch_size: int = 100,
+        block_ms: int = 1000,
+    ):
+        self.broker = broker
+        self.bus = bus
+        self.uow_factory = uow_factory
+        self.group = group
+        self.consumer = consumer
+        self.streams = list(streams)
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self._recovering = True
+        # handled, dead_lettered, acked
+        self.metrics = Counter()  # type: Counter[str]
+        for stream in self.streams:
+            broker.create_group(stream, group)
+
+    def consume_batch(self) -> int:
+        """Handles and acknowledges one batch; returns how many messages it read."""
+        messages = []
+        if self._recovering:
+            messages = self._read(pending=True)
+            self._recovering = bool(messages)
+        if not messages:
+            messages = self._read(pending=False)
+        done = {stream: [] for stream in self.streams}
+        for _, run in groupby(
+            messages, key=lambda m: (m.stream, m.fields.get("type"))
+        ):
+            self._handle_run(list(run))
+        for message in messages:
+            done[message.stream].append(message.id)
+        for stream, ids in done.items():
+            self.metrics["acked"] += self.broker.ack(stream, self.group, ids)
+        return len(messages)
+
+    def _read(self, pending: bool) -> List[brokers.BrokerMessage]:
+        return self.broker.read(
+            self.group,
+            self.consumer,
+            self.streams,
+            self.batch_size,
+            block_ms=self.block_ms,
+            pending=pending,
+        )
+
+    def _handle_run(self, run: List[brokers.BrokerMessage]) -> None:
+        if len(run) > 1 and run[0].fields.get("type") == "AllocationRequired":
+            try:
+                lines = [brokers.decode(message.fields) for message in run]
+            except Exception:
+                # nothing handled yet; find the bad one by going one at a time
+                logger.info("run_undecodable", messages=len(run))
+                lines = None
+            if lines is not None:
+                try:
+                    batchrefs = allocate_together(self.bus, lines, self.uow_factory())
+                except Exception as e:
+                    logger.exception("run_failed", lines=len(run))
+                    for message in run:
+                        self._dead_letter(message, e)
+                    return
+                if batchrefs is not None:
+                    self.metrics["handled"] += len(run)
+                    return
+        for message in run:
+            self._handle(message)
+
+    def _handle(self, message: brokers.BrokerMessage) -> None:
+        try:
+            event = brokers.decode(message.fields)
+            self.bus.handle(event, self.uow_factory())
+        except Exception as e:
+            logger.exception("message_failed", id=message.id, stream=message.stream)
+            self._dead_letter(message, e)
+        else:
+            self.metrics["handled"] += 1
+
+    def _dead_letter(self, message: brokers.BrokerMessage, error: Exception) -> None:
+        self.broker.publish(
+            dead_letter_stream(message.stream),
+            [{**message.fields, "error": repr(error), "id": message.id}],
+        )
+        self.metrics["dead_lettered"] += 1
+
+    def run(self, stop: Callable[[], bool] = lambda: False) -> None:
+        """Consumes until ``stop()``; reads block for up to ``block_ms``."""
+        while not stop():
+            self.consume_batch()
@@ -6,5 +6,5 @@ class AbstractEmailSender:
     def send(self, to: str, message: str): ...
 
 
-def send(*args):
+def send(*args, idempotency_key=None):
     print("SENDING EMAIL:", *args)
@@ -0,0 +1,175 @@
+"""
+Group commit: messages handled on different threads, each of which would pay
+for a commit of its own, are gathered for up to ``window`` seconds and handled
+one after another in one transaction, so one commit (and one fsync) covers
+them all.
+
+Each message gets a GroupedUnitOfWork, a savepoint in the shared transaction,
+so a handler that fails only undoes its own work and only its caller sees the
+error. If the group's commit itself fails, every message that had succeeded is
+handled again alone, in a unit of work of its own, and its caller gets that
+outcome instead.
+
+A caller waits for the group to commit, so it trades up to ``window`` of
+latency for fewer commits. Handlers run before the group commits, and again
+if it fails: keep side effects outside the database in the outbox (see
+``outbox_dispatcher``), as Allocated and OutOfStock are. Their outbox rows are
+rolled back with the group, so each is delivered once. A bus with in-line
+handlers that reach outside the database would repeat them.
+"""
+
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import List, Optional
+
+from cosmicpython import config, logs
+from cosmicpython.adapters import cache
+from cosmicpython.domain import events
+from cosmicpython.service_layer.unit_of_work import (
+    GroupedUnitOfWork,
+    SqlAlchemyUnitOfWork,
+    refresh_cache,
+)
+
+logger = logs.get_logger(__name__)
+
+
+class GroupCommitter:
+    """
+    Handles ``submit``-ted messages on ``bus``, up to ``max_group`` of them in
+    one transaction, on a thread of its own. The units of work share
+    ``session_factory``, ``product_cache`` and ``metrics``, with the same
+    defaults as SqlAlchemyUnitOfWork. Close it, or use it as a context
+    manager, to stop the thread once what was submitted is handled.
+    """
+
+    def __init__(
+        self,
+        bus,
+        session_factory=None,
+        product_cache=None,
+        metrics=None,
+        window: float = 0.002,
+        max_group: int = 100,
+    ):
+        self.bus = bus
+        self.session_factory = session_factory
+        if product_cache is None:
+            product_cache = config.get_product_cache()
+        self.product_cache = product_cache
+        self.uow_metrics = config.get_metrics() if metrics is None else metrics
+        self.window = window
+        self.max_group = max_group
+        self._pending = queue.Queue()  # type: queue.Queue
+        # groups, messages, failed, group_failures
+        self.metrics = Counter()  # type: Counter[str]
+        self._thread = threading.Thread(
+            target=self._run, name="group-commit", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, event: events.Event) -> Future:
+        """A Future of what ``bus.handle`` returns, set once the group commits."""
+        future = Future()
+        self._pending.put((event, future))
+        return future
+
+    def handle(self, event: events.Event):
+        return self.submit(event).result()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        self._pending.put(None)
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            group = [self._pending.get()]
+            if group[0] is None:
+                break
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_group:
+                try:
+                    item = self._pending.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            self._handle_group(group)
+
+    def _uow(self) -> SqlAlchemyUnitOfWork:
+        return SqlAlchemyUnitOfWork(
+            self.session_factory, self.product_cache, self.uow_metrics
+        )
+
+    def _handle_group(self, group: List[tuple]) -> None:
+        if self.session_factory is None:
+            self.session_factory = config.get_session_factory()
+        self.metrics["groups"] += 1
+        self.metrics["messages"] += len(group)
+        outcomes = []
+        session = self.session_factory()
+        seen = set()
+        try:
+            for event, _ in group:
+                uow = GroupedUnitOfWork(
+                    session,
+                    self.session_factory,
+                    self.product_cache,
+                    self.uow_metrics,
+                )
+                try:
+                    outcomes.append((self.bus.handle(event, uow), None))
+                except Exception as e:
+                    outcomes.append((None, e))
+                seen.update(uow.seen)
+            self._commit(session, seen)
+        except Exception:
+            logger.exception("group_commit_failed", messages=len(group))
+            self.metrics["group_failures"] += 1
+            session.rollback()
+            outcomes = [
+                self._handle_alone(event) if error is None else (None, error)
+                for (event, _), (_, error) in zip(group, outcomes)
+            ]
+        finally:
+            session.close()
+        for (_, future), (result, error) in zip(group, outcomes):
+            if error is None:
+                future.set_result(result)
+            else:
+                self.metrics["failed"] += 1
+                future.set_exception(error)
+
+    def _commit(self, session, seen: set) -> None:
+        if self.product_cache is None:
+            session.commit()
+            return
+        # as in SqlAlchemyUnitOfWork: drop what we saw unless the commit works
+        snapshots = dict.fromkeys(product.sku for product in seen)
+        try:
+            session.flush()
+            flushed = {product.sku: cache.snapshot(product) for product in seen}
+            session.commit()
+            snapshots = flushed
+        finally:
+            refresh_cache(self.product_cache, snapshots)
+
+    def _handle_alone(self, event: events.Event) -> tuple:
+        try:
+            return self.bus.handle(event, self._uow()), None
+        except Exception as e:
+            return None, e
@@ -1,62 +1,211 @@
-import logging
-import pprint
+from typing import Optional
 
+from cosmicpython import logs
+from cosmicpython.adapters.idempotency import AllocationRecord, IdempotencyKeyReused
 from cosmicpython.domain import events, models
 from cosmicpython.domain.models import InvalidSku, OrderLine
-from cosmicpython.service_layer import unit_of_work
+from cosmicpython.service_layer import email, unit_of_work
+
+logger = logs.get_logger(__name__)
 
 
 def add_batch(
     event: events.BatchCreated,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
-
-    print(
-        f"Batch created with ref: {event.ref}, SKU: {event.sku}, Quantity: {event.qty}, ETA: {event.eta}"
-    )
     with uow:
         product = uow.products.get(sku=event.sku)
         if product is None:
             product = models.Product(event.sku, batches=[])
             uow.products.add(product)
-        logging.info("Add batch structure:\n%s", pprint.pformat(product))
         batch = models.Batch(event.ref, event.sku, event.qty, event.eta)
-        product.batches.append(batch)
+        product.add_batch(batch)
         uow.commit()
+        logger.debug(
+            "batch_added", ref=event.ref, sku=event.sku, qty=event.qty, eta=event.eta
+        )
         return batch
 
 
+def add_batches(
+    event: events.BatchesCreated,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> int:
+    # bulk ingestion: written without loading the products, see batch_loader
+    with uow:
+        uow.batch_loader.load(event.batches)
+        uow.commit()
+        return len(event.batches)
+
+
+def replay(done: AllocationRecord, line: OrderLine, key: str) -> str:
+    """The batchref an earlier request with ``key`` got, if it was for ``line``."""
+    if not done.matches(line):
+        raise IdempotencyKeyReused(key)
+    logger.debug("replayed", orderid=line.orderid, key=key)
+    return done.batchref
+
+
 def allocate(
     event: events.AllocationRequired,
     uow: unit_of_work.AbstractUnitOfWork,
+    lock: Optional[str] = None,
 ) -> str | None:
     line = OrderLine(event.orderid, event.sku, event.qty)
+    key = event.idempotency_key
 
     with uow:
-        product = uow.products.get(sku=line.sku)
+        if key is not None:
+            # a retry: answer it without loading the product
+            done = uow.idempotency.get(key)
+            if done is not None:
+                return replay(done, line, key)
+        product = uow.products.get(sku=line.sku, lock=lock)
         if product is None:
             raise InvalidSku(line.sku)
 
-        batchref = product.allocate(line)
+        with uow.metrics.timer("domain_call_seconds", call="allocate"):
+            batchref = product.allocate(line)
+        if key is not None and batchref is not None:
+            uow.idempotency.add(
+                key, AllocationRecord(line.orderid, line.sku, line.qty, batchref)
+            )
         uow.commit()
+        logger.debug(
+            "allocated", orderid=line.orderid, sku=line.sku, batchref=batchref
+        )
         return batchref
 
 
+# What allocate_all raises for a bad line, before anything is committed: the
+# other lines can still be allocated on their own.
+LINE_REJECTED = (InvalidSku, IdempotencyKeyReused)
+
+
+def allocate_many(
+    event: events.AllocationsRequired,
+    uow: unit_of_work.AbstractUnitOfWork,
+    lock: Optional[str] = None,
+) -> list[str | None]:
+    return allocate_all(event.lines, uow, lock=lock)
+
+
+def allocate_all(
+    batch: list[events.AllocationRequired],
+    uow: unit_of_work.AbstractUnitOfWork,
+    lock: Optional[str] = None,
+) -> list[str | None]:
+    """
+    Allocates every line in one unit of work, loading each SKU's product once.
+    Returns the batchref (or None when out of stock) for each line, in order.
+
+    Also the bus's batch handler for runs of AllocationRequired events, such as
+    the reallocations a shrunk batch emits. An unknown SKU, or an idempotency
+    key reused for another line, fails the whole run before anything is
+    allocated. Lines whose key was used before get its batchref back, as in
+    ``allocate``.
+    """
+    lines = [OrderLine(e.orderid, e.sku, e.qty) for e in batch]
+    keys = [e.idempotency_key for e in batch]
+
+    with uow:
+        # retries: answered from their records, without loading the product
+        done = {}
+        for key in dict.fromkeys(key for key in keys if key is not None):
+            record = uow.idempotency.get(key)
+            if record is not None:
+                done[key] = record
+        products = {}
+        for sku in dict.fromkeys(
+            line.sku for line, key in zip(lines, keys) if key not in done
+        ):
+            product = uow.products.get(sku=sku, lock=lock)
+            if product is None:
+                raise InvalidSku(sku)
+            products[sku] = product
+
+        batchrefs = []
+        with uow.metrics.timer("domain_call_seconds", call="allocate_all"):
+            for line, key in zip(lines, keys):
+                if key in done:
+                    batchrefs.append(replay(done[key], line, key))
+                    continue
+                batchref = products[line.sku].allocate(line)
+                if key is not None and batchref is not None:
+                    # a repeat of the key further on replays this one
+                    done[key] = AllocationRecord(
+                        line.orderid, line.sku, line.qty, batchref
+                    )
+                    uow.idempotency.add(key, done[key])
+                batchrefs.append(batchref)
+        uow.commit()
+        logger.debug(
+            "allocated_many",
+            lines=len(lines),
+            skus=len(products),
+            out_of_stock=logs.lazy(batchrefs.count, None),
+        )
+        return batchrefs
+
+
+def deallocate(
+    event: events.DeallocationRequired,
+    uow: unit_of_work.AbstractUnitOfWork,
+    lock: Optional[str] = None,
+):
+    line = OrderLine(event.orderid, event.sku, event.qty)
+
+    with uow:
+        product = uow.products.get(sku=line.sku, lock=lock)
+        if product is None:
+            raise InvalidSku(line.sku)
+
+        with uow.metrics.timer("domain_call_seconds", call="deallocate"):
+            product.deallocate(line)
+        uow.commit()
+        logger.debug("deallocated", orderid=line.orderid, sku=line.sku)
+
+
 def change_batch_quantity(
     event: events.BatchQuantityChanged,
     uow: unit_of_work.AbstractUnitOfWork,
+    lock: Optional[str] = None,
 ):
     with uow:
-        product = uow.products.get_by_batchref(batchref=event.ref)
-        product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        product = uow.products.get_by_batchref(batchref=event.ref, lock=lock)
+        with uow.metrics.timer("domain_call_seconds", call="change_batch_quantity"):
+            product.change_batch_quantity(ref=event.ref, qty=event.qty)
         uow.commit()
+        logger.debug("batch_quantity_changed", ref=event.ref, qty=event.qty)
 
 
 def send_out_of_stock_notification(
     event: events.OutOfStock,
-    uow: unit_of_work.AbstractUnitOfWork,
+    uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
+    idempotency_key: Optional[str] = None,
 ):
-    print(
+    # the outbox worker passes the message's idempotency key so a redelivered
+    # notification can be recognised downstream
+    email.send(
         "stock@made.com",
         f"Out of stock for {event.sku}",
+        idempotency_key=idempotency_key,
     )
+
+
+def add_allocations_to_read_model(
+    batch: list[events.Allocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.allocations_view.add(batch)
+        uow.commit()
+
+
+def remove_allocations_from_read_model(
+    batch: list[events.Deallocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.allocations_view.remove(batch)
+        uow.commit()
@@ -0,0 +1,183 @@
+"""
+Bulk ingestion of inbound shipments: a CSV or NDJSON stream of batches, one per
+line, handed to the message bus as a BatchesCreated per ``chunk_size`` rows.
+
+Only one chunk is held in memory at a time. Each chunk commits on its own, so a
+bad row or a batch that already exists stops the ingest with the chunks before
+it loaded; the error says which line it got to.
+"""
+
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from itertools import islice
+from typing import AsyncIterable, Callable, Iterable, Iterator, List, Optional
+
+from cosmicpython.domain import events
+
+
+class InvalidShipmentRow(Exception):
+    def __init__(self, line: int, reason: str) -> None:
+        super().__init__(f"Line {line}: {reason}")
+        self.line = line
+
+
+class IngestFailed(Exception):
+    """Raised with the original error as its cause, once some chunks may be in."""
+
+    def __init__(self, report: "IngestReport", error: Exception) -> None:
+        super().__init__(f"Ingest stopped after {report.rows} rows: {error}")
+        self.report = report
+
+
+def batch_created(line: int, row: dict) -> events.BatchCreated:
+    # ref, sku and qty are required; eta may be blank or missing
+    try:
+        ref, sku, qty = row["ref"], row["sku"], row["qty"]
+        eta = row.get("eta") or None
+        return events.BatchCreated(
+            ref=str(ref),
+            sku=str(sku),
+            qty=int(qty),
+            eta=date.fromisoformat(eta) if isinstance(eta, str) else eta,
+        )
+    except KeyError as e:
+        raise InvalidShipmentRow(line, f"missing {e.args[0]}") from None
+    except (TypeError, ValueError) as e:
+        raise InvalidShipmentRow(line, str(e)) from None
+
+
+class CsvReader:
+    """
+    Reads rows from lines of CSV with a header naming at least ref, sku and qty.
+    Keeps its place across calls, so a stream can be fed in pieces.
+    """
+
+    def __init__(self) -> None:
+        self.header: Optional[List[str]] = None
+        self.line = 0
+
+    def rows(self, lines: Iterable[str]) -> Iterator[events.BatchCreated]:
+        for values in csv.reader(lines):
+            self.line += 1
+            if not values:
+                continue
+            if self.header is None:
+                self.header = [name.strip() for name in values]
+                continue
+            if len(values) != len(self.header):
+                raise InvalidShipmentRow(
+                    self.line,
+                    f"expected {len(self.header)} fields, got {len(values)}",
+                )
+            yield batch_created(self.line, dict(zip(self.header, values)))
+
+
+class NdjsonReader:
+    """Reads rows from lines holding one JSON object each."""
+
+    def __init__(self) -> None:
+        self.line = 0
+
+    def rows(self, lines: Iterable[str]) -> Iterator[events.BatchCreated]:
+        for text in lines:
+            self.line += 1
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except json.JSONDecodeError as e:
+                raise InvalidShipmentRow(self.line, str(e)) from None
+            if not isinstance(row, dict):
+                raise InvalidShipmentRow(self.line, "expected a JSON object")
+            yield batch_created(self.line, row)
+
+
+READERS = {"csv": CsvReader, "ndjson": NdjsonReader}
+
+
+def reader_for(format: str):
+    try:
+        return READERS[format]()
+    except KeyError:
+        raise ValueError(f"Unknown shipment format {format!r}") from None
+
+
+@dataclass
+class IngestReport:
+    rows: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def add(self, rows: int) -> None:
+        self.rows += rows
+        self.chunks += 1
+        self.seconds = time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def chunks(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def ingest(
+    lines: Iterable[str],
+    bus,
+    uow_factory: Callable,
+    format: str = "csv",
+    chunk_size: int = 5000,
+) -> IngestReport:
+    """Loads every batch in ``lines``, through ``bus``, a chunk per unit of work."""
+    report = IngestReport()
+    try:
+        for chunk in chunks(reader_for(format).rows(lines), chunk_size):
+            bus.handle(events.BatchesCreated(chunk), uow_factory())
+            report.add(len(chunk))
+    except Exception as e:
+        raise IngestFailed(report, e) from e
+    return report
+
+
+async def ingest_async(
+    byte_chunks: AsyncIterable[bytes],
+    bus,
+    uow_factory: Callable,
+    format: str = "csv",
+    chunk_size: int = 5000,
+) -> IngestReport:
+    """``ingest`` for an async byte stream, such as a request body."""
+    reader = reader_for(format)
+    report = IngestReport()
+    pending: List[events.BatchCreated] = []
+    try:
+        async for lines in split_lines(byte_chunks):
+            pending.extend(reader.rows(lines))
+            while len(pending) >= chunk_size:
+                chunk, pending = pending[:chunk_size], pending[chunk_size:]
+                await bus.handle(events.BatchesCreated(chunk), uow_factory())
+                report.add(len(chunk))
+        if pending:
+            await bus.handle(events.BatchesCreated(pending), uow_factory())
+            report.add(len(pending))
+    except Exception as e:
+        raise IngestFailed(report, e) from e
+    return report
+
+
+async def split_lines(byte_chunks: AsyncIterable[bytes]) -> AsyncIterable[List[str]]:
+    """The complete lines in each piece of a UTF-8 byte stream."""
+    partial = b""
+    async for data in byte_chunks:
+        *lines, partial = (partial + data).split(b"\n")
+        if lines:
+            yield [line.decode().rstrip("\r") for line in lines]
+    if partial:
+        yield [partial.decode().rstrip("\r")]
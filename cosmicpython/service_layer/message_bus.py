@@ -1,25 +1,223 @@
+import asyncio
+import random
+import time
 from abc import abstractmethod
-from collections.abc import Callable
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
 from typing import Dict, List, Type
 
+from cosmicpython import config, logs
+from cosmicpython.adapters.idempotency import IdempotencyKeyInFlight
+from cosmicpython.adapters.metrics import AbstractMetrics
+from cosmicpython.adapters.repository import ProductLocked
 from cosmicpython.domain import events
-from cosmicpython.service_layer import handlers, services
-from cosmicpython.service_layer.unit_of_work import AbstractUnitOfWork
+from cosmicpython.service_layer import async_handlers, handlers
+from cosmicpython.service_layer.background import (
+    AsyncHandlerTasks,
+    ThreadedHandlerPool,
+)
+from cosmicpython.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
+    AbstractUnitOfWork,
+    ConcurrencyConflict,
+)
+
+logger = logs.get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How often a handler is re-run after one of ``RETRY_ON``, and how long to
+    wait in between: ``backoff * multiplier ** (retry - 1)``, capped at
+    ``max_backoff`` and spread by up to ``jitter`` of itself.
+    """
+
+    attempts: int = 3
+    backoff: float = 0.01
+    multiplier: float = 2.0
+    max_backoff: float = 0.5
+    jitter: float = 0.5
+
+    def delay(self, retry: int) -> float:
+        delay = min(self.backoff * self.multiplier ** (retry - 1), self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+# Raised when another transaction got to the aggregate, or to the idempotency
+# key, first; worth a retry.
+RETRY_ON = (ConcurrencyConflict, ProductLocked, IdempotencyKeyInFlight)
+
+
+def allocate_together(
+    bus: "AbstractMessageBus",
+    lines: List[events.AllocationRequired],
+    uow: AbstractUnitOfWork,
+) -> List[str | None] | None:
+    """
+    The batchrefs ``bus`` allocates ``lines`` with as one AllocationsRequired, or
+    None if it rejected one of them (``handlers.LINE_REJECTED``) before committing
+    anything, so the rest can still be allocated one at a time. Anything else is
+    raised: by then part of the work may be committed, and allocating the lines
+    again could allocate some of them twice.
+    """
+    try:
+        [batchrefs, *_] = bus.handle(events.AllocationsRequired(lines), uow)
+    except handlers.LINE_REJECTED as e:
+        logger.info("lines_rejected", lines=len(lines), error=type(e).__name__)
+        return None
+    return batchrefs
+
+
+def count_events(metrics: AbstractMetrics, event: events.Event, count: int = 1):
+    if count:
+        metrics.increment("bus_events_total", count, event=type(event).__name__)
+
+
+def take_run(event: events.Event, queue: deque) -> List[events.Event]:
+    """``event`` plus every event of the same type waiting at the head of the queue."""
+    run = [event]
+    while queue and type(queue[0]) is type(event):
+        run.append(queue.popleft())
+    return run
+
+
+def handler_options(bus, handler) -> dict:
+    """``bus.handler_options`` for ``handler``, or for what it takes them from."""
+    if handler not in bus.handler_options and handler in bus.OPTIONS_FROM:
+        handler = bus.OPTIONS_FROM[handler]
+    return bus.handler_options.get(handler, {})
 
 
 class AbstractMessageBus:
+    """
+    ``handler_options`` passes extra keyword arguments to particular handlers,
+    e.g. ``{handlers.allocate: {"lock": "nowait"}}`` to allocate under a row lock
+    instead of relying on the optimistic version check. A handler in
+    ``OPTIONS_FROM`` with no options of its own gets those of the handler it maps
+    to, so that lock also applies when the lines go to ``allocate_all`` or
+    ``allocate_many`` together.
+
+    ``BATCH_HANDLERS`` take a list of events. When several events of such a type
+    are queued back to back (e.g. the AllocationRequired cascade of a shrunk
+    batch), they go to the batch handlers in one call, which returns a result
+    per event, instead of to ``HANDLERS`` one at a time. Types with no
+    ``HANDLERS`` entry go to their batch handlers even one at a time; those
+    returning None (e.g. read model updates) add nothing to the results.
+
+    ``FIRE_AND_FORGET`` handlers (side effects such as notifications) are handed
+    to ``background`` instead of run in line, at most as many at once as the
+    number they map to, on their own ``uow.clone()``. They add nothing to the
+    results, their errors are logged rather than raised, and events they raise
+    are not handled. ``join`` waits for them.
+
+    ``request_metrics`` (by default ``config.get_metrics()``) records the events
+    handled, each handler's latency and errors, and the queries sent per
+    ``handle``. ``metrics`` counts conflicts and retries.
+    """
+
     HANDLERS: Dict[Type[events.Event], List[Callable]]
+    BATCH_HANDLERS: Dict[Type[events.Event], List[Callable]] = {}
+    FIRE_AND_FORGET: Dict[Callable, int] = {}
+    OPTIONS_FROM: Dict[Callable, Callable] = {}
+
+    def __init__(
+        self,
+        retry: RetryPolicy = RetryPolicy(),
+        sleep=time.sleep,
+        handler_options: Dict[Callable, dict] | None = None,
+        background: ThreadedHandlerPool | None = None,
+        request_metrics: AbstractMetrics | None = None,
+    ):
+        self.retry = retry
+        self._sleep = sleep
+        self.handler_options = handler_options or {}
+        self.background = background or ThreadedHandlerPool()
+        if request_metrics is None:
+            request_metrics = config.get_metrics()
+        self.request_metrics = request_metrics
+        # conflicts, retries, retries_exhausted
+        self.metrics = Counter()  # type: Counter[str]
 
     def handle(self, event: events.Event, uow: AbstractUnitOfWork):
+        with self.request_metrics.count_queries():
+            return self._handle(event, uow)
+
+    def _handle(self, event: events.Event, uow: AbstractUnitOfWork):
         results = []
-        queue = [event]
+        queue = deque([event])
         while queue:
-            event = queue.pop(0)
+            event = queue.popleft()
+            logger.debug("handling", event=type(event).__name__, queued=len(queue))
+            count_events(self.request_metrics, event)
+            if type(event) in self.BATCH_HANDLERS:
+                run = take_run(event, queue)
+                count_events(self.request_metrics, event, len(run) - 1)
+                if len(run) > 1 or type(event) not in self.HANDLERS:
+                    for handler in self.BATCH_HANDLERS[type(event)]:
+                        batch_results = self._run_handler(handler, run, uow)
+                        results.extend(batch_results or [])
+                        self._handle_new_events(queue, uow.collect_new_events())
+                    continue
             for handler in self.HANDLERS[type(event)]:
-                results.append(handler(event, uow=uow))
+                if handler in self.FIRE_AND_FORGET:
+                    self.background.submit(
+                        handler,
+                        self.FIRE_AND_FORGET[handler],
+                        self._run_handler,
+                        handler,
+                        event,
+                        uow.clone(),
+                    )
+                    continue
+                results.append(self._run_handler(handler, event, uow))
                 self._handle_new_events(queue, uow.collect_new_events())
         return results
 
+    def join(self, timeout: float | None = None) -> bool:
+        return self.background.join(timeout)
+
+    def _run_handler(self, handler, event, uow):
+        name = handler.__name__
+        with self.request_metrics.timer("bus_handler_seconds", handler=name):
+            try:
+                return self._run_with_retries(handler, event, uow)
+            except Exception as e:
+                self.request_metrics.increment(
+                    "bus_handler_errors_total", handler=name, error=type(e).__name__
+                )
+                raise
+
+    def _run_with_retries(self, handler, event, uow):
+        # every handler opens its own unit of work, so a retry reloads the
+        # aggregate and re-applies the change on top of the winning commit
+        options = handler_options(self, handler)
+        retry = 0
+        while True:
+            try:
+                return handler(event, uow=uow, **options)
+            except RETRY_ON as e:
+                self.metrics["conflicts"] += 1
+                retry += 1
+                if retry >= self.retry.attempts:
+                    self.metrics["retries_exhausted"] += 1
+                    logger.warning(
+                        "retries_exhausted",
+                        handler=handler.__name__,
+                        attempts=retry,
+                        error=type(e).__name__,
+                    )
+                    raise
+                self.metrics["retries"] += 1
+                logger.info(
+                    "retrying",
+                    handler=handler.__name__,
+                    retry=retry,
+                    error=type(e).__name__,
+                )
+                self._sleep(self.retry.delay(retry))
+
     @abstractmethod
     def _handle_new_events(self, queue, events): ...
 
@@ -28,9 +226,155 @@ class MessageBus(AbstractMessageBus):
     HANDLERS = {
         events.OutOfStock: [handlers.send_out_of_stock_notification],
         events.BatchCreated: [handlers.add_batch],
+        events.BatchesCreated: [handlers.add_batches],
         events.AllocationRequired: [handlers.allocate],
+        events.AllocationsRequired: [handlers.allocate_many],
+        events.DeallocationRequired: [handlers.deallocate],
         events.BatchQuantityChanged: [handlers.change_batch_quantity],
     }
+    BATCH_HANDLERS = {
+        events.AllocationRequired: [handlers.allocate_all],
+        events.Allocated: [handlers.add_allocations_to_read_model],
+        events.Deallocated: [handlers.remove_allocations_from_read_model],
+    }
+    FIRE_AND_FORGET = {
+        handlers.send_out_of_stock_notification: 4,
+    }
+    OPTIONS_FROM = {
+        handlers.allocate_all: handlers.allocate,
+        handlers.allocate_many: handlers.allocate,
+    }
+
+    def _handle_new_events(self, queue, events):
+        queue.extend(events)
+
+
+class AbstractAsyncMessageBus:
+    HANDLERS: Dict[Type[events.Event], List[Callable[..., Awaitable]]]
+    BATCH_HANDLERS: Dict[Type[events.Event], List[Callable[..., Awaitable]]] = {}
+
+    FIRE_AND_FORGET: Dict[Callable, int] = {}
+    OPTIONS_FROM: Dict[Callable, Callable] = {}
+
+    def __init__(
+        self,
+        retry: RetryPolicy = RetryPolicy(),
+        sleep=asyncio.sleep,
+        handler_options: Dict[Callable, dict] | None = None,
+        background: AsyncHandlerTasks | None = None,
+        request_metrics: AbstractMetrics | None = None,
+    ):
+        self.retry = retry
+        self._sleep = sleep
+        self.handler_options = handler_options or {}
+        self.background = background or AsyncHandlerTasks()
+        if request_metrics is None:
+            request_metrics = config.get_metrics()
+        self.request_metrics = request_metrics
+        self.metrics = Counter()  # type: Counter[str]
+
+    async def handle(self, event: events.Event, uow: AbstractAsyncUnitOfWork):
+        with self.request_metrics.count_queries():
+            return await self._handle(event, uow)
+
+    async def _handle(self, event: events.Event, uow: AbstractAsyncUnitOfWork):
+        results = []
+        queue = deque([event])
+        while queue:
+            event = queue.popleft()
+            logger.debug("handling", event=type(event).__name__, queued=len(queue))
+            count_events(self.request_metrics, event)
+            if type(event) in self.BATCH_HANDLERS:
+                run = take_run(event, queue)
+                count_events(self.request_metrics, event, len(run) - 1)
+                if len(run) > 1 or type(event) not in self.HANDLERS:
+                    for handler in self.BATCH_HANDLERS[type(event)]:
+                        batch_results = await self._run_handler(handler, run, uow)
+                        results.extend(batch_results or [])
+                        self._handle_new_events(queue, uow.collect_new_events())
+                    continue
+            for handler in self.HANDLERS[type(event)]:
+                if handler in self.FIRE_AND_FORGET:
+                    await self.background.submit(
+                        handler,
+                        self.FIRE_AND_FORGET[handler],
+                        self._run_handler,
+                        handler,
+                        event,
+                        uow.clone(),
+                    )
+                    continue
+                results.append(await self._run_handler(handler, event, uow))
+                self._handle_new_events(queue, uow.collect_new_events())
+        return results
+
+    async def join(self) -> None:
+        await self.background.join()
+
+    async def _run_handler(self, handler, event, uow):
+        name = handler.__name__
+        with self.request_metrics.timer("bus_handler_seconds", handler=name):
+            try:
+                return await self._run_with_retries(handler, event, uow)
+            except Exception as e:
+                self.request_metrics.increment(
+                    "bus_handler_errors_total", handler=name, error=type(e).__name__
+                )
+                raise
+
+    async def _run_with_retries(self, handler, event, uow):
+        options = handler_options(self, handler)
+        retry = 0
+        while True:
+            try:
+                return await handler(event, uow=uow, **options)
+            except RETRY_ON as e:
+                self.metrics["conflicts"] += 1
+                retry += 1
+                if retry >= self.retry.attempts:
+                    self.metrics["retries_exhausted"] += 1
+                    logger.warning(
+                        "retries_exhausted",
+                        handler=handler.__name__,
+                        attempts=retry,
+                        error=type(e).__name__,
+                    )
+                    raise
+                self.metrics["retries"] += 1
+                logger.info(
+                    "retrying",
+                    handler=handler.__name__,
+                    retry=retry,
+                    error=type(e).__name__,
+                )
+                await self._sleep(self.retry.delay(retry))
+
+    @abstractmethod
+    def _handle_new_events(self, queue, events): ...
+
+
+class AsyncMessageBus(AbstractAsyncMessageBus):
+    HANDLERS = {
+        events.OutOfStock: [async_handlers.send_out_of_stock_notification],
+        events.BatchCreated: [async_handlers.add_batch],
+        events.BatchesCreated: [async_handlers.add_batches],
+        events.AllocationRequired: [async_handlers.allocate],
+        events.AllocationsRequired: [async_handlers.allocate_many],
+        events.DeallocationRequired: [async_handlers.deallocate],
+        events.BatchQuantityChanged: [async_handlers.change_batch_quantity],
+    }
+    BATCH_HANDLERS = {
+        events.AllocationRequired: [async_handlers.allocate_all],
+        events.Allocated: [async_handlers.add_allocations_to_read_model],
+        events.Deallocated: [async_handlers.remove_allocations_from_read_model],
+    }
+    FIRE_AND_FORGET = {
+        async_handlers.send_out_of_stock_notification: 4,
+    }
+    OPTIONS_FROM = {
+        async_handlers.allocate_all: async_handlers.allocate,
+        async_handlers.allocate_many: async_handlers.allocate,
+    }
 
     def _handle_new_events(self, queue, events):
         queue.extend(events)
@@ -0,0 +1,104 @@
+import functools
+import logging
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Type
+
+from cosmicpython import config
+from cosmicpython.adapters import outbox
+from cosmicpython.adapters.broker import AbstractBroker
+from cosmicpython.domain import events
+from cosmicpython.service_layer import handlers
+
+logger = logging.getLogger(__name__)
+
+# Called as handler(event, idempotency_key=...) for each outbox message.
+EXTERNAL_HANDLERS: Dict[Type[events.Event], List[Callable]] = {
+    events.OutOfStock: [handlers.send_out_of_stock_notification],
+    # only published, see external_handlers
+    events.Allocated: [],
+}
+
+
+def publish(broker: AbstractBroker, event: events.Event, idempotency_key=None):
+    broker.publish_events([event], idempotency_key)
+
+
+def external_handlers(
+    broker: Optional[AbstractBroker] = None,
+) -> Dict[Type[events.Event], List[Callable]]:
+    """EXTERNAL_HANDLERS, each event also published to ``broker`` if there is one."""
+    if broker is None:
+        return EXTERNAL_HANDLERS
+    return {
+        type_: [*handlers_, functools.partial(publish, broker)]
+        for type_, handlers_ in EXTERNAL_HANDLERS.items()
+    }
+
+
+class OutboxDispatcher:
+    """
+    Delivers the events units of work wrote to the outbox, oldest first, in
+    batches of ``batch_size``, each in its own transaction.
+
+    Delivery is at least once: a message is only marked dispatched in the same
+    transaction that read it, after its handlers returned, so a worker dying in
+    between redelivers it. Handlers get the message's idempotency key to drop
+    such repeats. A handler that raises leaves the message pending with its
+    ``attempts`` bumped; after ``max_attempts`` it is no longer picked up.
+    """
+
+    def __init__(
+        self,
+        session_factory=None,
+        handlers: Dict[Type[events.Event], List[Callable]] | None = None,
+        batch_size: int = 100,
+        max_attempts: int = 10,
+    ):
+        self.session_factory = session_factory
+        self.handlers = EXTERNAL_HANDLERS if handlers is None else handlers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        # dispatched, failed
+        self.metrics = Counter()  # type: Counter[str]
+
+    def dispatch_batch(self) -> int:
+        """Delivers up to ``batch_size`` pending messages; returns how many it read."""
+        if self.session_factory is None:
+            self.session_factory = config.get_session_factory()
+        session = self.session_factory()
+        try:
+            box = outbox.SqlAlchemyOutbox(session)
+            messages = box.pending(self.batch_size, self.max_attempts)
+            delivered = []
+            for message in messages:
+                try:
+                    for handler in self.handlers[type(message.event)]:
+                        handler(
+                            message.event, idempotency_key=message.idempotency_key
+                        )
+                except Exception as e:
+                    logger.exception(
+                        "Delivering outbox message %s failed", message.idempotency_key
+                    )
+                    box.mark_failed(message.id, repr(e))
+                    self.metrics["failed"] += 1
+                else:
+                    delivered.append(message.id)
+            box.mark_dispatched(delivered)
+            session.commit()
+            self.metrics["dispatched"] += len(delivered)
+            return len(messages)
+        finally:
+            session.close()
+
+    def run(
+        self,
+        poll_interval: float = 1.0,
+        stop: Callable[[], bool] = lambda: False,
+        sleep=time.sleep,
+    ) -> None:
+        """Drains the outbox until ``stop()``, polling when it runs dry."""
+        while not stop():
+            if self.dispatch_batch() < self.batch_size:
+                sleep(poll_interval)
@@ -1,26 +1,31 @@
-import logging
-import pprint
-from typing import Optional
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import AsyncMessageBus, MessageBus
+from cosmicpython.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
+    AbstractUnitOfWork,
+)
 
-logging.basicConfig(level=logging.INFO)
+# Kept for callers from before the message bus. They only raise
+# DeallocationRequired, so Deallocated still reaches the read model.
 
-from cosmicpython.domain import events, models
-from cosmicpython.domain.models import OrderLine
-from cosmicpython.service_layer.unit_of_work import AbstractUnitOfWork, unit_of_work
 
+def deallocate(
+    orderid: str,
+    sku: str,
+    qty: int,
+    uow: AbstractUnitOfWork,
+    bus: MessageBus | None = None,
+):
+    bus = bus or MessageBus()
+    bus.handle(events.DeallocationRequired(orderid, sku, qty), uow)
 
-def deallocate(orderid: str, sku: str, qty: int, uow: AbstractUnitOfWork):
-    line = OrderLine(orderid, sku, qty)
-    with uow:
-        product = uow.products.get(sku=line.sku)
-        logging.info(
-            "Deallocate structure:\n%s",
-            pprint.pformat([b._allocations for b in product.batches]),
-        )
-        logging.info(f"Line profivided: {line.orderid}")
-        try:
-            product.deallocate(line)
-            uow.commit()
-        except models.NoBatchContainingOrderLine as e:
-            uow.rollback()
-            raise e
+
+async def deallocate_async(
+    orderid: str,
+    sku: str,
+    qty: int,
+    uow: AbstractAsyncUnitOfWork,
+    bus: AsyncMessageBus | None = None,
+):
+    bus = bus or AsyncMessageBus()
+    await bus.handle(events.DeallocationRequired(orderid, sku, qty), uow)
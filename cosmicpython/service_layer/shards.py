@@ -0,0 +1,250 @@
+"""
+Allocation on a pool of worker processes, each owning a share of the SKUs.
+
+An AllocationRequired goes to the worker ``shard_for(sku)`` picks, so a SKU is
+only ever allocated by one process and never contended between them, however
+many processes there are. Each worker keeps the Products it owns in its own
+product cache: as nothing else changes them, a load is just the version check.
+Workers take whatever is waiting in their queue, up to ``batch_size`` lines, and
+allocate it in one unit of work.
+
+This only holds if everything allocating those SKUs goes through the pool;
+anything else still works, as the version check catches it, but contends again.
+
+A worker that dies fails what it had been sent and not yet answered, and
+whatever is sent to it afterwards, with ShardError.
+"""
+
+import multiprocessing
+import queue
+import threading
+import zlib
+from collections import Counter
+from concurrent.futures import Future
+from dataclasses import dataclass
+from itertools import count
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cosmicpython import logs
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import allocate_together
+
+logger = logs.get_logger(__name__)
+
+
+class ShardError(Exception):
+    """An allocation failed in a worker, or its worker died; says which."""
+
+
+@dataclass(frozen=True)
+class WorkerExited:
+    """Queued behind whatever a worker sent before it exited."""
+
+    shard: int
+
+
+def shard_for(sku: str, shards: int) -> int:
+    # crc32 rather than hash(): it must agree between processes and restarts
+    return zlib.crc32(sku.encode()) % shards
+
+
+def take_waiting(inbox, first, limit: int) -> list:
+    """``first`` plus whatever else is already in ``inbox``, up to ``limit``."""
+    taken = [first]
+    while len(taken) < limit:
+        try:
+            item = inbox.get_nowait()
+        except queue.Empty:
+            break
+        taken.append(item)
+        if item is None:
+            break
+    return taken
+
+
+def run_worker(inbox, results, batch_size: int, cache_size: int) -> None:
+    """A worker process: allocates what arrives in ``inbox`` until a None."""
+    # imported in the worker, which starts from scratch
+    from cosmicpython import config
+    from cosmicpython.adapters.cache import ProductCache
+    from cosmicpython.service_layer.message_bus import MessageBus
+    from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+    config.configure_logging()
+    config.start_mappers()
+    cache = ProductCache(max_size=cache_size, ttl=None)
+    bus = MessageBus()
+
+    def uow():
+        return SqlAlchemyUnitOfWork(product_cache=cache)
+
+    stopping = False
+    while not stopping:
+        requests = take_waiting(inbox, inbox.get(), batch_size)
+        if requests[-1] is None:
+            stopping = True
+            requests.pop()
+        if requests:
+            results.put(allocate(bus, uow, requests))
+    config.dispose_engine()
+
+
+def describe(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+def allocate(bus, uow: Callable, requests: List[tuple]) -> List[tuple]:
+    """(id, batchref, error) for each (id, AllocationRequired) in ``requests``."""
+    if len(requests) > 1:
+        lines = [line for _, line in requests]
+        try:
+            batchrefs = allocate_together(bus, lines, uow())
+        except Exception as e:
+            # some may be committed, so going one at a time could allocate twice
+            logger.exception("run_failed", lines=len(requests))
+            return [(id, None, describe(e)) for id, _ in requests]
+        if batchrefs is not None:
+            return [(id, ref, None) for (id, _), ref in zip(requests, batchrefs)]
+    outcomes = []
+    for id, line in requests:
+        try:
+            [batchref, *_] = bus.handle(line, uow())
+        except Exception as e:
+            outcomes.append((id, None, describe(e)))
+        else:
+            outcomes.append((id, batchref, None))
+    return outcomes
+
+
+class ShardedAllocator:
+    """
+    ``shards`` worker processes, fed by ``allocate``, which returns a Future of
+    the batchref (None when out of stock, ShardError when the worker failed or
+    died).
+    ``route(sku, shards)`` picks the worker, by default ``shard_for``. Close it,
+    or use it as a context manager, to stop the workers.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        batch_size: int = 100,
+        cache_size: int = 10_000,
+        route: Callable[[str, int], int] = shard_for,
+    ):
+        context = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self.route = route
+        self._results = context.Queue()
+        self._inboxes = [context.Queue() for _ in range(shards)]
+        self._workers = [
+            context.Process(
+                target=run_worker,
+                args=(inbox, self._results, batch_size, cache_size),
+                daemon=True,
+            )
+            for inbox in self._inboxes
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._ids = count()
+        # by id: the shard it went to and its future
+        self._futures: Dict[int, Tuple[int, Future]] = {}
+        # the shards whose worker exited, and how
+        self._exited: Dict[int, Optional[int]] = {}
+        self._lock = threading.Lock()
+        # allocated, out_of_stock, failed
+        self.metrics = Counter()  # type: Counter[str]
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+        self._watcher = threading.Thread(target=self._watch_workers, daemon=True)
+        self._watcher.start()
+
+    def allocate(self, orderid: str, sku: str, qty: int) -> Future:
+        future = Future()
+        shard = self.route(sku, self.shards)
+        with self._lock:
+            exited = shard in self._exited
+            if not exited:
+                id = next(self._ids)
+                self._futures[id] = (shard, future)
+        if exited:
+            self._fail([future], self._exited_error(shard))
+            return future
+        line = events.AllocationRequired(orderid, sku, qty)
+        self._inboxes[shard].put((id, line))
+        return future
+
+    def _watch_workers(self) -> None:
+        running = {
+            worker.sentinel: shard for shard, worker in enumerate(self._workers)
+        }
+        while running:
+            for sentinel in wait(list(running)):
+                shard = running.pop(sentinel)
+                # behind its last results, so those are set before the rest fail
+                self._results.put(WorkerExited(shard))
+
+    def _read_results(self) -> None:
+        while (outcomes := self._results.get()) is not None:
+            if isinstance(outcomes, WorkerExited):
+                self._worker_exited(outcomes)
+                continue
+            for id, batchref, error in outcomes:
+                with self._lock:
+                    _, future = self._futures.pop(id)
+                if error is not None:
+                    self.metrics["failed"] += 1
+                    future.set_exception(ShardError(error))
+                    continue
+                self.metrics["allocated" if batchref else "out_of_stock"] += 1
+                future.set_result(batchref)
+
+    def _worker_exited(self, exited: WorkerExited) -> None:
+        shard = exited.shard
+        exitcode = self._workers[shard].exitcode
+        with self._lock:
+            self._exited[shard] = exitcode
+            lost = [
+                id for id, (sent_to, _) in self._futures.items() if sent_to == shard
+            ]
+            futures = [self._futures.pop(id)[1] for id in lost]
+        if futures:
+            logger.error(
+                "shard_exited",
+                shard=shard,
+                exitcode=exitcode,
+                unanswered=len(futures),
+            )
+        # nothing reads its inbox any more, so don't wait to flush it at exit
+        self._inboxes[shard].cancel_join_thread()
+        self._fail(futures, self._exited_error(shard))
+
+    def _exited_error(self, shard: int) -> ShardError:
+        return ShardError(f"Shard {shard} exited with code {self._exited[shard]}")
+
+    def _fail(self, futures: List[Future], error: ShardError) -> None:
+        for future in futures:
+            self.metrics["failed"] += 1
+            future.set_exception(error)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        self._watcher.join(timeout)
+        self._results.put(None)
+        self._reader.join(timeout)
+        # only left if a worker outlived the timeout
+        with self._lock:
+            futures = [future for _, future in self._futures.values()]
+            self._futures.clear()
+        self._fail(futures, ShardError("The allocator closed before answering"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,17 +1,51 @@
 import abc
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import insert
+from sqlalchemy.orm.exc import StaleDataError
 
 from cosmicpython import config
-from cosmicpython.adapters import repository
+from cosmicpython.adapters import (
+    batch_loader,
+    cache,
+    idempotency,
+    orm,
+    outbox,
+    read_model,
+    repository,
+)
+from cosmicpython.adapters.metrics import AbstractMetrics, NoopMetrics
+
+
+class ConcurrencyConflict(Exception):
+    """Another transaction changed an aggregate we loaded before we committed."""
+
+
+def take_external_events(products: repository.AbstractProductRepository) -> list:
+    """Removes the events bound for the outbox from the products that have any."""
+    external = []
+    # left dirty: their internal events are still to be collected
+    for product in products.tracked.dirty:
+        internal = []
+        for event in product.events:
+            if outbox.is_external(event):
+                external.append(event)
+            if outbox.is_internal(event):
+                internal.append(event)
+        product.events = internal
+    return external
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractProductRepository
+    allocations_view: read_model.AbstractAllocationsView
+    batch_loader: batch_loader.AbstractBatchLoader
+    idempotency: idempotency.AbstractIdempotencyStore
+    metrics: AbstractMetrics = NoopMetrics()
 
-    def __exit__(self, *_):
+    def __exit__(self, exc_type, *_):
+        if exc_type is not None:
+            self.metrics.increment("uow_rollbacks_total", reason=exc_type.__name__)
         self.rollback()
 
     @abc.abstractmethod
@@ -19,12 +53,21 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
     def commit(self):
-        self._commit()
+        with self.metrics.timer("uow_commit_seconds"):
+            self._commit()
+
+    @abc.abstractmethod
+    def clone(self) -> "AbstractUnitOfWork":
+        """A unit of work on the same storage, safe to use from another thread."""
+        raise NotImplementedError
 
     def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        # only the products that recorded events since the last collection
+        for product in self.products.tracked.take_dirty():
+            # hand over the whole list rather than popping from its front, which
+            # is quadratic when a batch shrink reallocates thousands of lines
+            events, product.events = product.events, []
+            yield from events
 
     @abc.abstractmethod
     def rollback(self):
@@ -34,24 +77,32 @@ class AbstractUnitOfWork(abc.ABC):
         return self
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-    )
-)
+def snapshot_seen(products: repository.AbstractProductRepository) -> dict:
+    """Snapshots of every product we've seen, by SKU, taken after a flush."""
+    return {product.sku: cache.snapshot(product) for product in products.seen}
+
+
+def refresh_cache(product_cache: cache.ProductCache, snapshots: dict) -> None:
+    """Caches each snapshot; a None snapshot or no snapshot at all drops the SKU."""
+    for sku, snapshot in snapshots.items():
+        if snapshot is None:
+            product_cache.invalidate(sku)
+        else:
+            product_cache.put(snapshot)
 
 
 @contextmanager
-def unit_of_work(session_factory=DEFAULT_SESSION_FACTORY):
+def unit_of_work(session_factory=None):
     """
     Function based contextmanager that does the exact same behavior as the
     below object version. This one has an implicit rather than explicit commit,
     however.
 
     Args:
-        session_factory (sessionmaker): factory for creating sessions
+        session_factory (sessionmaker): factory for creating sessions, defaults
+            to the shared one from ``config`` (created on first use)
     """
-    session = session_factory()
+    session = (session_factory or config.get_session_factory())()
     batches = repository.SQLAlchemyRepository(session)
     try:
         yield batches
@@ -63,32 +114,277 @@ def unit_of_work(session_factory=DEFAULT_SESSION_FACTORY):
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY) -> None:
+    """
+    ``product_cache`` (by default ``config.get_product_cache()``) is shared with
+    the repository, and refreshed with the products this unit of work saw once
+    they are committed. ``idempotency_cache`` (by default
+    ``config.get_idempotency_cache()``) likewise gets the idempotency records
+    it committed. ``metrics`` defaults to ``config.get_metrics()``.
+    """
+
+    def __init__(
+        self,
+        session_factory=None,
+        product_cache=None,
+        metrics=None,
+        idempotency_cache=None,
+    ) -> None:
         super().__init__()
         self.session_factory = session_factory
+        if product_cache is None:
+            product_cache = config.get_product_cache()
+        self.product_cache = product_cache
+        self.metrics = config.get_metrics() if metrics is None else metrics
+        if idempotency_cache is None:
+            idempotency_cache = config.get_idempotency_cache()
+        self.idempotency_cache = idempotency_cache
 
     def __enter__(self):
+        # the shared engine is only built once a unit of work is actually used
+        if self.session_factory is None:
+            self.session_factory = config.get_session_factory()
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyProductRepository(self.session)
+        self.products = repository.SqlAlchemyProductRepository(
+            self.session, cache=self.product_cache, metrics=self.metrics
+        )
+        self.allocations_view = read_model.SqlAlchemyAllocationsView(self.session)
+        self.batch_loader = batch_loader.SqlAlchemyBatchLoader(self.session)
+        self.idempotency = idempotency.SqlAlchemyIdempotencyStore(
+            self.session, self.idempotency_cache
+        )
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
         self.session.close()
 
+    def clone(self):
+        return type(self)(
+            self.session_factory,
+            self.product_cache,
+            self.metrics,
+            self.idempotency_cache,
+        )
+
     def _commit(self):
-        self.session.commit()
+        rows = outbox.to_rows(take_external_events(self.products))
+        snapshots = {}
+        if self.product_cache is not None:
+            # until the commit succeeds, every product we saw is dropped; read
+            # the SKUs now as a failed flush expires the products
+            snapshots = dict.fromkeys(product.sku for product in self.products.seen)
+        try:
+            if rows:
+                self.session.execute(insert(orm.outbox), rows)
+            if self.product_cache is not None:
+                # snapshot what was flushed: commit expires everything loaded
+                self.session.flush()
+                flushed = snapshot_seen(self.products)
+            self.session.commit()
+            self.idempotency.committed()
+            if self.product_cache is not None:
+                snapshots = flushed
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
+        finally:
+            if self.product_cache is not None:
+                refresh_cache(self.product_cache, snapshots)
 
     def rollback(self):
         return self.session.rollback()
 
 
+class GroupedUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    One member of a group commit (see ``group_commit.GroupCommitter``): works
+    in ``session``, which the group shares, inside a savepoint of its own.
+    ``commit`` flushes and releases the savepoint, and ``rollback`` only undoes
+    what came after the last commit; the group's transaction is committed, and
+    the product cache refreshed, by whoever owns ``session``.
+    """
+
+    def __init__(
+        self, session, session_factory=None, product_cache=None, metrics=None
+    ) -> None:
+        super().__init__(session_factory, product_cache, metrics)
+        self.session = session
+        self.seen = set()
+
+    def __enter__(self):
+        self.products = repository.SqlAlchemyProductRepository(
+            self.session, cache=self.product_cache, metrics=self.metrics
+        )
+        self.allocations_view = read_model.SqlAlchemyAllocationsView(self.session)
+        self.batch_loader = batch_loader.SqlAlchemyBatchLoader(self.session)
+        # nothing is cached until the group commits, and it may not
+        self.idempotency = idempotency.SqlAlchemyIdempotencyStore(self.session)
+        self._savepoint = self.session.begin_nested()
+        return self
+
+    def __exit__(self, *args):
+        AbstractUnitOfWork.__exit__(self, *args)
+        self.seen.update(self.products.seen)
+
+    def clone(self):
+        return SqlAlchemyUnitOfWork(
+            self.session_factory,
+            self.product_cache,
+            self.metrics,
+            self.idempotency_cache,
+        )
+
+    def _commit(self):
+        rows = outbox.to_rows(take_external_events(self.products))
+        try:
+            if rows:
+                self.session.execute(insert(orm.outbox), rows)
+            self._savepoint.commit()
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
+        # whatever the handler does next goes in a savepoint of its own
+        self._savepoint = self.session.begin_nested()
+
+    def rollback(self):
+        # also after a failed flush, which leaves the savepoint inactive
+        self._savepoint.rollback()
+
+
 class FakeUnitOfWork(AbstractUnitOfWork):
     def __init__(self, batches=[]) -> None:
         self.products = repository.FakeProductRepository(batches)
+        self.allocations_view = read_model.FakeAllocationsView()
+        self.batch_loader = batch_loader.FakeBatchLoader(self.products)
+        self.idempotency = idempotency.FakeIdempotencyStore()
 
     def _commit(self):
+        self.idempotency.committed()
         self.committed = True
 
     def rollback(self):
         pass
+
+    def clone(self):
+        # the fake repository is shared state; tests inspect it through this uow
+        return self
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AbstractAsyncProductRepository
+    idempotency: idempotency.AbstractAsyncIdempotencyStore
+    metrics: AbstractMetrics = NoopMetrics()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *_):
+        if exc_type is not None:
+            self.metrics.increment("uow_rollbacks_total", reason=exc_type.__name__)
+        await self.rollback()
+
+    @abc.abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    async def commit(self):
+        with self.metrics.timer("uow_commit_seconds"):
+            await self._commit()
+
+    @abc.abstractmethod
+    def clone(self) -> "AbstractAsyncUnitOfWork":
+        raise NotImplementedError
+
+    collect_new_events = AbstractUnitOfWork.collect_new_events
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    def __init__(
+        self,
+        session_factory=None,
+        product_cache=None,
+        metrics=None,
+        idempotency_cache=None,
+    ) -> None:
+        super().__init__()
+        self.session_factory = session_factory
+        if product_cache is None:
+            product_cache = config.get_product_cache()
+        self.product_cache = product_cache
+        self.metrics = config.get_metrics() if metrics is None else metrics
+        if idempotency_cache is None:
+            idempotency_cache = config.get_idempotency_cache()
+        self.idempotency_cache = idempotency_cache
+
+    async def __aenter__(self):
+        if self.session_factory is None:
+            self.session_factory = config.get_async_session_factory()
+        self.session = self.session_factory()
+        self.products = repository.AsyncSqlAlchemyProductRepository(
+            self.session, cache=self.product_cache, metrics=self.metrics
+        )
+        self.allocations_view = read_model.AsyncSqlAlchemyAllocationsView(
+            self.session
+        )
+        self.batch_loader = batch_loader.AsyncSqlAlchemyBatchLoader(self.session)
+        self.idempotency = idempotency.AsyncSqlAlchemyIdempotencyStore(
+            self.session, self.idempotency_cache
+        )
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    def clone(self):
+        return type(self)(
+            self.session_factory,
+            self.product_cache,
+            self.metrics,
+            self.idempotency_cache,
+        )
+
+    async def _commit(self):
+        rows = outbox.to_rows(take_external_events(self.products))
+        snapshots = {}
+        if self.product_cache is not None:
+            snapshots = dict.fromkeys(product.sku for product in self.products.seen)
+        try:
+            if rows:
+                await self.session.execute(insert(orm.outbox), rows)
+            if self.product_cache is not None:
+                await self.session.flush()
+                flushed = snapshot_seen(self.products)
+            await self.session.commit()
+            self.idempotency.committed()
+            if self.product_cache is not None:
+                snapshots = flushed
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
+        finally:
+            if self.product_cache is not None:
+                refresh_cache(self.product_cache, snapshots)
+
+    async def rollback(self):
+        await self.session.rollback()
+
+
+class FakeAsyncUnitOfWork(AbstractAsyncUnitOfWork):
+    def __init__(self, products=[]) -> None:
+        self.products = repository.FakeAsyncProductRepository(products)
+        self.allocations_view = read_model.FakeAsyncAllocationsView()
+        self.batch_loader = batch_loader.FakeAsyncBatchLoader(self.products._products)
+        self.idempotency = idempotency.FakeAsyncIdempotencyStore()
+        self.committed = False
+
+    async def _commit(self):
+        self.idempotency.committed()
+        self.committed = True
+
+    async def rollback(self):
+        pass
+
+    def clone(self):
+        return self
@@ -0,0 +1,15 @@
+from cosmicpython.service_layer.unit_of_work import (
+    AbstractAsyncUnitOfWork,
+    AbstractUnitOfWork,
+)
+
+
+def allocations(orderid: str, uow: AbstractUnitOfWork) -> list[dict]:
+    """The sku, qty and batchref of each line of an order, from the read model."""
+    with uow:
+        return uow.allocations_view.for_order(orderid)
+
+
+async def allocations_async(orderid: str, uow: AbstractAsyncUnitOfWork) -> list[dict]:
+    async with uow:
+        return await uow.allocations_view.for_order(orderid)
@@ -1,9 +1,11 @@
+import asyncio
 import subprocess
 import time
 
 import pytest
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
 from cosmicpython import config
 from cosmicpython.adapters.orm import (
@@ -31,6 +33,18 @@ def session_factory(in_memory_db):
     clear_mappers()
 
 
+@pytest.fixture
+def async_session_factory(tmp_path):
+    # aiosqlite gives every connection its own :memory: database, so use a file
+    path = tmp_path / "async.db"
+    metadata.create_all(create_engine(f"sqlite:///{path}"))
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    config.start_mappers()
+    yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    clear_mappers()
+    asyncio.run(engine.dispose())
+
+
 @pytest.fixture
 def session(session_factory):
     return session_factory()
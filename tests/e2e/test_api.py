@@ -3,7 +3,12 @@ import requests
 
 from cosmicpython import config
 from cosmicpython.domain.models import OrderLine
-from tests.test_utils import random_batchref, random_orderid, random_sku
+from tests.test_utils import (
+    random_batchref,
+    random_orderid,
+    random_sku,
+    random_suffix,
+)
 
 
 def add_stock_via_api(batches: list[tuple]):
@@ -144,3 +149,107 @@ def test_400_message_for_invalid_sku():
 
     assert r.json()["message"] == f"Invalid sku {unknown_sku}"
     assert r.status_code == 400
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_allocations_return_a_batchref_per_line():
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref("1"), random_batchref("2")
+    order1, order2, order3 = (
+        random_orderid("1"),
+        random_orderid("2"),
+        random_orderid("3"),
+    )
+    add_stock_via_api([(batch, sku, 10, None), (otherbatch, othersku, 10, None)])
+    lines = [
+        {"orderid": order1, "sku": sku, "qty": 6},
+        {"orderid": order2, "sku": othersku, "qty": 6},
+        {"orderid": order3, "sku": sku, "qty": 6},
+    ]
+    url = config.get_api_url().url
+
+    r = requests.post(f"{url}/allocations/bulk", json={"lines": lines})
+
+    assert r.status_code == 201
+    assert [a["batchref"] for a in r.json()["allocations"]] == [
+        batch,
+        otherbatch,
+        None,
+    ]
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_allocations_can_be_read_back_by_order():
+    sku = random_sku()
+    batch1 = random_batchref("1")
+    order1 = random_orderid("1")
+    add_stock_via_api([(batch1, sku, 10, "2011-01-01")])
+    url = config.get_api_url().url
+
+    r = requests.post(
+        f"{url}/allocations", json={"orderid": order1, "sku": sku, "qty": 3}
+    )
+    assert r.status_code == 201
+
+    r = requests.get(f"{url}/allocations/{order1}")
+    assert r.status_code == 200
+    assert r.json() == [{"sku": sku, "qty": 3, "batchref": batch1}]
+
+    r = requests.get(f"{url}/allocations/{random_orderid('missing')}")
+    assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_bulk_batches_can_be_allocated_to():
+    sku = random_sku()
+    early, late = random_batchref("1"), random_batchref("2")
+    url = config.get_api_url().url
+    body = (
+        f"ref,sku,qty,eta\n{late},{sku},10,2011-01-02\n{early},{sku},10,2011-01-01\n"
+    )
+
+    r = requests.post(
+        f"{url}/batches/bulk", data=body, headers={"content-type": "text/csv"}
+    )
+    assert r.status_code == 201
+    assert r.json()["rows"] == 2
+
+    r = requests.post(
+        f"{url}/allocations", json={"orderid": random_orderid(), "sku": sku, "qty": 3}
+    )
+    assert r.json()["batchref"] == early
+
+    r = requests.post(
+        f"{url}/batches/bulk", data=body, headers={"content-type": "text/csv"}
+    )
+    assert r.status_code == 400
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_metrics_are_exposed_for_prometheus():
+    url = config.get_api_url().url
+    post_to_add_batch(random_batchref(), random_sku(), 10, None)
+
+    r = requests.get(f"{url}/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    assert 'cosmicpython_bus_events_total{event="BatchCreated"}' in r.text
+    assert "cosmicpython_uow_commit_seconds_count" in r.text
+
+
+@pytest.mark.usefixtures("restart_api")
+def test_a_retried_allocation_is_only_allocated_once():
+    sku, batch, orderid = random_sku(), random_batchref(), random_orderid()
+    add_stock_via_api([(batch, sku, 10, None)])
+    url = config.get_api_url().url
+    line = {"orderid": orderid, "sku": sku, "qty": 6}
+    headers = {"Idempotency-Key": random_suffix()}
+
+    first = requests.post(f"{url}/allocations", json=line, headers=headers)
+    retry = requests.post(f"{url}/allocations", json=line, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert first.json() == retry.json() == {"batchref": batch}
+
+    r = requests.post(f"{url}/allocations", json={**line, "qty": 1}, headers=headers)
+    assert r.status_code == 422
+    assert len(requests.get(f"{url}/allocations/{orderid}").json()) == 1
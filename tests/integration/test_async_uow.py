@@ -0,0 +1,87 @@
+import asyncio
+
+from sqlalchemy import text
+
+from cosmicpython.domain import events
+from cosmicpython.service_layer import services
+from cosmicpython.service_layer.message_bus import AsyncMessageBus
+from cosmicpython.service_layer.unit_of_work import AsyncSqlAlchemyUnitOfWork
+
+message_bus = AsyncMessageBus()
+
+
+def test_async_uow_allocates_and_deallocates(async_session_factory):
+    sku = "ASYNC-BENCH"
+
+    async def scenario():
+        await message_bus.handle(
+            events.BatchCreated("batch1", sku, 100, None),
+            AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        )
+        [batchref] = await message_bus.handle(
+            events.AllocationRequired("o1", sku, 10),
+            AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        )
+        await message_bus.handle(
+            events.AllocationRequired("o2", sku, 5),
+            AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        )
+        await services.deallocate_async(
+            "o2", sku, 5, AsyncSqlAlchemyUnitOfWork(async_session_factory)
+        )
+        async with async_session_factory() as session:
+            rows = await session.execute(
+                text(
+                    "SELECT orderid FROM allocations"
+                    " JOIN order_lines ON orderline_id = order_lines.id"
+                )
+            )
+            view = await session.execute(
+                text("SELECT orderid FROM allocations_view WHERE sku = :sku"),
+                dict(sku=sku),
+            )
+        return batchref, list(rows), list(view)
+
+    assert asyncio.run(scenario()) == ("batch1", [("o1",)], [("o1",)])
+
+
+def test_async_uow_reallocates_on_batch_quantity_change(async_session_factory):
+    sku = "ASYNC-SHELF"
+
+    async def scenario():
+        for event in [
+            events.BatchCreated("batch1", sku, 50, None),
+            events.BatchCreated("batch2", sku, 50, None),
+            events.AllocationRequired("order1", sku, 20),
+            events.AllocationRequired("order2", sku, 20),
+            events.BatchQuantityChanged("batch1", 25),
+        ]:
+            await message_bus.handle(
+                event, AsyncSqlAlchemyUnitOfWork(async_session_factory)
+            )
+
+        uow = AsyncSqlAlchemyUnitOfWork(async_session_factory)
+        async with uow:
+            product = await uow.products.get(sku=sku)
+            return {b.reference: b.available_quantity for b in product.batches}
+
+    assert asyncio.run(scenario()) == {"batch1": 5, "batch2": 30}
+
+
+def test_async_uow_writes_external_events_to_the_outbox(async_session_factory):
+    sku = "ASYNC-LAMP"
+
+    async def scenario():
+        await message_bus.handle(
+            events.BatchCreated("batch1", sku, 10, None),
+            AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        )
+        await message_bus.handle(
+            events.AllocationRequired("o1", sku, 20),
+            AsyncSqlAlchemyUnitOfWork(async_session_factory),
+        )
+        async with async_session_factory() as session:
+            rows = await session.execute(text("SELECT event_type FROM outbox"))
+        return list(rows)
+
+    assert asyncio.run(scenario()) == [("OutOfStock",)]
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from cosmicpython.adapters.batch_loader import DuplicateBatches
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import AsyncMessageBus, MessageBus
+from cosmicpython.service_layer.unit_of_work import (
+    AsyncSqlAlchemyUnitOfWork,
+    SqlAlchemyUnitOfWork,
+)
+
+message_bus = MessageBus()
+
+SHIPMENT = events.BatchesCreated(
+    [
+        events.BatchCreated("b2", "LAMP", 50, date(2011, 1, 2)),
+        events.BatchCreated("b3", "LAMP", 20),
+        events.BatchCreated("b4", "TABLE", 5),
+    ]
+)
+
+
+def test_loads_batches_and_upserts_their_products(session_factory):
+    uow = SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b1", "LAMP", 100), uow)
+
+    message_bus.handle(SHIPMENT, uow)
+
+    with uow:
+        lamp = uow.products.get("LAMP")
+        assert sorted((b.reference, b.eta) for b in lamp.batches) == [
+            ("b1", None),
+            ("b2", date(2011, 1, 2)),
+            ("b3", None),
+        ]
+        # bumped, so whoever loaded the product before the shipment conflicts
+        assert lamp.version == 2
+        table = uow.products.get("TABLE")
+        assert [b.available_quantity for b in table.batches] == [5]
+        assert table.version == 1
+
+
+def test_rejects_the_whole_chunk_if_a_batch_exists(session_factory):
+    uow = SqlAlchemyUnitOfWork(session_factory)
+    message_bus.handle(events.BatchCreated("b3", "LAMP", 100), uow)
+
+    with pytest.raises(DuplicateBatches, match="b3"):
+        message_bus.handle(SHIPMENT, uow)
+
+    with uow:
+        assert [b.reference for b in uow.products.get("LAMP").batches] == ["b3"]
+        assert uow.products.get("TABLE") is None
+
+
+def test_async_loader(async_session_factory):
+    bus = AsyncMessageBus()
+
+    async def scenario():
+        uow = AsyncSqlAlchemyUnitOfWork(async_session_factory)
+        await bus.handle(SHIPMENT, uow)
+        async with uow:
+            product = await uow.products.get("LAMP")
+            return sorted(b.reference for b in product.batches)
+
+    assert asyncio.run(scenario()) == ["b2", "b3"]
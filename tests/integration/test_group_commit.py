@@ -0,0 +1,128 @@
+import pytest
+from sqlalchemy import create_engine, select, text
+
+from cosmicpython import config
+from cosmicpython.adapters.cache import ProductCache
+from cosmicpython.adapters.metrics import NoopMetrics
+from cosmicpython.adapters.orm import clear_mappers, metadata, outbox, sessionmaker
+from cosmicpython.domain import events
+from cosmicpython.service_layer.group_commit import GroupCommitter
+from cosmicpython.service_layer.handlers import InvalidSku
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+SKUS = ("LAMP", "TABLE", "CHAIR")
+
+
+@pytest.fixture
+def file_session_factory(tmp_path):
+    # the committer works on a thread of its own, so no :memory: database
+    engine = create_engine(f"sqlite:///{tmp_path / 'group.db'}")
+    metadata.create_all(engine)
+    config.start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+    engine.dispose()
+
+
+@pytest.fixture
+def bus(file_session_factory):
+    bus = MessageBus(request_metrics=NoopMetrics())
+    for sku in SKUS:
+        bus.handle(
+            events.BatchCreated(f"{sku}-b1", sku, 10, None),
+            SqlAlchemyUnitOfWork(file_session_factory, metrics=NoopMetrics()),
+        )
+    return bus
+
+
+def committer(bus, session_factory, **kwargs):
+    return GroupCommitter(
+        bus, session_factory, metrics=NoopMetrics(), window=0.5, **kwargs
+    )
+
+
+def allocated_orders(session_factory):
+    session = session_factory()
+    try:
+        return {
+            row.orderid
+            for row in session.execute(text("SELECT orderid FROM order_lines"))
+        }
+    finally:
+        session.close()
+
+
+def outbox_events(session_factory):
+    session = session_factory()
+    try:
+        rows = session.execute(select(outbox))
+        return sorted((row.event_type, row.payload["orderid"]) for row in rows)
+    finally:
+        session.close()
+
+
+def test_messages_waiting_together_commit_together(bus, file_session_factory):
+    with committer(bus, file_session_factory, max_group=3) as group:
+        futures = [
+            group.submit(events.AllocationRequired(f"o-{sku}", sku, 4))
+            for sku in SKUS
+        ]
+        results = [future.result(timeout=5) for future in futures]
+
+    assert results == [["LAMP-b1"], ["TABLE-b1"], ["CHAIR-b1"]]
+    assert group.metrics == {"groups": 1, "messages": 3}
+    assert allocated_orders(file_session_factory) == {"o-LAMP", "o-TABLE", "o-CHAIR"}
+
+
+def test_a_failing_message_only_fails_its_own_caller(bus, file_session_factory):
+    with committer(bus, file_session_factory, max_group=3) as group:
+        ok = group.submit(events.AllocationRequired("o1", "LAMP", 4))
+        bad = group.submit(events.AllocationRequired("o2", "NO-SUCH-SKU", 4))
+        also_ok = group.submit(events.AllocationRequired("o3", "LAMP", 4))
+
+        assert ok.result(timeout=5) == ["LAMP-b1"]
+        with pytest.raises(InvalidSku):
+            bad.result(timeout=5)
+        assert also_ok.result(timeout=5) == ["LAMP-b1"]
+
+    assert group.metrics == {"groups": 1, "messages": 3, "failed": 1}
+    assert allocated_orders(file_session_factory) == {"o1", "o3"}
+
+
+def test_a_failed_group_is_handled_again_one_by_one(bus, file_session_factory):
+    def disk_full():
+        raise OSError("disk full")
+
+    def failing_first_commit():
+        session = file_session_factory()
+        if not opened:
+            session.commit = disk_full
+        opened.append(session)
+        return session
+
+    opened = []
+    with committer(bus, failing_first_commit, max_group=2) as group:
+        futures = [
+            group.submit(events.AllocationRequired(f"o-{sku}", sku, 4))
+            for sku in SKUS[:2]
+        ]
+        results = [future.result(timeout=5) for future in futures]
+
+    assert results == [["LAMP-b1"], ["TABLE-b1"]]
+    assert group.metrics["group_failures"] == 1
+    assert allocated_orders(file_session_factory) == {"o-LAMP", "o-TABLE"}
+    # the group's outbox rows went with it, so each allocation is published once
+    assert outbox_events(file_session_factory) == [
+        ("Allocated", "o-LAMP"),
+        ("Allocated", "o-TABLE"),
+    ]
+
+
+def test_the_product_cache_gets_what_the_group_committed(bus, file_session_factory):
+    product_cache = ProductCache()
+    with committer(bus, file_session_factory, product_cache=product_cache) as group:
+        group.handle(events.AllocationRequired("o1", "LAMP", 4))
+
+    [batch] = product_cache.get("LAMP").batches
+    assert [line[1] for line in batch[5]] == ["o1"]
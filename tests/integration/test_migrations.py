@@ -0,0 +1,24 @@
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from cosmicpython.adapters import orm
+
+MIGRATIONS = Path(__file__).parents[2] / "alembic"
+
+
+def test_migrations_build_the_schema_the_orm_expects(tmp_path):
+    url = f"sqlite:///{tmp_path / 'migrated.db'}"
+    alembic_config = Config()
+    alembic_config.set_main_option("script_location", str(MIGRATIONS))
+    alembic_config.set_main_option("sqlalchemy.url", url)
+
+    command.upgrade(alembic_config, "head")
+
+    with create_engine(url).connect() as connection:
+        diff = compare_metadata(MigrationContext.configure(connection), orm.metadata)
+    assert diff == []
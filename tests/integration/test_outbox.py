@@ -0,0 +1,109 @@
+from sqlalchemy import select
+
+from cosmicpython.adapters import orm
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.outbox_dispatcher import OutboxDispatcher
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+message_bus = MessageBus()
+
+
+def run_out_of_stock(session_factory, sku):
+    message_bus.handle(
+        events.BatchCreated("batch1", sku, 10, None),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+    return message_bus.handle(
+        events.AllocationRequired("o1", sku, 20),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+
+
+def outbox_rows(session_factory):
+    return session_factory().execute(select(orm.outbox)).all()
+
+
+def test_external_events_are_written_to_the_outbox_not_handled(session_factory):
+    results = run_out_of_stock(session_factory, "EMPTY-LAMP")
+
+    # only the allocate handler ran; the notification waits in the outbox
+    assert results == [None]
+    [row] = outbox_rows(session_factory)
+    assert row.event_type == "OutOfStock"
+    assert row.payload == {"sku": "EMPTY-LAMP"}
+    assert row.dispatched_at is None
+
+
+def test_allocations_go_to_the_outbox_and_the_read_model(session_factory):
+    message_bus.handle(
+        events.BatchCreated("batch1", "RED-LAMP", 10, None),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+    message_bus.handle(
+        events.AllocationRequired("o1", "RED-LAMP", 5),
+        SqlAlchemyUnitOfWork(session_factory),
+    )
+
+    [row] = outbox_rows(session_factory)
+    assert row.event_type == "Allocated"
+    assert row.payload == dict(orderid="o1", sku="RED-LAMP", qty=5, batchref="batch1")
+    view = session_factory().execute(select(orm.allocations_view)).all()
+    assert [(r.orderid, r.batchref) for r in view] == [("o1", "batch1")]
+
+
+def test_dispatcher_delivers_each_message_once(session_factory):
+    run_out_of_stock(session_factory, "EMPTY-LAMP")
+    delivered = []
+    dispatcher = OutboxDispatcher(
+        session_factory,
+        handlers={events.OutOfStock: [lambda e, **kw: delivered.append((e, kw))]},
+    )
+
+    assert dispatcher.dispatch_batch() == 1
+    assert dispatcher.dispatch_batch() == 0
+
+    [row] = outbox_rows(session_factory)
+    assert delivered == [
+        (events.OutOfStock("EMPTY-LAMP"), {"idempotency_key": row.idempotency_key})
+    ]
+    assert row.dispatched_at is not None
+
+
+def test_failed_delivery_is_retried_with_the_same_key(session_factory):
+    run_out_of_stock(session_factory, "EMPTY-LAMP")
+    keys = []
+
+    def flaky(event, idempotency_key):
+        keys.append(idempotency_key)
+        if len(keys) == 1:
+            raise ConnectionError("mail server went away")
+
+    dispatcher = OutboxDispatcher(
+        session_factory, handlers={events.OutOfStock: [flaky]}
+    )
+
+    dispatcher.dispatch_batch()
+    [row] = outbox_rows(session_factory)
+    assert row.attempts == 1
+    assert "mail server went away" in row.last_error
+    assert row.dispatched_at is None
+
+    dispatcher.dispatch_batch()
+    [row] = outbox_rows(session_factory)
+    assert row.dispatched_at is not None
+    assert keys == [row.idempotency_key] * 2
+    assert dispatcher.metrics == {"failed": 1, "dispatched": 1}
+
+
+def test_gives_up_on_a_message_after_max_attempts(session_factory):
+    run_out_of_stock(session_factory, "EMPTY-LAMP")
+
+    def broken(event, idempotency_key):
+        raise ConnectionError("mail server went away")
+
+    dispatcher = OutboxDispatcher(
+        session_factory, handlers={events.OutOfStock: [broken]}, max_attempts=2
+    )
+
+    assert [dispatcher.dispatch_batch() for _ in range(3)] == [1, 1, 0]
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from cosmicpython.adapters.cache import ProductCache
+from cosmicpython.domain import events
+from cosmicpython.domain.models import OrderLine
+from cosmicpython.service_layer import views
+from cosmicpython.service_layer.message_bus import AsyncMessageBus, MessageBus
+from cosmicpython.service_layer.unit_of_work import (
+    AsyncSqlAlchemyUnitOfWork,
+    ConcurrencyConflict,
+    SqlAlchemyUnitOfWork,
+)
+from tests.test_utils import assert_query_count
+
+message_bus = MessageBus()
+
+
+@pytest.fixture
+def product_cache():
+    return ProductCache()
+
+
+def allocated(session_factory, orderid):
+    return views.allocations(orderid, SqlAlchemyUnitOfWork(session_factory))
+
+
+def test_commit_caches_the_product(session_factory, product_cache):
+    uow = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LAMP", 100, None), uow)
+
+    cached = product_cache.get("LAMP")
+    assert cached.version == 1
+    assert [batch[1] for batch in cached.batches] == ["b1"]
+
+
+def test_a_cached_product_is_only_checked_against_its_version(
+    session_factory, in_memory_db, product_cache
+):
+    uow = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LAMP", 100, None), uow)
+    message_bus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+
+    with uow:
+        with assert_query_count(in_memory_db, 1):
+            product = uow.products.get("LAMP")
+        assert product.batches[0].available_quantity == 90
+    assert product_cache.metrics["hits"] == 2
+
+
+def test_allocating_through_the_cache_persists(session_factory, product_cache):
+    uow = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LAMP", 100, None), uow)
+    message_bus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+    message_bus.handle(events.AllocationRequired("o2", "LAMP", 20), uow)
+    message_bus.handle(events.DeallocationRequired("o1", "LAMP", 10), uow)
+
+    product_cache.clear()
+    with uow:
+        [batch] = uow.products.get("LAMP").batches
+        assert batch.available_quantity == 80
+    assert allocated(session_factory, "o2") == [
+        {"sku": "LAMP", "qty": 20, "batchref": "b1"}
+    ]
+
+
+def test_a_change_made_elsewhere_makes_the_snapshot_stale(
+    session_factory, product_cache
+):
+    uow = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    message_bus.handle(events.BatchCreated("b1", "LAMP", 100, None), uow)
+    # another process, with its own cache, allocates
+    message_bus.handle(
+        events.AllocationRequired("o1", "LAMP", 10),
+        SqlAlchemyUnitOfWork(session_factory, ProductCache()),
+    )
+
+    with uow:
+        product = uow.products.get("LAMP")
+        assert product.batches[0].available_quantity == 90
+    assert product_cache.metrics["stale"] == 1
+
+
+def test_a_conflicting_commit_drops_the_snapshot(session_factory, product_cache):
+    message_bus.handle(
+        events.BatchCreated("b1", "LAMP", 100, None),
+        SqlAlchemyUnitOfWork(session_factory, product_cache),
+    )
+
+    first = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    second = SqlAlchemyUnitOfWork(session_factory, product_cache)
+    with first, second:
+        first.products.get("LAMP").allocate(OrderLine("o1", "LAMP", 10))
+        second.products.get("LAMP").allocate(OrderLine("o2", "LAMP", 10))
+        first.commit()
+        with pytest.raises(ConcurrencyConflict):
+            second.commit()
+
+    assert product_cache.get("LAMP") is None
+    with first:
+        assert first.products.get("LAMP").batches[0].available_quantity == 90
+
+
+def test_async_uow_reads_through_the_cache(async_session_factory, product_cache):
+    bus = AsyncMessageBus()
+
+    async def scenario():
+        uow = AsyncSqlAlchemyUnitOfWork(async_session_factory, product_cache)
+        await bus.handle(events.BatchCreated("b1", "LAMP", 100, None), uow)
+        await bus.handle(events.AllocationRequired("o1", "LAMP", 10), uow)
+        await bus.handle(events.AllocationRequired("o2", "LAMP", 10), uow)
+        product_cache.clear()
+        async with uow:
+            product = await uow.products.get("LAMP")
+            return product.batches[0].available_quantity
+
+    assert asyncio.run(scenario()) == 80
+    assert product_cache.metrics["hits"] == 2
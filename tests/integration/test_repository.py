@@ -1,9 +1,12 @@
 import pytest
 from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 
 from cosmicpython import service_layer
-from cosmicpython.adapters import repository
+from cosmicpython.adapters import orm, repository
 from cosmicpython.domain import models
+from tests.test_utils import assert_query_count
 
 
 def test_repository_can_save_a_batch(session):
@@ -94,3 +97,96 @@ def test_behavior_when_batch_not_found(session):
 
     with pytest.raises(repository.NoBatchContainingOrderLine):
         repo.find_containing_line(line)
+
+
+def test_batch_references_are_unique(session):
+    repo = repository.SQLAlchemyRepository(session)
+    repo.add(models.Batch("batch1", "RUSTY-SOAPDISH", 100, eta=None))
+    repo.add(models.Batch("batch1", "GENERIC-SOFA", 100, eta=None))
+
+    with pytest.raises(IntegrityError):
+        session.commit()
+
+
+def add_product_with_allocated_batches(session_factory, sku, batches=3):
+    session = session_factory()
+    product = models.Product(sku, batches=[])
+    for n in range(batches):
+        batch = models.Batch(f"{sku}-batch{n}", sku, 100, eta=None)
+        batch.allocate(models.OrderLine(f"{sku}-order{n}", sku, 10))
+        product.add_batch(batch)
+    session.add(product)
+    session.commit()
+    session.close()
+
+
+def test_loaded_skus_share_one_string(session_factory):
+    add_product_with_allocated_batches(session_factory, "SHARED-SKU")
+    product = repository.SqlAlchemyProductRepository(session_factory()).get(
+        "SHARED-SKU"
+    )
+
+    loaded = [b.sku for b in product.batches]
+    loaded += [line.sku for b in product.batches for line in b._allocations]
+    assert len(loaded) == 6
+    assert all(sku is product.sku for sku in loaded)
+
+
+@pytest.mark.parametrize(
+    "loading, queries", [("lazy", 5), ("selectin", 3), ("joined", 1)]
+)
+def test_queries_to_load_and_allocate(
+    session_factory, in_memory_db, loading, queries
+):
+    add_product_with_allocated_batches(session_factory, "SOLID-DRESSER")
+    products = repository.SqlAlchemyProductRepository(session_factory())
+
+    with assert_query_count(in_memory_db, queries):
+        product = products.get("SOLID-DRESSER", loading=loading)
+        product.allocate(models.OrderLine("new-order", "SOLID-DRESSER", 5))
+
+
+@pytest.mark.parametrize("loading, queries", [("selectin", 3), ("joined", 1)])
+def test_queries_to_load_and_deallocate(
+    session_factory, in_memory_db, loading, queries
+):
+    add_product_with_allocated_batches(session_factory, "SOLID-DRESSER")
+    products = repository.SqlAlchemyProductRepository(session_factory())
+
+    with assert_query_count(in_memory_db, queries):
+        product = products.get("SOLID-DRESSER", loading=loading)
+        product.deallocate(
+            models.OrderLine("SOLID-DRESSER-order2", "SOLID-DRESSER", 10)
+        )
+
+
+@pytest.mark.parametrize("loading, queries", [("selectin", 3), ("joined", 1)])
+def test_queries_to_change_batch_quantity(
+    session_factory, in_memory_db, loading, queries
+):
+    add_product_with_allocated_batches(session_factory, "SOLID-DRESSER")
+    products = repository.SqlAlchemyProductRepository(session_factory())
+
+    with assert_query_count(in_memory_db, queries):
+        product = products.get_by_batchref("SOLID-DRESSER-batch1", loading=loading)
+        product.change_batch_quantity("SOLID-DRESSER-batch1", 5)
+
+
+@pytest.mark.parametrize(
+    "lock, clause",
+    [
+        ("update", "FOR UPDATE OF products"),
+        ("nowait", "FOR UPDATE OF products NOWAIT"),
+        ("skip_locked", "FOR UPDATE OF products SKIP LOCKED"),
+    ],
+)
+def test_locking_reads_lock_only_the_product_row(session, lock, clause):
+    query = session.query(models.Product).options(
+        *orm.product_loader_options("joined")
+    )
+
+    locked = repository.lock_product_row(query.filter_by(sku="X"), lock)
+
+    assert str(locked.statement.compile(dialect=postgresql.dialect())).endswith(
+        clause
+    )
@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import create_engine
+
+from cosmicpython import config
+from cosmicpython.adapters.orm import metadata
+from cosmicpython.domain import events
+from cosmicpython.service_layer import views
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.shards import ShardedAllocator, ShardError
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def test_shards_allocate_through_the_database(tmp_path, monkeypatch, session_factory):
+    # the workers are new processes, so they find the database through DB_URI
+    uri = f"sqlite:///{tmp_path / 'shards.db'}"
+    monkeypatch.setenv("DB_URI", uri)
+    engine = create_engine(uri)
+    metadata.create_all(engine)
+    factory = config.sessionmaker(bind=engine)
+    bus = MessageBus()
+    for sku in ("LAMP", "TABLE", "CHAIR"):
+        bus.handle(
+            events.BatchCreated(f"{sku}-b1", sku, 10, None),
+            SqlAlchemyUnitOfWork(factory),
+        )
+
+    with ShardedAllocator(shards=2) as allocator:
+        futures = [
+            allocator.allocate(f"o{n}", sku, 4)
+            for n in range(3)
+            for sku in ("LAMP", "TABLE", "CHAIR")
+        ]
+        batchrefs = [future.result(timeout=60) for future in futures]
+
+    assert batchrefs == ["LAMP-b1", "TABLE-b1", "CHAIR-b1"] * 2 + [None] * 3
+    assert allocator.metrics == {"allocated": 6, "out_of_stock": 3}
+    allocations = views.allocations("o1", SqlAlchemyUnitOfWork(factory))
+    assert sorted(row["batchref"] for row in allocations) == [
+        "CHAIR-b1",
+        "LAMP-b1",
+        "TABLE-b1",
+    ]
+    engine.dispose()
+
+
+def test_allocations_sent_to_a_dead_worker_fail(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_URI", f"sqlite:///{tmp_path / 'shards.db'}")
+
+    with ShardedAllocator(shards=2, route=lambda sku, shards: 0) as allocator:
+        [dead, alive] = allocator._workers
+        dead.kill()
+        dead.join()
+
+        with pytest.raises(ShardError, match="Shard 0 exited with code -9"):
+            allocator.allocate("o1", "LAMP", 1).result(timeout=60)
+
+    assert allocator.metrics == {"failed": 1}
+    assert alive.exitcode == 0
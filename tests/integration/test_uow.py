@@ -1,8 +1,14 @@
 import pytest
-from sqlalchemy import text
+from sqlalchemy import create_engine, text
 
+from cosmicpython.adapters.idempotency import IdempotencyCache
+from cosmicpython.adapters.metrics import PrometheusMetrics
+from cosmicpython.adapters.orm import metadata, sessionmaker
+from cosmicpython.domain import events
 from cosmicpython.domain import models as model
 from cosmicpython.service_layer import unit_of_work
+from cosmicpython.service_layer.message_bus import MessageBus, RetryPolicy
+from tests.test_utils import assert_query_count
 
 
 def get_allocated_batch_ref(session, orderid, sku):
@@ -40,11 +46,9 @@ def insert_product_with_batch(sku, batch, session_factory):
 def test_uow_can_retrieve_a_batch_and_allocate_to_it(session_factory):
     session = session_factory()
     sku = "HIPSTER-WORKBENCH"
-    insert_batch(session, "batch1", sku, 100, None)
     insert_product_with_batch(
         sku, model.Batch("batch1", sku, 100, None), session_factory
     )
-    session.commit()
 
     uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
     with uow:
@@ -80,3 +84,126 @@ def test_rolls_back_on_error(session_factory):
     new_session = session_factory()
     rows = list(new_session.execute(text('SELECT * FROM "batches"')))
     assert rows == []
+
+
+def test_loaded_batches_track_their_allocated_quantity(session_factory):
+    sku = "TIDY-SHELF"
+    batch = model.Batch("batch1", sku, 100, None)
+    batch.allocate(model.OrderLine("o1", sku, 10))
+    batch.allocate(model.OrderLine("o2", sku, 15))
+    insert_product_with_batch(sku, batch, session_factory)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku=sku)
+        [loaded] = product.batches
+        assert loaded.available_quantity == 75
+
+        product.allocate(model.OrderLine("o3", sku, 5))
+        uow.commit()
+        assert loaded.available_quantity == 70
+        product.check_consistency()
+
+
+def test_concurrent_changes_to_a_product_conflict(session_factory):
+    sku = "CONTESTED-LAMP"
+    insert_product_with_batch(
+        sku, model.Batch("batch1", sku, 100, None), session_factory
+    )
+
+    first = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    second = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with first, second:
+        first.products.get(sku=sku).allocate(model.OrderLine("o1", sku, 10))
+        second.products.get(sku=sku).allocate(model.OrderLine("o2", sku, 10))
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            second.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku=sku)
+        assert product.version == 1
+        assert product.batches[0].available_quantity == 90
+
+
+def test_queries_are_counted_per_message(in_memory_db, session_factory):
+    metrics = PrometheusMetrics()
+    metrics.attach(in_memory_db)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, metrics=metrics)
+    bus = MessageBus(request_metrics=metrics)
+
+    bus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100, None), uow)
+
+    assert metrics.value("bus_queries_per_request") == 1
+    assert metrics.value("repository_get_seconds", by="sku") == 1
+    # the message sent some queries: none of it fell in the zero bucket
+    assert 'queries_per_request_bucket{le="0"} 0' in metrics.render()
+
+
+def test_a_retried_allocation_only_reads_its_record(in_memory_db, session_factory):
+    idempotency_cache = IdempotencyCache()
+    bus = MessageBus()
+    bus.handle(
+        events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100, None),
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+    )
+    line = events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10, "key-1")
+
+    def uow(cache=None):
+        return unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, idempotency_cache=cache
+        )
+
+    assert bus.handle(line, uow(idempotency_cache)) == ["batch1"]
+    with assert_query_count(in_memory_db, 1):
+        assert bus.handle(line, uow(IdempotencyCache())) == ["batch1"]
+    with assert_query_count(in_memory_db, 0):
+        assert bus.handle(line, uow(idempotency_cache)) == ["batch1"]
+
+    session = session_factory()
+    assert session.execute(text("SELECT count(*) FROM order_lines")).scalar() == 1
+
+
+def test_a_key_allocated_by_another_request_meanwhile_is_replayed(
+    tmp_path, session_factory
+):
+    # a file, so the two units of work are separate transactions
+    engine = create_engine(f"sqlite:///{tmp_path / 'keys.db'}")
+    metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    bus = MessageBus(RetryPolicy(backoff=0))
+    line = events.AllocationRequired("o1", "RACING-WORKBENCH", 10, "key-1")
+    raced = []
+
+    def uow():
+        return unit_of_work.SqlAlchemyUnitOfWork(
+            factory, idempotency_cache=IdempotencyCache()
+        )
+
+    class RacedUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+        def __enter__(self):
+            super().__enter__()
+            get = self.idempotency.get
+
+            def get_then_lose_the_race(key):
+                # the first attempt misses the record; the other request then
+                # allocates the line and commits it
+                record = get(key)
+                if not raced:
+                    raced.append(bus.handle(line, uow()))
+                return record
+
+            self.idempotency.get = get_then_lose_the_race
+            return self
+
+    bus.handle(events.BatchCreated("batch1", "RACING-WORKBENCH", 100), uow())
+
+    racing = RacedUnitOfWork(factory, idempotency_cache=IdempotencyCache())
+    assert bus.handle(line, racing) == ["batch1"]
+    assert raced == [["batch1"]]
+    assert bus.metrics["retries"] == 1
+    session = factory()
+    assert session.execute(text("SELECT count(*) FROM order_lines")).scalar() == 1
+    session.close()
+    engine.dispose()
@@ -0,0 +1,57 @@
+from datetime import date
+
+from cosmicpython.domain import events
+from cosmicpython.service_layer import views
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+message_bus = MessageBus()
+
+
+def handle(session_factory, *messages):
+    for message in messages:
+        message_bus.handle(message, SqlAlchemyUnitOfWork(session_factory))
+
+
+def test_allocations_view(session_factory):
+    handle(
+        session_factory,
+        events.BatchCreated("sku1batch", "sku1", 50, None),
+        events.BatchCreated("sku2batch", "sku2", 50, date.today()),
+        events.AllocationRequired("order1", "sku1", 20),
+        events.AllocationRequired("order1", "sku2", 20),
+        # add a spurious batch and order to make sure we're getting the right ones
+        events.BatchCreated("sku1batch-later", "sku1", 50, date.today()),
+        events.AllocationRequired("otherorder", "sku1", 30),
+        events.AllocationRequired("otherorder", "sku2", 10),
+    )
+
+    assert views.allocations("order1", SqlAlchemyUnitOfWork(session_factory)) == [
+        {"sku": "sku1", "qty": 20, "batchref": "sku1batch"},
+        {"sku": "sku2", "qty": 20, "batchref": "sku2batch"},
+    ]
+
+
+def test_deallocation(session_factory):
+    handle(
+        session_factory,
+        events.BatchCreated("b1", "sku1", 50, None),
+        events.AllocationRequired("o1", "sku1", 40),
+        events.DeallocationRequired("o1", "sku1", 40),
+    )
+
+    assert views.allocations("o1", SqlAlchemyUnitOfWork(session_factory)) == []
+
+
+def test_reallocation_moves_the_line_in_the_view(session_factory):
+    handle(
+        session_factory,
+        events.BatchCreated("b1", "sku1", 50, None),
+        events.BatchCreated("b2", "sku1", 50, date.today()),
+        events.AllocationRequired("o1", "sku1", 40),
+        events.BatchQuantityChanged("b1", 10),
+    )
+
+    assert views.allocations("o1", SqlAlchemyUnitOfWork(session_factory)) == [
+        {"sku": "sku1", "qty": 40, "batchref": "b2"},
+    ]
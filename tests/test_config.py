@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy import create_engine, text
+
+from cosmicpython import config
+from cosmicpython.adapters.pool import MeteredQueuePool, PoolMetrics
+
+
+def test_pool_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+    monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "2500")
+
+    settings = config.get_pool_settings()
+
+    assert settings.pool_size == 20
+    assert settings.max_overflow == 0
+    assert settings.pre_ping is False
+    options = config.engine_options(settings)
+    assert options["connect_args"] == {"options": "-c statement_timeout=2500"}
+
+
+def test_api_and_unit_of_work_share_one_engine():
+    assert config.get_engine() is config.get_engine()
+    assert config.get_session_factory().kw["bind"] is config.get_engine()
+
+
+def test_pool_metrics_count_checkouts_and_waits(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}", poolclass=MeteredQueuePool, pool_size=2
+    )
+    metrics = PoolMetrics()
+    metrics.attach(engine)
+
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    status = metrics.snapshot(engine.pool)
+    assert status["checkouts"] == 3
+    assert status["checkins"] == 3
+    assert status["connects"] == 1
+    assert status["checked_out"] == 0
+    assert status["wait_seconds_total"] > 0
+
+
+def test_importing_the_api_does_not_build_an_engine():
+    # a clean interpreter, without any of the DB_* variables
+    check = (
+        "import cosmicpython.endpoints.api\n"
+        "from cosmicpython import config\n"
+        "assert config.get_engine.cache_info().currsize == 0\n"
+    )
+    env = {k: v for k, v in os.environ.items() if not k.startswith("DB_")}
+    subprocess.run([sys.executable, "-c", check], env=env, check=True)
+
+
+def test_sqlite_uris_skip_the_pool_settings(monkeypatch):
+    monkeypatch.setenv("DB_URI", "sqlite://")
+
+    uri = config.get_database_uri()
+
+    assert uri == "sqlite://"
+    assert config.engine_options(config.get_pool_settings(), uri) == {}
@@ -3,7 +3,12 @@ from random import randint
 
 import pytest
 
-from cosmicpython.domain.models import Batch, OrderLine, Product
+from cosmicpython.domain.models import (
+    Batch,
+    InconsistentAllocatedQuantity,
+    OrderLine,
+    Product,
+)
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -102,3 +107,23 @@ def test_returns_allocated_batch_ref():
     line = OrderLine("oref", "HIGHBROW-POSTER", 10)
     allocation = product.allocate(line)
     assert allocation == in_stock_batch.reference
+
+
+def test_deallocate_one_releases_the_lines_quantity():
+    batch = Batch("batch-001", "SQUEAKY-CHAIR", 20, eta=None)
+    batch.allocate(OrderLine("order1", "SQUEAKY-CHAIR", 5))
+    batch.allocate(OrderLine("order2", "SQUEAKY-CHAIR", 3))
+
+    line = batch.deallocate_one()
+
+    assert batch.available_quantity == 20 - 8 + line.qty
+    batch.check_allocated_quantity()
+
+
+def test_consistency_check_catches_a_stale_allocated_quantity():
+    batch, line = make_batch_and_line("SQUEAKY-CHAIR", 20, 2)
+    batch.allocate(line)
+    batch._allocations.clear()
+
+    with pytest.raises(InconsistentAllocatedQuantity):
+        batch.check_allocated_quantity()
@@ -1,4 +1,7 @@
 import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event
 
 
 def random_suffix():
@@ -15,3 +18,34 @@ def random_batchref(name=""):
 
 def random_orderid(name=""):
     return f"order-{name}-{random_suffix()}"
+
+
+class QueryCounter:
+    """Counts the SQL statements an engine sends while the counter is active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *_):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def assert_query_count(engine, expected):
+    with QueryCounter(engine) as counter:
+        yield counter
+    assert counter.count == expected, "\n\n".join(
+        [f"expected {expected} queries, got {counter.count}:", *counter.statements]
+    )
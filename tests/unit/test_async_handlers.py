@@ -0,0 +1,83 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from cosmicpython.adapters.repository import FakeAsyncProductRepository
+from cosmicpython.domain import events, models
+from cosmicpython.service_layer.message_bus import AsyncMessageBus
+from cosmicpython.service_layer.unit_of_work import FakeAsyncUnitOfWork
+
+message_bus = AsyncMessageBus()
+
+
+def handle(event, uow):
+    return asyncio.run(message_bus.handle(event, uow))
+
+
+class TestAddBatch:
+    def test_for_new_product(self):
+        uow = FakeAsyncUnitOfWork()
+        handle(events.BatchCreated("b1", "CRUNCHY-ARMCHAIR", 100, None), uow)
+        assert asyncio.run(uow.products.get("CRUNCHY-ARMCHAIR")) is not None
+        assert uow.committed
+
+
+class TestAllocate:
+    def test_returns_allocation(self):
+        uow = FakeAsyncUnitOfWork()
+        handle(events.BatchCreated("batch1", "COMPLICATED-LAMP", 100, None), uow)
+        result = handle(events.AllocationRequired("o1", "COMPLICATED-LAMP", 10), uow)
+        assert result.pop(0) == "batch1"
+
+    def test_a_retry_gets_the_same_batchref(self):
+        uow = FakeAsyncUnitOfWork()
+        handle(events.BatchCreated("batch1", "COMPLICATED-LAMP", 100, None), uow)
+        line = events.AllocationRequired("o1", "COMPLICATED-LAMP", 10, "key-1")
+
+        assert handle(line, uow) == handle(line, uow) == ["batch1"]
+        product = asyncio.run(uow.products.get("COMPLICATED-LAMP"))
+        assert product.batches[0].available_quantity == 90
+
+    def test_a_retried_run_gets_the_same_batchrefs(self):
+        uow = FakeAsyncUnitOfWork()
+        handle(events.BatchCreated("batch1", "COMPLICATED-LAMP", 10, None), uow)
+        handle(events.BatchCreated("batch2", "COMPLICATED-LAMP", 10, None), uow)
+        lines = events.AllocationsRequired(
+            [
+                events.AllocationRequired("o1", "COMPLICATED-LAMP", 10, "key-1"),
+                events.AllocationRequired("o2", "COMPLICATED-LAMP", 5, "key-2"),
+            ]
+        )
+
+        assert handle(lines, uow) == [["batch1", "batch2"]]
+        product = asyncio.run(uow.products.get("COMPLICATED-LAMP"))
+        uow.products = FakeAsyncProductRepository([])
+
+        assert handle(lines, uow) == [["batch1", "batch2"]]
+        assert [b.available_quantity for b in product.batches] == [0, 5]
+
+    def test_errors_for_invalid_sku(self):
+        uow = FakeAsyncUnitOfWork()
+        with pytest.raises(models.InvalidSku):
+            handle(events.AllocationRequired("o1", "NONEXISTENTSKU", 10), uow)
+
+
+class TestChangeBatchQuantity:
+    def test_reallocates_if_necessary(self):
+        uow = FakeAsyncUnitOfWork()
+        event_history = [
+            events.BatchCreated("batch1", "INDIFFERENT-TABLE", 50, None),
+            events.BatchCreated("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            events.AllocationRequired("order1", "INDIFFERENT-TABLE", 20),
+            events.AllocationRequired("order2", "INDIFFERENT-TABLE", 20),
+        ]
+        for e in event_history:
+            handle(e, uow)
+
+        handle(events.BatchQuantityChanged("batch1", 25), uow)
+
+        product = asyncio.run(uow.products.get(sku="INDIFFERENT-TABLE"))
+        [batch1, batch2] = product.batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 30
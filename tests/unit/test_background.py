@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import pytest
+
+from cosmicpython.service_layer.background import (
+    AsyncHandlerTasks,
+    BackgroundQueueFull,
+    ThreadedHandlerPool,
+)
+
+
+class TestThreadedHandlerPool:
+    def test_caps_concurrent_calls_per_key(self):
+        pool = ThreadedHandlerPool(max_workers=4)
+        lock = threading.Lock()
+        running, peak = [0], [0]
+
+        def tracked():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            threading.Event().wait(0.01)
+            with lock:
+                running[0] -= 1
+
+        for _ in range(8):
+            pool.submit("notify", 2, tracked)
+
+        assert pool.join(timeout=5)
+        assert peak[0] == 2
+        assert pool.metrics["completed"] == 8
+        pool.shutdown()
+
+    def test_errors_are_counted_not_raised(self):
+        pool = ThreadedHandlerPool()
+
+        def broken():
+            raise ConnectionError("mail server went away")
+
+        pool.submit("notify", 1, broken)
+        pool.submit("notify", 1, lambda: None)
+
+        assert pool.join(timeout=5)
+        assert pool.metrics == {"submitted": 2, "failed": 1, "completed": 1}
+        pool.shutdown()
+
+    def test_rejects_submissions_once_full(self):
+        pool = ThreadedHandlerPool(max_pending=1, submit_timeout=0.01)
+        release = threading.Event()
+        pool.submit("notify", 1, release.wait)
+
+        with pytest.raises(BackgroundQueueFull):
+            pool.submit("notify", 1, release.wait)
+
+        release.set()
+        assert pool.join(timeout=5)
+        assert pool.metrics["rejected"] == 1
+        pool.shutdown()
+
+
+class TestAsyncHandlerTasks:
+    def test_caps_concurrent_calls_per_key(self):
+        tasks = AsyncHandlerTasks()
+        running, peak = [0], [0]
+
+        async def tracked():
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.001)
+            running[0] -= 1
+
+        async def scenario():
+            for _ in range(8):
+                await tasks.submit("notify", 3, tracked)
+            await tasks.join()
+
+        asyncio.run(scenario())
+        assert peak[0] == 3
+        assert tasks.metrics == {"submitted": 8, "completed": 8}
+
+    def test_errors_are_counted_not_raised(self):
+        tasks = AsyncHandlerTasks()
+
+        async def broken():
+            raise ConnectionError("mail server went away")
+
+        async def scenario():
+            await tasks.submit("notify", 1, broken)
+            await tasks.join()
+
+        asyncio.run(scenario())
+        assert tasks.metrics["failed"] == 1
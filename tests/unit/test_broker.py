@@ -0,0 +1,173 @@
+import pytest
+
+from cosmicpython.adapters import broker as brokers
+from cosmicpython.adapters.broker import FakeBroker
+from cosmicpython.domain import events
+from cosmicpython.service_layer.broker_consumer import (
+    BrokerConsumer,
+    dead_letter_stream,
+)
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.outbox_dispatcher import external_handlers
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+INBOUND = brokers.INBOUND
+ALLOCATED = brokers.OUTBOUND[events.Allocated]
+
+
+def send(broker, *commands):
+    broker.publish(INBOUND, [brokers.encode(command) for command in commands])
+
+
+def published(broker, stream):
+    return [
+        brokers.decode(m.fields, {"Allocated": events.Allocated})
+        for m in broker.streams.get(stream, [])
+    ]
+
+
+class TestFakeBroker:
+    def test_a_group_shares_messages_between_its_consumers(self):
+        broker = FakeBroker()
+        broker.create_group("s", "g")
+        broker.publish("s", [{"n": "1"}, {"n": "2"}, {"n": "3"}])
+
+        first = broker.read("g", "c1", ["s"], count=2)
+        second = broker.read("g", "c2", ["s"], count=2)
+
+        assert [m.fields["n"] for m in first] == ["1", "2"]
+        assert [m.fields["n"] for m in second] == ["3"]
+
+    def test_unacknowledged_messages_stay_pending_for_their_consumer(self):
+        broker = FakeBroker()
+        broker.create_group("s", "g")
+        broker.publish("s", [{"n": "1"}, {"n": "2"}])
+        [one, two] = broker.read("g", "c1", ["s"], count=10)
+
+        assert broker.ack("s", "g", [one.id]) == 1
+        assert broker.read("g", "c1", ["s"], count=10, pending=True) == [two]
+        assert broker.read("g", "c2", ["s"], count=10, pending=True) == []
+        assert broker.pending_count("s", "g") == 1
+
+    def test_reads_wait_for_messages(self):
+        broker = FakeBroker()
+        broker.create_group("s", "g")
+
+        assert broker.read("g", "c1", ["s"], count=1, block_ms=10) == []
+
+
+def test_events_round_trip_through_messages():
+    event = events.AllocationRequired("o1", "RED-CHAIR", 10)
+
+    assert brokers.decode(brokers.encode(event)) == event
+
+
+def test_unknown_messages_are_rejected():
+    with pytest.raises(brokers.UnknownMessage):
+        brokers.decode({"type": "Allocated", "payload": "{}"})
+
+
+def make_consumer(broker, uow, bus=None, **kwargs):
+    bus = bus or MessageBus()
+    return BrokerConsumer(broker, bus, lambda: uow, block_ms=0, **kwargs)
+
+
+class TestBrokerConsumer:
+    def test_allocates_what_it_reads(self):
+        broker, uow = FakeBroker(), FakeUnitOfWork()
+        consumer = make_consumer(broker, uow)
+        MessageBus().handle(events.BatchCreated("b1", "RED-CHAIR", 100), uow)
+        send(
+            broker,
+            events.AllocationRequired("o1", "RED-CHAIR", 10),
+            events.AllocationRequired("o2", "RED-CHAIR", 5),
+        )
+
+        assert consumer.consume_batch() == 2
+
+        assert uow.products.get("RED-CHAIR").batches[0].available_quantity == 85
+        # published by the outbox worker once committed, not in line
+        assert published(broker, ALLOCATED) == []
+        assert broker.pending_count(INBOUND, "cosmicpython") == 0
+        assert consumer.metrics == {"handled": 2, "acked": 2}
+
+    def test_dead_letters_what_it_cannot_handle(self):
+        broker, uow = FakeBroker(), FakeUnitOfWork()
+        consumer = make_consumer(broker, uow)
+        MessageBus().handle(events.BatchCreated("b1", "RED-CHAIR", 100), uow)
+        send(
+            broker,
+            events.AllocationRequired("o1", "RED-CHAIR", 10),
+            events.AllocationRequired("o2", "NO-SUCH-SKU", 5),
+        )
+        broker.publish(INBOUND, [{"type": "Garbage", "payload": "{}"}])
+
+        consumer.consume_batch()
+
+        dead = broker.streams[dead_letter_stream(INBOUND)]
+        assert [m.fields["type"] for m in dead] == ["AllocationRequired", "Garbage"]
+        assert "InvalidSku" in dead[0].fields["error"]
+        # the good line of the failed run still got allocated
+        assert uow.products.get("RED-CHAIR").batches[0].available_quantity == 90
+        assert broker.pending_count(INBOUND, "cosmicpython") == 0
+
+    def test_a_run_that_fails_after_allocating_is_not_allocated_again(self):
+        def broken_read_model(batch, uow):
+            raise ConnectionError("read model went away")
+
+        class BrokenMessageBus(MessageBus):
+            BATCH_HANDLERS = {
+                **MessageBus.BATCH_HANDLERS,
+                events.Allocated: [broken_read_model],
+            }
+
+        broker, uow = FakeBroker(), FakeUnitOfWork()
+        consumer = make_consumer(broker, uow, BrokenMessageBus())
+        MessageBus().handle(events.BatchCreated("b1", "RED-CHAIR", 10), uow)
+        MessageBus().handle(events.BatchCreated("b2", "RED-CHAIR", 100), uow)
+        send(
+            broker,
+            events.AllocationRequired("o1", "RED-CHAIR", 10),
+            events.AllocationRequired("o2", "RED-CHAIR", 5),
+        )
+
+        consumer.consume_batch()
+
+        [b1, b2] = uow.products.get("RED-CHAIR").batches
+        assert (b1.available_quantity, b2.available_quantity) == (0, 95)
+        assert len(broker.streams[dead_letter_stream(INBOUND)]) == 2
+        assert consumer.metrics == {"dead_lettered": 2, "acked": 2}
+
+    def test_a_restarted_consumer_handles_what_it_left_pending(self):
+        broker, uow = FakeBroker(), FakeUnitOfWork()
+        MessageBus().handle(events.BatchCreated("b1", "RED-CHAIR", 100), uow)
+        make_consumer(broker, uow)
+        send(broker, events.BatchQuantityChanged("b1", 50))
+        # read by a consumer that then died
+        broker.read("cosmicpython", "consumer-1", [INBOUND], count=10)
+
+        assert make_consumer(broker, uow).consume_batch() == 1
+
+        assert uow.products.get("RED-CHAIR").batches[0].available_quantity == 50
+        assert broker.pending_count(INBOUND, "cosmicpython") == 0
+
+
+def test_the_outbox_publishes_external_events_to_the_broker():
+    broker = FakeBroker()
+    [*_, publish] = external_handlers(broker)[events.OutOfStock]
+
+    publish(events.OutOfStock("RED-CHAIR"), idempotency_key="key-1")
+
+    [message] = broker.streams[brokers.OUTBOUND[events.OutOfStock]]
+    assert message.fields["idempotency_key"] == "key-1"
+
+
+def test_the_outbox_publishes_allocations_to_the_broker():
+    broker = FakeBroker()
+    [publish] = external_handlers(broker)[events.Allocated]
+
+    publish(events.Allocated("o1", "RED-CHAIR", 10, "b1"), idempotency_key="key-1")
+
+    assert published(broker, ALLOCATED) == [
+        events.Allocated("o1", "RED-CHAIR", 10, "b1")
+    ]
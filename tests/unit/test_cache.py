@@ -0,0 +1,57 @@
+from cosmicpython.adapters.cache import ProductCache, ProductSnapshot
+
+
+def snapshot(sku, version=1):
+    return ProductSnapshot(id=1, sku=sku, version=version, batches=())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_drops_least_recently_used_past_max_size():
+    cache = ProductCache(max_size=2)
+    cache.put(snapshot("a"))
+    cache.put(snapshot("b"))
+    cache.get("a")
+    cache.put(snapshot("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert len(cache) == 2
+    assert cache.metrics["evictions"] == 1
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = ProductCache(ttl=10, clock=clock)
+    cache.put(snapshot("a"))
+    clock.now = 10
+    assert cache.get("a") is not None
+    clock.now = 10.5
+    assert cache.get("a") is None
+    assert cache.metrics["expired"] == 1
+    assert cache.metrics["misses"] == 1
+
+
+def test_a_stale_snapshot_is_dropped():
+    cache = ProductCache()
+    cache.put(snapshot("a", version=3))
+    cached = cache.get("a")
+
+    assert cache.validate(cached, 3)
+    assert not cache.validate(cached, 4)
+    assert cache.get("a") is None
+    assert (cache.metrics["hits"], cache.metrics["stale"]) == (1, 1)
+
+
+def test_an_older_snapshot_does_not_replace_a_newer_one():
+    cache = ProductCache()
+    cache.put(snapshot("a", version=5))
+    cache.put(snapshot("a", version=4))
+
+    assert cache.get("a").version == 5
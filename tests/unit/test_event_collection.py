@@ -0,0 +1,37 @@
+from cosmicpython.domain import events
+from cosmicpython.domain.models import Batch, OrderLine, Product
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+
+def make_products(count):
+    return [
+        Product(f"SKU-{n}", [Batch(f"b{n}", f"SKU-{n}", 10, None)])
+        for n in range(count)
+    ]
+
+
+def test_only_products_that_recorded_events_are_collected():
+    products = make_products(100)
+    uow = FakeUnitOfWork(products)
+
+    products[7].allocate(OrderLine("o1", "SKU-7", 3))
+    products[3].allocate(OrderLine("o2", "SKU-3", 30))
+
+    assert list(uow.products.tracked.dirty) == [products[7], products[3]]
+    assert list(uow.collect_new_events()) == [
+        events.Allocated("o1", "SKU-7", 3, "b7"),
+        events.OutOfStock("SKU-3"),
+    ]
+    assert uow.products.tracked.dirty == {}
+    assert list(uow.collect_new_events()) == []
+
+
+def test_events_recorded_before_the_product_was_seen_are_collected():
+    [product] = make_products(1)
+    product.allocate(OrderLine("o1", "SKU-0", 3))
+
+    uow = FakeUnitOfWork([product])
+
+    assert list(uow.collect_new_events()) == [
+        events.Allocated("o1", "SKU-0", 3, "b0")
+    ]
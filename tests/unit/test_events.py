@@ -0,0 +1,16 @@
+import dataclasses
+from datetime import date
+
+from cosmicpython.domain import events
+
+
+def test_events_have_no_instance_dict():
+    event = events.BatchCreated("batch1", "SMALL-TABLE", 10, date.today())
+
+    assert not hasattr(event, "__dict__")
+
+
+def test_events_still_round_trip_as_dicts():
+    event = events.Allocated("order1", "SMALL-TABLE", 10, "batch1")
+
+    assert events.Allocated(**dataclasses.asdict(event)) == event
@@ -1,10 +1,24 @@
+import threading
 from collections import defaultdict
 from datetime import date
 from typing import List
 
-from cosmicpython.domain import events
-from cosmicpython.service_layer.message_bus import AbstractMessageBus, MessageBus
-from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+import pytest
+
+from cosmicpython.adapters.batch_loader import DuplicateBatches
+from cosmicpython.adapters.idempotency import IdempotencyKeyReused
+from cosmicpython.adapters.repository import FakeProductRepository, ProductLocked
+from cosmicpython.domain import events, models
+from cosmicpython.service_layer import handlers
+from cosmicpython.service_layer.message_bus import (
+    AbstractMessageBus,
+    MessageBus,
+    RetryPolicy,
+)
+from cosmicpython.service_layer.unit_of_work import (
+    ConcurrencyConflict,
+    FakeUnitOfWork,
+)
 
 message_bus = MessageBus()
 
@@ -19,6 +33,45 @@ class TestAddBatch:
         assert uow.committed
 
 
+class TestAddBatches:
+    def test_adds_every_batch_to_its_product(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "CRUNCHY-ARMCHAIR", 100), uow)
+        [loaded] = message_bus.handle(
+            events.BatchesCreated(
+                [
+                    events.BatchCreated("b2", "CRUNCHY-ARMCHAIR", 50),
+                    events.BatchCreated("b3", "MISC-LAMP", 10),
+                ]
+            ),
+            uow,
+        )
+        assert loaded == 2
+        assert [
+            b.reference for b in uow.products.get("CRUNCHY-ARMCHAIR").batches
+        ] == [
+            "b1",
+            "b2",
+        ]
+        assert uow.products.get("MISC-LAMP").version == 1
+        assert uow.committed
+
+    def test_rejects_batches_that_already_exist(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "CRUNCHY-ARMCHAIR", 100), uow)
+        with pytest.raises(DuplicateBatches, match="b1"):
+            message_bus.handle(
+                events.BatchesCreated(
+                    [
+                        events.BatchCreated("b2", "CRUNCHY-ARMCHAIR", 50),
+                        events.BatchCreated("b1", "CRUNCHY-ARMCHAIR", 50),
+                    ]
+                ),
+                uow,
+            )
+        assert len(uow.products.get("CRUNCHY-ARMCHAIR").batches) == 1
+
+
 class TestAllocate:
     def test_returns_allocation(self):
         uow = FakeUnitOfWork()
@@ -30,6 +83,115 @@ class TestAllocate:
         ).pop(0)
         assert result == "batch1"
 
+    def test_a_retry_gets_the_same_batchref_without_loading_the_product(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "COMPLICATED-LAMP", 100), uow)
+        line = events.AllocationRequired("o1", "COMPLICATED-LAMP", 10, "key-1")
+        [batchref] = message_bus.handle(line, uow)
+        product = uow.products.get("COMPLICATED-LAMP")
+        uow.products = FakeProductRepository([])
+
+        assert message_bus.handle(line, uow) == [batchref]
+        assert product.batches[0].available_quantity == 90
+
+    def test_a_key_used_for_another_line_is_rejected(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "COMPLICATED-LAMP", 100), uow)
+        message_bus.handle(
+            events.AllocationRequired("o1", "COMPLICATED-LAMP", 10, "key-1"), uow
+        )
+
+        with pytest.raises(IdempotencyKeyReused):
+            message_bus.handle(
+                events.AllocationRequired("o2", "COMPLICATED-LAMP", 10, "key-1"), uow
+            )
+
+
+class TestAllocateMany:
+    def test_returns_a_result_per_line(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("batch1", "FLAT-RUG", 10, None), uow)
+        message_bus.handle(events.BatchCreated("batch2", "ROUND-RUG", 10, None), uow)
+
+        results = message_bus.handle(
+            events.AllocationsRequired(
+                [
+                    events.AllocationRequired("o1", "FLAT-RUG", 6),
+                    events.AllocationRequired("o2", "ROUND-RUG", 2),
+                    events.AllocationRequired("o3", "FLAT-RUG", 6),
+                ]
+            ),
+            uow,
+        )
+
+        assert results[0] == ["batch1", "batch2", None]
+        assert uow.committed
+
+    def test_raises_out_of_stock_for_each_line(self):
+        uow = FakeUnitOfWork()
+        messagebus = FakeMessageBus()
+        messagebus.handle(events.BatchCreated("batch1", "FLAT-RUG", 10, None), uow)
+
+        messagebus.handle(
+            events.AllocationsRequired(
+                [
+                    events.AllocationRequired("o1", "FLAT-RUG", 20),
+                    events.AllocationRequired("o2", "FLAT-RUG", 20),
+                ]
+            ),
+            uow,
+        )
+
+        assert messagebus.events_published == [events.OutOfStock("FLAT-RUG")] * 2
+
+    def test_retried_lines_get_their_batchrefs_without_loading_the_product(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "FLAT-RUG", 10), uow)
+        lines = events.AllocationsRequired(
+            [
+                events.AllocationRequired("o1", "FLAT-RUG", 6, "key-1"),
+                events.AllocationRequired("o2", "FLAT-RUG", 2, "key-2"),
+            ]
+        )
+        [batchrefs] = message_bus.handle(lines, uow)
+        product = uow.products.get("FLAT-RUG")
+        uow.products = FakeProductRepository([])
+
+        assert message_bus.handle(lines, uow) == [batchrefs] == [["b1", "b1"]]
+        assert product.batches[0].available_quantity == 2
+
+    def test_a_key_repeated_in_the_run_is_allocated_once(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "FLAT-RUG", 10), uow)
+        message_bus.handle(events.BatchCreated("b2", "FLAT-RUG", 10), uow)
+        line = events.AllocationRequired("o1", "FLAT-RUG", 10, "key-1")
+
+        [batchrefs] = message_bus.handle(events.AllocationsRequired([line] * 2), uow)
+
+        assert batchrefs == ["b1", "b1"]
+        [b1, b2] = uow.products.get("FLAT-RUG").batches
+        assert (b1.available_quantity, b2.available_quantity) == (0, 10)
+
+    def test_invalid_sku_allocates_nothing(self):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("batch1", "FLAT-RUG", 10, None), uow)
+        uow.committed = False
+
+        with pytest.raises(models.InvalidSku):
+            message_bus.handle(
+                events.AllocationsRequired(
+                    [
+                        events.AllocationRequired("o1", "FLAT-RUG", 1),
+                        events.AllocationRequired("o2", "NO-SUCH-RUG", 1),
+                    ]
+                ),
+                uow,
+            )
+
+        [batch] = uow.products.get(sku="FLAT-RUG").batches
+        assert batch.available_quantity == 10
+        assert not uow.committed
+
 
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
@@ -65,6 +227,26 @@ class TestChangeBatchQuantity:
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30  # (2)
 
+    def test_reallocates_every_line_of_an_emptied_batch(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus()
+        messagebus.handle(events.BatchCreated("batch1", "LONG-BENCH", 500, None), uow)
+        messagebus.handle(
+            events.BatchCreated("batch2", "LONG-BENCH", 500, date.today()), uow
+        )
+        for n in range(500):
+            messagebus.handle(
+                events.AllocationRequired(f"o{n}", "LONG-BENCH", 1), uow
+            )
+
+        results = messagebus.handle(events.BatchQuantityChanged("batch1", 0), uow)
+
+        assert results == [None] + ["batch2"] * 500
+        [batch1, batch2] = uow.products.get(sku="LONG-BENCH").batches
+        assert batch1.allocated_quantity == 0
+        assert batch2.allocated_quantity == 500
+        assert uow.products.get(sku="LONG-BENCH").events == []
+
     def test_reallocates_if_necessary_isolated(self):
         uow = FakeUnitOfWork()
         messagebus = FakeMessageBus()
@@ -83,15 +265,207 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 10
         assert batch2.available_quantity == 50
 
+        messagebus.events_published.clear()
         messagebus.handle(events.BatchQuantityChanged("batch1", 25), uow)
 
         # assert on new events emitted rather than downstream side-effects
-        [reallocation_event] = messagebus.events_published
+        [deallocation_event, reallocation_event] = messagebus.events_published
+        assert isinstance(deallocation_event, events.Deallocated)
+        assert deallocation_event.orderid == reallocation_event.orderid
         assert isinstance(reallocation_event, events.AllocationRequired)
         assert reallocation_event.orderid in {"order1", "order2"}
         assert reallocation_event.sku == "INDIFFERENT-TABLE"
 
 
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    """Loses the race to another transaction on its first ``conflicts`` commits."""
+
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+        self.commits = 0
+
+    def _commit(self):
+        self.commits += 1
+        if self.commits <= self.conflicts:
+            raise ConcurrencyConflict("products row changed underneath us")
+        super()._commit()
+
+
+class TestConcurrencyConflicts:
+    def test_retries_the_handler_with_backoff(self):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        MessageBus().handle(events.BatchCreated("b1", "BUSY-LAMP", 100, None), uow)
+        uow.conflicts, uow.commits = 2, 0
+        waits = []
+        messagebus = MessageBus(
+            RetryPolicy(attempts=3, backoff=0.01, multiplier=2, jitter=0),
+            sleep=waits.append,
+        )
+
+        [batchref] = messagebus.handle(
+            events.AllocationRequired("o1", "BUSY-LAMP", 10), uow
+        )
+
+        assert batchref == "b1"
+        assert waits == [0.01, 0.02]
+        assert messagebus.metrics["conflicts"] == 2
+        assert messagebus.metrics["retries"] == 2
+
+    def test_gives_up_after_the_last_attempt(self):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        MessageBus().handle(events.BatchCreated("b1", "BUSY-LAMP", 100, None), uow)
+        uow.conflicts, uow.commits = 5, 0
+        messagebus = MessageBus(RetryPolicy(attempts=2), sleep=lambda _: None)
+
+        with pytest.raises(ConcurrencyConflict):
+            messagebus.handle(events.AllocationRequired("o1", "BUSY-LAMP", 10), uow)
+
+        assert messagebus.metrics["retries_exhausted"] == 1
+
+
+class LockingProductRepository(FakeProductRepository):
+    """Records the lock each read asked for; the first ``busy`` reads find it held."""
+
+    def __init__(self, products, busy=0):
+        super().__init__(products)
+        self.locks = []
+        self.busy = busy
+
+    def _get(self, sku, loading=None, lock=None):
+        self.locks.append(lock)
+        if len(self.locks) <= self.busy:
+            raise ProductLocked(sku)
+        return super()._get(sku)
+
+
+class TestRowLocking:
+    def make_uow(self, busy=0):
+        uow = FakeUnitOfWork()
+        message_bus.handle(events.BatchCreated("b1", "HOT-CHAIR", 100, None), uow)
+        uow.products = LockingProductRepository(uow.products.seen, busy=busy)
+        return uow
+
+    def test_allocates_under_the_lock_configured_for_the_handler(self):
+        uow = self.make_uow()
+        messagebus = MessageBus(
+            handler_options={handlers.allocate: {"lock": "nowait"}}
+        )
+
+        messagebus.handle(events.AllocationRequired("o1", "HOT-CHAIR", 10), uow)
+
+        assert uow.products.locks == ["nowait"]
+
+    def test_lines_allocated_together_take_the_lock_configured_for_allocate(self):
+        uow = self.make_uow()
+        messagebus = MessageBus(
+            handler_options={handlers.allocate: {"lock": "nowait"}}
+        )
+        lines = [
+            events.AllocationRequired("o1", "HOT-CHAIR", 10),
+            events.AllocationRequired("o2", "HOT-CHAIR", 10),
+        ]
+
+        messagebus.handle(events.AllocationsRequired(lines), uow)
+
+        assert uow.products.locks == ["nowait"]
+
+    def test_retries_while_the_row_is_held(self):
+        uow = self.make_uow(busy=1)
+        messagebus = MessageBus(
+            RetryPolicy(backoff=0),
+            handler_options={handlers.allocate: {"lock": "skip_locked"}},
+        )
+
+        [batchref] = messagebus.handle(
+            events.AllocationRequired("o1", "HOT-CHAIR", 10), uow
+        )
+
+        assert batchref == "b1"
+        assert uow.products.locks == ["skip_locked", "skip_locked"]
+        assert messagebus.metrics["retries"] == 1
+
+
+class TestFireAndForget:
+    def test_side_effects_run_in_the_background_without_failing_the_command(self):
+        ran = threading.Event()
+
+        def notify(event, uow):
+            ran.set()
+            raise ConnectionError("mail server went away")
+
+        class NotifyingMessageBus(MessageBus):
+            HANDLERS = {**MessageBus.HANDLERS, events.OutOfStock: [notify]}
+            FIRE_AND_FORGET = {notify: 1}
+
+        uow = FakeUnitOfWork()
+        messagebus = NotifyingMessageBus()
+        messagebus.handle(events.BatchCreated("b1", "RARE-RUG", 1, None), uow)
+
+        results = messagebus.handle(
+            events.AllocationRequired("o1", "RARE-RUG", 5), uow
+        )
+
+        assert results == [None]
+        assert messagebus.join(timeout=5)
+        assert ran.is_set()
+        assert messagebus.background.metrics["failed"] == 1
+
+
+class OneAtATimeMessageBus(MessageBus):
+    BATCH_HANDLERS = {
+        event_type: batch_handlers
+        for event_type, batch_handlers in MessageBus.BATCH_HANDLERS.items()
+        if event_type not in MessageBus.HANDLERS
+    }
+
+
+class TestReallocationCascade:
+    def shrink(self, messagebus, uow):
+        history = [
+            events.BatchCreated("batch1", "SLIM-SHELF", 10, None),
+            events.BatchCreated("batch2", "SLIM-SHELF", 6, date.today()),
+            events.BatchCreated("batch3", "SLIM-SHELF", 100, date(2099, 1, 1)),
+        ] + [
+            events.AllocationRequired(f"o{n}", "SLIM-SHELF", n) for n in (1, 2, 3, 4)
+        ]
+        for e in history:
+            messagebus.handle(e, uow)
+        uow.commits = 0
+        return messagebus.handle(events.BatchQuantityChanged("batch1", 0), uow)
+
+    def allocations(self, uow):
+        product = uow.products.get(sku="SLIM-SHELF")
+        return {
+            batch.reference: sorted(line.orderid for line in batch._allocations)
+            for batch in product.batches
+        }
+
+    def test_reallocates_the_whole_cascade_in_one_commit(self):
+        uow = ConflictingUnitOfWork(conflicts=0)
+
+        self.shrink(MessageBus(), uow)
+
+        # the shrink, then one each for every line it evicted: dropping them
+        # from the read model, reallocating them and adding them back to it
+        assert uow.commits == 4
+
+    def test_matches_handling_each_event_on_its_own(self):
+        batched, one_at_a_time = (
+            ConflictingUnitOfWork(conflicts=0),
+            ConflictingUnitOfWork(conflicts=0),
+        )
+
+        batched_results = self.shrink(MessageBus(), batched)
+        single_results = self.shrink(OneAtATimeMessageBus(), one_at_a_time)
+
+        assert batched_results == single_results
+        assert self.allocations(batched) == self.allocations(one_at_a_time)
+        # the shrink, the read model removal, 4 allocations and the read model
+        # additions, which queue up behind the allocations into a single run
+        assert one_at_a_time.commits == 7
+
+
 class FakeMessageBus(MessageBus):
     def __init__(self):
         super().__init__()
@@ -0,0 +1,47 @@
+import asyncio
+
+from cosmicpython.adapters.idempotency import (
+    AllocationRecord,
+    FakeAsyncIdempotencyStore,
+    FakeIdempotencyStore,
+    IdempotencyCache,
+)
+
+RECORD = AllocationRecord("o1", "LAMP", 10, "b1")
+
+
+def test_the_least_recently_used_record_is_dropped():
+    cache = IdempotencyCache(max_size=2)
+    cache.put("k1", RECORD)
+    cache.put("k2", RECORD)
+    cache.get("k1")
+
+    cache.put("k3", RECORD)
+
+    assert cache.get("k2") is None
+    assert cache.get("k1") == RECORD
+    assert cache.metrics == {"hits": 2, "misses": 1, "evictions": 1}
+
+
+def test_records_are_only_cached_once_committed():
+    store = FakeIdempotencyStore()
+    store.cache = IdempotencyCache()
+
+    store.add("k1", RECORD)
+    assert store.cache.get("k1") is None
+
+    store.committed()
+    assert store.cache.get("k1") == RECORD
+
+
+def test_the_async_store_caches_what_was_committed_too():
+    store = FakeAsyncIdempotencyStore()
+    store.cache = IdempotencyCache()
+
+    asyncio.run(store.add("k1", RECORD))
+    assert store.cache.get("k1") is None
+
+    store.committed()
+    assert store.cache.get("k1") == RECORD
+    assert asyncio.run(store.get("k1")) == RECORD
+    assert store.cache.metrics == {"hits": 2, "misses": 1}
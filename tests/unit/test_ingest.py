@@ -0,0 +1,97 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from cosmicpython.adapters.batch_loader import DuplicateBatches
+from cosmicpython.domain import events
+from cosmicpython.service_layer import ingest
+from cosmicpython.service_layer.message_bus import AsyncMessageBus, MessageBus
+from cosmicpython.service_layer.unit_of_work import (
+    FakeAsyncUnitOfWork,
+    FakeUnitOfWork,
+)
+
+CSV = """ref,sku,qty,eta
+b1,LAMP,100,2011-01-02
+b2,LAMP,20,
+b3,TABLE,5,
+"""
+
+NDJSON = """{"ref": "b1", "sku": "LAMP", "qty": 100, "eta": "2011-01-02"}
+{"ref": "b2", "sku": "LAMP", "qty": 20, "eta": null}
+
+{"ref": "b3", "sku": "TABLE", "qty": 5}
+"""
+
+EXPECTED = [
+    events.BatchCreated("b1", "LAMP", 100, date(2011, 1, 2)),
+    events.BatchCreated("b2", "LAMP", 20),
+    events.BatchCreated("b3", "TABLE", 5),
+]
+
+
+@pytest.mark.parametrize("format, text", [("csv", CSV), ("ndjson", NDJSON)])
+def test_reads_batches(format, text):
+    rows = ingest.reader_for(format).rows(text.splitlines())
+    assert list(rows) == EXPECTED
+
+
+@pytest.mark.parametrize(
+    "format, text, error",
+    [
+        ("csv", "ref,sku,qty\nb1,LAMP,lots\n", "Line 2: invalid literal"),
+        ("csv", "ref,sku,qty\nb1,LAMP\n", "Line 2: expected 3 fields, got 2"),
+        ("csv", "ref,qty\nb1,1\n", "Line 2: missing sku"),
+        (
+            "ndjson",
+            '{"ref": "b1", "sku": "LAMP", "qty": 1}\n[1]\n',
+            "Line 2: expected",
+        ),
+        ("ndjson", '{"ref": "b1", "sku": "LAMP", "qty": 1, "eta": "soon"}', "Line 1"),
+    ],
+)
+def test_bad_rows_name_their_line(format, text, error):
+    with pytest.raises(ingest.InvalidShipmentRow, match=error):
+        list(ingest.reader_for(format).rows(text.splitlines()))
+
+
+def test_ingests_in_chunks():
+    uow = FakeUnitOfWork()
+    report = ingest.ingest(
+        CSV.splitlines(), MessageBus(), lambda: uow, format="csv", chunk_size=2
+    )
+
+    assert (report.rows, report.chunks) == (3, 2)
+    assert len(uow.products.get("LAMP").batches) == 2
+    assert uow.products.get("TABLE") is not None
+
+
+def test_a_failed_chunk_reports_what_was_loaded():
+    uow = FakeUnitOfWork()
+    lines = CSV.splitlines() + ["b1,LAMP,1,"]
+
+    with pytest.raises(ingest.IngestFailed, match="after 2 rows") as failure:
+        ingest.ingest(lines, MessageBus(), lambda: uow, format="csv", chunk_size=2)
+
+    assert isinstance(failure.value.__cause__, DuplicateBatches)
+    assert failure.value.report.rows == 2
+
+
+def test_ingests_a_byte_stream():
+    uow = FakeAsyncUnitOfWork()
+
+    async def body():
+        # pieces that split lines, and a body with no final newline
+        data = NDJSON.rstrip("\n").encode()
+        for start in range(0, len(data), 7):
+            yield data[start : start + 7]
+
+    report = asyncio.run(
+        ingest.ingest_async(
+            body(), AsyncMessageBus(), lambda: uow, format="ndjson", chunk_size=2
+        )
+    )
+
+    assert (report.rows, report.chunks) == (3, 2)
+    assert len(uow.products._products.get("LAMP").batches) == 2
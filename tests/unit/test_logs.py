@@ -0,0 +1,79 @@
+import logging
+
+import pytest
+
+from cosmicpython import logs
+
+
+class Expensive:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return "expensive value"
+
+
+def test_fields_are_formatted_as_key_value_pairs(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    logs.get_logger("test.logs").info("allocated", sku="RED-CHAIR", qty=10)
+
+    assert caplog.records[0].getMessage() == "allocated sku=RED-CHAIR qty=10"
+    assert caplog.records[0].fields == {"sku": "RED-CHAIR", "qty": 10}
+
+
+def test_values_with_spaces_are_quoted(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    logs.get_logger("test.logs").info("note", text="two words", empty="")
+
+    assert caplog.records[0].getMessage() == "note text='two words' empty=''"
+
+
+def test_lazy_values_are_not_computed_below_the_level(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    expensive = Expensive()
+    logs.get_logger("test.logs").debug("detail", value=logs.lazy(expensive))
+
+    assert expensive.calls == 0
+    assert not caplog.records
+
+
+def test_lazy_values_are_computed_when_emitted(caplog):
+    caplog.set_level(logging.DEBUG, logger="test.logs")
+    expensive = Expensive()
+    logs.get_logger("test.logs").debug("detail", value=logs.lazy(expensive))
+
+    assert caplog.records[0].getMessage() == "detail value='expensive value'"
+
+
+def test_sampling_drops_info_but_keeps_warnings(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    logger = logs.StructuredLogger(
+        logging.getLogger("test.logs"), sample_rate=0.25, random=lambda: 0.5
+    )
+    logger.info("sampled_out")
+    logger.warning("kept")
+
+    assert [r.getMessage() for r in caplog.records] == ["kept"]
+
+
+def test_sampling_keeps_records_below_the_rate(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    logger = logs.StructuredLogger(
+        logging.getLogger("test.logs"), sample_rate=0.25, random=lambda: 0.1
+    )
+    logger.info("sampled_in")
+
+    assert [r.getMessage() for r in caplog.records] == ["sampled_in"]
+
+
+def test_records_point_at_the_caller(caplog):
+    caplog.set_level(logging.INFO, logger="test.logs")
+    logs.get_logger("test.logs").info("here")
+
+    assert caplog.records[0].funcName == "test_records_point_at_the_caller"
+
+
+def test_sample_rate_must_be_a_share():
+    with pytest.raises(ValueError):
+        logs.configure(sample_rate=1.5)
@@ -0,0 +1,98 @@
+import pytest
+
+from cosmicpython.adapters.metrics import NoopMetrics, PrometheusMetrics
+from cosmicpython.domain import events
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+
+def test_counters_render_with_their_labels():
+    metrics = PrometheusMetrics()
+    metrics.increment("bus_events_total", event="OutOfStock")
+    metrics.increment("bus_events_total", 2, event="OutOfStock")
+
+    assert metrics.render().splitlines() == [
+        "# HELP cosmicpython_bus_events_total Events handled by the message bus",
+        "# TYPE cosmicpython_bus_events_total counter",
+        'cosmicpython_bus_events_total{event="OutOfStock"} 3',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = PrometheusMetrics()
+    for queries in (1, 3, 3, 400):
+        metrics.observe("bus_queries_per_request", queries)
+
+    lines = metrics.render().splitlines()
+    assert 'cosmicpython_bus_queries_per_request_bucket{le="0"} 0' in lines
+    assert 'cosmicpython_bus_queries_per_request_bucket{le="1"} 1' in lines
+    assert 'cosmicpython_bus_queries_per_request_bucket{le="3"} 3' in lines
+    assert 'cosmicpython_bus_queries_per_request_bucket{le="250"} 3' in lines
+    assert 'cosmicpython_bus_queries_per_request_bucket{le="+Inf"} 4' in lines
+    assert "cosmicpython_bus_queries_per_request_sum 407.0" in lines
+    assert "cosmicpython_bus_queries_per_request_count 4" in lines
+
+
+def test_label_values_are_escaped():
+    metrics = PrometheusMetrics()
+    metrics.increment("uow_rollbacks_total", reason='say "no"\n')
+
+    assert r'reason="say \"no\"\n"' in metrics.render()
+
+
+def test_only_known_metrics_can_be_recorded():
+    with pytest.raises(ValueError):
+        PrometheusMetrics().increment("bus_handler_seconds")
+
+
+def test_collectors_are_rendered_with_the_rest():
+    metrics = PrometheusMetrics()
+    metrics.add_collector(lambda: [("db_pool", "gauge", "Pool", {"stat": "size"}, 5)])
+
+    assert 'cosmicpython_db_pool{stat="size"} 5' in metrics.render()
+
+
+def test_noop_metrics_record_nothing():
+    metrics = NoopMetrics()
+    metrics.increment("bus_events_total", event="OutOfStock")
+    with metrics.timer("uow_commit_seconds"):
+        pass
+
+    assert metrics.render() == ""
+
+
+def test_the_bus_records_events_handlers_and_commits():
+    metrics = PrometheusMetrics()
+    uow = FakeUnitOfWork()
+    uow.metrics = metrics
+    bus = MessageBus(request_metrics=metrics)
+
+    bus.handle(events.BatchCreated("b1", "SMALL-TABLE", 10, None), uow)
+    bus.handle(events.AllocationRequired("o1", "SMALL-TABLE", 1), uow)
+
+    assert metrics.value("bus_events_total", event="BatchCreated") == 1
+    assert metrics.value("bus_events_total", event="AllocationRequired") == 1
+    assert metrics.value("bus_handler_seconds", handler="allocate") == 1
+    assert metrics.value("domain_call_seconds", call="allocate") == 1
+    # the Allocated event's read model update commits too
+    assert metrics.value("bus_events_total", event="Allocated") == 1
+    assert metrics.value("uow_commit_seconds") == 3
+    assert metrics.value("bus_queries_per_request") == 2
+
+
+def test_handler_errors_and_rollbacks_are_counted():
+    metrics = PrometheusMetrics()
+    uow = FakeUnitOfWork()
+    uow.metrics = metrics
+    bus = MessageBus(request_metrics=metrics)
+
+    with pytest.raises(Exception):
+        bus.handle(events.AllocationRequired("o1", "NO-SUCH-SKU", 1), uow)
+
+    assert (
+        metrics.value(
+            "bus_handler_errors_total", handler="allocate", error="InvalidSku"
+        )
+        == 1
+    )
+    assert metrics.value("uow_rollbacks_total", reason="InvalidSku") == 1
@@ -1,4 +1,5 @@
-from datetime import date
+import random
+from datetime import date, timedelta
 
 from cosmicpython.domain import events
 from cosmicpython.domain.models import Batch, OrderLine, Product
@@ -14,3 +15,90 @@ def test_records_out_of_stock_event_if_cannot_allocate():
     allocation = product.allocate(OrderLine("order2", "SMALL-FORK", 1))
     assert product.events[-1] == events.OutOfStock(sku="SMALL-FORK")  # (1)
     assert allocation is None
+
+
+def test_records_allocated_and_deallocated_events():
+    batch = Batch("batch1", "SMALL-FORK", 10, eta=today)
+    product = Product(sku="SMALL-FORK", batches=[batch])
+    line = OrderLine("order1", "SMALL-FORK", 3)
+
+    product.allocate(line)
+    product.deallocate(line)
+
+    assert product.events == [
+        events.Allocated("order1", "SMALL-FORK", 3, "batch1"),
+        events.Deallocated("order1", "SMALL-FORK", 3),
+    ]
+
+
+def test_allocating_a_line_again_records_nothing():
+    batch = Batch("batch1", "SMALL-FORK", 10, eta=today)
+    product = Product(sku="SMALL-FORK", batches=[batch])
+    line = OrderLine("order1", "SMALL-FORK", 3)
+    product.allocate(line)
+    version = product.version
+
+    assert product.allocate(line) == "batch1"
+    assert product.version == version
+    assert product.events == [events.Allocated("order1", "SMALL-FORK", 3, "batch1")]
+
+
+def test_shrinking_a_batch_deallocates_every_line_before_asking_to_reallocate():
+    batch = Batch("batch1", "SMALL-FORK", 10, eta=today)
+    product = Product(sku="SMALL-FORK", batches=[batch])
+    for n in range(3):
+        product.allocate(OrderLine(f"order{n}", "SMALL-FORK", 3))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 0)
+
+    assert [type(e) for e in product.events] == (
+        [events.Deallocated] * 3 + [events.AllocationRequired] * 3
+    )
+
+
+def test_skips_earlier_batches_too_small_for_the_line():
+    small = Batch("small-batch", "TALL-LAMP", 5, eta=None)
+    large = Batch("large-batch", "TALL-LAMP", 50, eta=today)
+    product = Product(sku="TALL-LAMP", batches=[small, large])
+
+    assert product.allocate(OrderLine("order1", "TALL-LAMP", 10)) == "large-batch"
+    assert product.allocate(OrderLine("order2", "TALL-LAMP", 5)) == "small-batch"
+
+
+def test_added_batches_take_their_place_in_eta_order():
+    later = Batch("later-batch", "SHORT-LAMP", 10, eta=today + timedelta(days=2))
+    product = Product(sku="SHORT-LAMP", batches=[later])
+    product.allocate(OrderLine("order1", "SHORT-LAMP", 1))
+
+    product.add_batch(Batch("sooner-batch", "SHORT-LAMP", 10, eta=today))
+
+    assert product.allocate(OrderLine("order2", "SHORT-LAMP", 1)) == "sooner-batch"
+
+
+def test_allocates_like_sorting_the_batches_on_every_call():
+    rng = random.Random(1234)
+    etas = [None, today, today + timedelta(days=1), today + timedelta(days=2)]
+    batches = [
+        Batch(f"batch{i}", "ODD-VASE", rng.randint(0, 20), eta=rng.choice(etas))
+        for i in range(40)
+    ]
+    expected = [
+        Batch(b.reference, b.sku, b._purchased_quantity, b.eta) for b in batches
+    ]
+    product = Product(sku="ODD-VASE", batches=batches)
+
+    allocated = []
+    for i in range(200):
+        if allocated and i % 10 == 0:
+            line = allocated.pop(rng.randrange(len(allocated)))
+            product.deallocate(line)
+            next(b for b in expected if b.contains(line)).deallocate(line)
+
+        line = OrderLine(f"order{i}", "ODD-VASE", rng.randint(1, 8))
+        batch = next((b for b in sorted(expected) if b.can_allocate(line)), None)
+        if batch:
+            batch.allocate(line)
+            allocated.append(line)
+
+        assert product.allocate(line) == (batch.reference if batch else None)
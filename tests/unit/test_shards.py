@@ -0,0 +1,101 @@
+import queue
+
+from cosmicpython.domain import events
+from cosmicpython.service_layer import shards
+from cosmicpython.service_layer.message_bus import MessageBus
+from cosmicpython.service_layer.unit_of_work import FakeUnitOfWork
+
+
+def test_a_sku_always_goes_to_the_same_shard():
+    skus = [f"SKU-{n}" for n in range(1000)]
+
+    placed = [shards.shard_for(sku, 4) for sku in skus]
+
+    assert placed == [shards.shard_for(sku, 4) for sku in skus]
+    assert shards.shard_for("RED-CHAIR", 4) == 1  # the same in every process
+    assert set(placed) == {0, 1, 2, 3}
+    assert min(placed.count(shard) for shard in range(4)) > 200
+
+
+def test_takes_what_is_waiting_up_to_the_limit():
+    inbox = queue.Queue()
+    for n in range(5):
+        inbox.put(n)
+
+    assert shards.take_waiting(inbox, "first", 3) == ["first", 0, 1]
+    assert shards.take_waiting(inbox, "first", 10) == ["first", 2, 3, 4]
+
+
+def test_stops_taking_at_the_sentinel():
+    inbox = queue.Queue()
+    for item in (1, None, 2):
+        inbox.put(item)
+
+    assert shards.take_waiting(inbox, 0, 10) == [0, 1, None]
+
+
+def test_allocates_what_it_took_together():
+    uow = FakeUnitOfWork()
+    bus = MessageBus()
+    bus.handle(events.BatchCreated("b1", "RED-CHAIR", 10), uow)
+
+    outcomes = shards.allocate(
+        bus,
+        lambda: uow,
+        [
+            (1, events.AllocationRequired("o1", "RED-CHAIR", 6)),
+            (2, events.AllocationRequired("o2", "RED-CHAIR", 6)),
+        ],
+    )
+
+    assert outcomes == [(1, "b1", None), (2, None, None)]
+    assert uow.committed
+
+
+def test_one_bad_line_only_fails_itself():
+    uow = FakeUnitOfWork()
+    bus = MessageBus()
+    bus.handle(events.BatchCreated("b1", "RED-CHAIR", 10), uow)
+
+    [ok, bad] = shards.allocate(
+        bus,
+        lambda: uow,
+        [
+            (1, events.AllocationRequired("o1", "RED-CHAIR", 6)),
+            (2, events.AllocationRequired("o2", "NO-SUCH-SKU", 1)),
+        ],
+    )
+
+    assert ok == (1, "b1", None)
+    assert bad[:2] == (2, None) and "InvalidSku" in bad[2]
+
+
+def test_lines_that_fail_after_allocating_are_not_allocated_again():
+    def broken_read_model(batch, uow):
+        raise ConnectionError("read model went away")
+
+    class BrokenMessageBus(MessageBus):
+        BATCH_HANDLERS = {
+            **MessageBus.BATCH_HANDLERS,
+            events.Allocated: [broken_read_model],
+        }
+
+    uow = FakeUnitOfWork()
+    bus = MessageBus()
+    bus.handle(events.BatchCreated("b1", "RED-CHAIR", 10), uow)
+    bus.handle(events.BatchCreated("b2", "RED-CHAIR", 10), uow)
+
+    outcomes = shards.allocate(
+        BrokenMessageBus(),
+        lambda: uow,
+        [
+            (1, events.AllocationRequired("o1", "RED-CHAIR", 10)),
+            (2, events.AllocationRequired("o2", "RED-CHAIR", 5)),
+        ],
+    )
+
+    assert [error for _, _, error in outcomes] == [
+        "ConnectionError: read model went away"
+    ] * 2
+    [b1, b2] = uow.products.get("RED-CHAIR").batches
+    assert (b1.available_quantity, b2.available_quantity) == (0, 5)